@@ -1,14 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import dis
 import logging
+import threading
 import warnings
-from types import FunctionType
+from types import ClassType, CodeType, FunctionType
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 import byteplay
 
+import cache
+import gf2
 import hook
+import importer
+import liveness
+import matrices
+import peephole
 import recompiler
+import report
+import semirings
 
 
 __author__ = 'Alexander Borzunov'
@@ -19,66 +34,139 @@ orig_xrange = xrange
 xrange = hook.CPMRange
 
 
-def analyze_loop(settings, code, index):
-    instr = code[index]
-    if not (instr[0] == byteplay.FOR_ITER and
-            (index >= 2 and code[index - 2][0] == byteplay.GET_ITER)):
-        return 0
-    # Now we found GET_ITER and FOR_ITER instructions
-
-    # Try to find SETUP_LOOP
-    for rel_index in orig_xrange(index - 3, -1, -1):
-        if code[rel_index][0] == byteplay.SETUP_LOOP:
-            setup_index = rel_index
-            break
-    else:
-        return 0
-
-    # Try to find JUMP_ABSOLUTE and POP_BLOCK by label from FOR_ITER
-    pop_block_label = instr[1]
-    for rel_index in orig_xrange(index + 1, len(code) - 1):
-        if code[rel_index][0] is pop_block_label:
-            pop_block_index = rel_index + 1
-            break
-    else:
-        return 0
-    if not (code[pop_block_index - 2][0] == byteplay.JUMP_ABSOLUTE and
-            code[pop_block_index - 2][1] is code[index - 1][0] and
-            code[pop_block_index][0] == byteplay.POP_BLOCK):
-        return 0
-    # It's important to check POP_BLOCK instruction existence to
-    # distinguish real for-loops from list comprehensions
-
-    # Try to find marker of current line's number
-    for rel_index in orig_xrange(setup_index - 1, -1, -1):
-        if code[rel_index][0] == byteplay.SetLineno:
-            head_lineno = code[rel_index][1]
-            break
-    else:
-        head_lineno = None
+def find_loops(code):
+    # Find for-loops in one pass. Returns a list of tuples with indexes
+    # of FOR_ITER and POP_BLOCK instructions and a number of the line
+    # where the loop starts.
+
+    label_indexes = {}
+    for index, (oper, arg) in enumerate(code):
+        if isinstance(oper, byteplay.Label):
+            label_indexes[oper] = index
+
+    loops = []
+    lineno = None
+    setup_found = False
+    for index, (oper, arg) in enumerate(code):
+        if oper == byteplay.SetLineno:
+            lineno = arg
+        elif oper == byteplay.SETUP_LOOP:
+            setup_found = True
+            head_lineno = lineno
+        elif (oper == byteplay.FOR_ITER and setup_found and
+              index >= 3 and code[index - 2][0] == byteplay.GET_ITER):
+            # Check JUMP_ABSOLUTE and POP_BLOCK after the label from
+            # FOR_ITER. It's important to check POP_BLOCK instruction
+            # existence to distinguish real for-loops from list
+            # comprehensions.
+            pop_block_index = label_indexes.get(arg, -1) + 1
+            if (index + 2 < pop_block_index < len(code) and
+                    code[pop_block_index - 2][0] == byteplay.JUMP_ABSOLUTE and
+                    code[pop_block_index - 2][1] is code[index - 1][0] and
+                    code[pop_block_index][0] == byteplay.POP_BLOCK):
+                loops.append((index, pop_block_index, head_lineno))
+    return loops
+
+
+def apply_insertions(code, insertions):
+    # Insert lists of instructions at the specified positions (in the
+    # original code) in one pass
+    insertions.sort(key=lambda item: item[0])
+    new_code = []
+    prev_position = 0
+    for position, instrs in insertions:
+        new_code += code[prev_position:position]
+        new_code += instrs
+        prev_position = position
+    new_code += code[prev_position:]
+    code[:] = new_code
+
+
+def analyze_loop(settings, code, loop):
+    # Returns a list of insertions (pairs of a position in the code and
+    # a list of instructions) that optimize the loop. The list is empty
+    # if the loop can't be optimized.
+
+    index, pop_block_index, head_lineno = loop
+    pop_block_label = code[index][1]
 
     body = code[index + 1:pop_block_index - 2]
     # Don't forget that "else_body" loop part also exists
 
+    if any(oper == byteplay.YIELD_VALUE for oper, arg in body):
+        # Loops of generators that yield values on iterations can't be
+        # executed at once, so they aren't considered as errors
+        if settings['verbose']:
+            settings['logger'].debug(
+                'Loop at line %s yields values and is skipped', head_lineno)
+        entry = report.make_entry(settings, report.SKIPPED, head_lineno)
+        entry['category'] = 'generator'
+        entry['reason'] = 'Loop yields values'
+        settings['report'].append(entry)
+        return []
+
     settings['head_lineno'] = head_lineno
+    # Jumps to this label inside the loop's body start the next iteration
+    settings['head_label'] = code[index - 1][0]
+    if settings['opt_dead_vars']:
+        # Find variables which values are needed after the loop (the
+        # loop is finished at the label before POP_BLOCK instruction).
+        # The analysis is made once for all loops of the code.
+        if settings['live_in'] is None:
+            settings['live_in'] = liveness.find_live_in(code)
+        live_in = settings['live_in']
+        if live_in is liveness.ALL_LIVE:
+            settings['live_vars'] = None
+        else:
+            settings['live_vars'] = set(live_in[pop_block_index - 1])
+    else:
+        settings['live_vars'] = None
+    if settings['gf2_width'] is not None:
+        recompile_body = gf2.recompile_body
+    elif settings['semiring'] is not None:
+        recompile_body = semirings.recompile_body
+    else:
+        recompile_body = recompiler.recompile_body
     try:
-        state = recompiler.recompile_body(settings, body)
+        state = recompile_body(settings, body)
     except recompiler.RecompilationError as err:
         if settings['verbose']:
             settings['logger'].debug(err)
-        if settings['strict']:
+        settings['report'].append(report.make_entry(
+            settings, report.FAILED, head_lineno, error=err))
+        # Loops nested in an optimized loop are executed only if the
+        # optimization is skipped in the run-time (inner loops with
+        # constant ranges are unrolled), so their errors aren't reported
+        if settings['strict'] and settings['outer_loop_end'] is None:
             raise
-        return 0
+        return []
+    if settings['outer_loop_end'] is None:
+        settings['outer_loop_end'] = pop_block_index
+
+    # Simplify the matcode before it's saved in the head hook
+    unoptimized_size = peephole.matcode_size(state.content)
+    state.content[:] = peephole.optimize_matcode(state.content)
+    state.matcode_sizes = (unoptimized_size,
+                           peephole.matcode_size(state.content))
+    if settings['verbose']:
+        settings['logger'].debug('Matcode was simplified from %s to %s '
+                                 'operations' % state.matcode_sizes)
+    settings['report'].append(report.make_entry(
+        settings, report.OPTIMIZED, head_lineno, state=state))
+
+    if settings['cache_size']:
+        state.cache = cache.ResultCache(settings['cache_size'], head_lineno)
+        settings['caches'].append(state.cache)
+    else:
+        state.cache = None
 
     # Insert head_handler right before GET_ITER instruction
-    head_hook = hook.create_head_hook(state, pop_block_label)
-    code[index - 2:index - 2] = head_hook
+    insertions = [(index - 2, hook.create_head_hook(state, pop_block_label))]
+    insertions += hook.rewrite_iterable_call(code, index - 2)
 
     if settings['verbose']:
         settings['logger'].debug('Recompilation successful')
-
-    # Return length of analyzed code
-    return len(head_hook)
+    return insertions
 
 
 def patch_copied_func(func, new_code):
@@ -86,66 +174,272 @@ def patch_copied_func(func, new_code):
                         argdefs=func.func_defaults, closure=func.func_closure)
 
 
+# Maximal number of asynchronous calls running at the same time (other
+# calls wait in the queue of the shared pool)
+MAX_ASYNC_CALLS = 16
+
+_async_pool = None
+_async_pool_lock = threading.Lock()
+
+
+def get_async_pool():
+    global _async_pool
+    with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = futures.ThreadPoolExecutor(MAX_ASYNC_CALLS)
+        return _async_pool
+
+
+def add_async_call(func, executor):
+    # Add a method that runs the function and returns
+    # a `concurrent.futures.Future` object. The matrix exponentiation
+    # releases the calling thread only if it's passed to an executor, so
+    # the function is run in a shared pool of threads only if `executor`
+    # option is set (otherwise it's called in the current thread).
+
+    def async_call(*args, **kwargs):
+        if futures is None:
+            raise RuntimeError('"futures" package is required for '
+                               'asynchronous calls')
+        if executor is not None:
+            return get_async_pool().submit(func, *args, **kwargs)
+
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as err:
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+        return future
+
+    func.async_call = async_call
+    return func
+
+
 def remove_excess_line_numbers(code):
     # CPython < 2.7 and PyPy add excess SetLineno instructions in some places.
     # This breaks search of loops.
 
-    excess_instructions_indexes = []
+    new_code = []
     cur_line_number = None
-    for index, instr in enumerate(code):
+    for instr in code:
         if instr[0] == byteplay.SetLineno:
             new_line_number = instr[1]
             if cur_line_number == new_line_number:
-                excess_instructions_indexes.append(index)
-            else:
-                cur_line_number = new_line_number
+                continue
+            cur_line_number = new_line_number
+        new_code.append(instr)
+    code[:] = new_code
+
+
+def replace_consts(code, consts):
+    return CodeType(code.co_argcount, code.co_nlocals, code.co_stacksize,
+                    code.co_flags, code.co_code, consts, code.co_names,
+                    code.co_varnames, code.co_filename, code.co_name,
+                    code.co_firstlineno, code.co_lnotab, code.co_freevars,
+                    code.co_cellvars)
+
+
+LOOP_OPCODES = frozenset([dis.opmap['SETUP_LOOP'], dis.opmap['FOR_ITER']])
+
+
+def may_contain_loops(func_code):
+    # Quickly check whether the raw bytecode contains instructions of
+    # for-loops, so byteplay isn't used for code objects without them
+    found = set()
+    co_code = func_code.co_code
+    index = 0
+    while index < len(co_code):
+        oper = ord(co_code[index])
+        if oper in LOOP_OPCODES:
+            found.add(oper)
+            if len(found) == len(LOOP_OPCODES):
+                return True
+        index += 3 if oper >= dis.HAVE_ARGUMENT else 1
+    return False
+
+
+def upgrade_code(params, func_code, caches, loops_report, recursive=False,
+                 func_globals=None):
+    # Returns a code object with optimized loops. Entries about all
+    # analyzed loops are added to `loops_report` list. If no loop was
+    # optimized, the original code object is returned. Globals of the
+    # decorated function (if they are known) help to find out which pure
+    # functions are called in the loops.
+
+    if recursive:
+        consts = tuple(
+            upgrade_code(params, const, caches, loops_report, recursive,
+                         func_globals)
+            if isinstance(const, CodeType) else const
+            for const in func_code.co_consts)
+        if any(new is not old
+               for new, old in zip(consts, func_code.co_consts)):
+            func_code = replace_consts(func_code, consts)
+
+    if not may_contain_loops(func_code):
+        return func_code
+
+    settings = params.copy()
+    settings['caches'] = caches
+    settings['report'] = loops_report
+    settings['code_name'] = func_code.co_name
+    settings['code_filename'] = func_code.co_filename
+    settings['function_info'] = '%s, file "%s"' % (func_code.co_name,
+                                                   func_code.co_filename)
+    settings['pure_names'] = hook.pure_func_names(settings['pure_funcs'])
+    settings['func_globals'] = func_globals
+
+    if settings['verbose']:
+        settings['logger'] = logging.LoggerAdapter(
+            logging.getLogger(__name__),
+            {'function_info': settings['function_info']})
+
+    internals = byteplay.Code.from_code(func_code)
+    code = internals.code
 
-    for offset, index in enumerate(excess_instructions_indexes):
-        index -= offset
-        code[index:index + 1] = []
+    remove_excess_line_numbers(code)
+
+    # The code isn't changed until all loops are analyzed, so indexes
+    # found by `find_loops` stay valid
+    settings['outer_loop_end'] = None
+    settings['live_in'] = None
+    insertions = []
+    for loop in find_loops(code):
+        if (settings['outer_loop_end'] is not None and
+                loop[0] > settings['outer_loop_end']):
+            settings['outer_loop_end'] = None
+        insertions += analyze_loop(settings, code, loop)
+
+    if not insertions:
+        return func_code
+    apply_insertions(code, insertions)
+    return internals.to_code()
 
 
 DEFAULT_TYPES = (int, long)
 DEFAULT_ITERS_LIMIT = 5000
 MIN_ITERS_LIMIT = 2
+DEFAULT_EXECUTOR_THRESHOLD = 10 ** 7
+DEFAULT_MAX_DEGREE = 3
 
 
 def cpmoptimize(strict=True, iters_limit=DEFAULT_ITERS_LIMIT, types=DEFAULT_TYPES,
-                opt_min_rows=True, opt_clear_stack=True,
-                verbose=False):
+                opt_min_rows=True, opt_clear_stack=True, opt_dead_vars=True,
+                executor=None, executor_threshold=DEFAULT_EXECUTOR_THRESHOLD,
+                cache_size=0, max_degree=DEFAULT_MAX_DEGREE, pure_funcs=(),
+                gf2_width=None, semiring=None, verbose=False):
     if not isinstance(strict, bool):
         raise TypeError('`strict` argument must be of type bool. '
                         'Please write "@cpmoptimize()" instead of "@cpmoptimize".')
+    if executor is not None and not hasattr(executor, 'submit'):
+        raise TypeError('`executor` argument must have method "submit" '
+                        '(like `concurrent.futures.Executor` objects)')
+    if gf2_width is not None and not (
+        isinstance(gf2_width, (int, long)) and gf2_width > 0
+    ):
+        raise ValueError('`gf2_width` argument must be a positive integer '
+                         '(width of words in loops over GF(2))')
+    if semiring is not None and (
+        semiring not in matrices.SEMIRINGS or
+        semiring == matrices.ARITHMETIC.name
+    ):
+        raise ValueError('`semiring` argument must be one of: %s' % ', '.join(
+            sorted(name for name in matrices.SEMIRINGS
+                   if name != matrices.ARITHMETIC.name)))
+    if semiring is not None and gf2_width is not None:
+        raise ValueError('`semiring` and `gf2_width` arguments '
+                         "can't be used together")
     iters_limit = max(iters_limit, MIN_ITERS_LIMIT)
+    # Functions which calls can be folded besides the functions marked
+    # with `cpm_pure`
+    pure_funcs = frozenset(pure_funcs)
+    # Option `opt_clear_stack` is left for compatibility. Stack slots
+    # don't occupy rows of matrices anymore, so there is nothing to clear.
     params = locals()
 
     def upgrade_func(func):
-        settings = params.copy()
-
-        func_code = func.func_code
-        settings['function_info'] = '%s, file "%s"' % (func_code.co_name,
-                                                       func_code.co_filename)
-
-        if settings['verbose']:
-            settings['logger'] = logging.LoggerAdapter(
-                logging.getLogger(__name__),
-                {'function_info': settings['function_info']})
-
-        internals = byteplay.Code.from_code(func_code)
-        code = internals.code
+        if isinstance(func, (type, ClassType)):
+            return upgrade_class(func)
+        if isinstance(func, (staticmethod, classmethod)):
+            new_func = upgrade_func(func.__func__)
+            if new_func is func.__func__:
+                return func
+            return type(func)(new_func)
+
+        caches = []
+        loops_report = []
+        new_code = upgrade_code(params, func.func_code, caches, loops_report,
+                                recursive=True, func_globals=func.func_globals)
+        if new_code is func.func_code:
+            # No loop was optimized, so the code is left untouched (but
+            # the function still gets the methods below)
+            new_func = func
+        else:
+            new_func = patch_copied_func(func, new_code)
+        add_async_call(new_func, executor)
+        new_func.report = lambda: [dict(entry) for entry in loops_report]
+        new_func.cache_info = lambda: [elem.info() for elem in caches]
+
+        def cache_clear():
+            for elem in caches:
+                elem.clear()
+        new_func.cache_clear = cache_clear
+        # The report is dropped when the function is garbage collected
+        # (e.g. functions decorated in closures)
+        report.register_report(loops_report, new_func)
+        return new_func
+
+    def upgrade_class(cls):
+        # Optimize all methods defined in the class (including static
+        # methods and class methods)
+        for name, value in cls.__dict__.items():
+            if isinstance(value, (FunctionType, staticmethod, classmethod)):
+                new_value = upgrade_func(value)
+                if new_value is not value:
+                    setattr(cls, name, new_value)
+        return cls
+
+    def upgrade_module_code(module_code):
+        # Optimize loops in the module's body and all nested code objects
+        # (functions, classes, methods)
+        loops_report = []
+        new_code = upgrade_code(params, module_code, [], loops_report,
+                                recursive=True)
+        report.register_report(loops_report)
+        return new_code, loops_report
+    upgrade_func.upgrade_module_code = upgrade_module_code
 
-        remove_excess_line_numbers(code)
+    return upgrade_func
 
-        index = 0
-        while index < len(code):
-            index += analyze_loop(settings, code, index) + 1
 
-        return patch_copied_func(func, internals.to_code())
+def install_import_hook(prefixes, **options):
+    # Optimize loops in all source modules imported later which names
+    # start with one of the prefixes (e.g. "mypackage" matches
+    # "mypackage" and "mypackage.utils"). Options are the same as in
+    # `cpmoptimize`, but loops that can't be optimized are skipped by
+    # default. Returns an importer that has `changes` attribute (report
+    # entries about optimized loops of every module) and
+    # `uninstall` method.
 
-    return upgrade_func
+    options.setdefault('strict', False)
+    upgrade_func = cpmoptimize(**options)
+    result = importer.OptimizingImporter(
+        prefixes, upgrade_func.upgrade_module_code)
+    result.install()
+    return result
 
 
 RecompilationError = recompiler.RecompilationError
+get_report = report.get_report
+dump_report = report.dump_report
+clear_report = report.clear_report
+register_iterable_type = hook.register_iterable_type
+cpm_pure = hook.register_pure_func
 
 
-__all__ = ['cpmoptimize', 'xrange', 'RecompilationError']
+__all__ = ['cpmoptimize', 'xrange', 'RecompilationError', 'register_iterable_type',
+           'install_import_hook', 'get_report', 'dump_report', 'clear_report',
+           'cpm_pure']
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+
+
+def int_size(value):
+    # Number of bytes occupied by an integer (or by integers of a tuple,
+    # types in the keys are shared, so they aren't counted)
+    if isinstance(value, tuple):
+        return sum(int_size(elem) for elem in value)
+    if isinstance(value, type):
+        return 0
+    try:
+        return sys.getsizeof(value)
+    except (AttributeError, TypeError):
+        # sys.getsizeof() isn't supported in PyPy
+        return len('%x' % abs(value)) // 2 + 1
+
+
+def make_key(values):
+    # Values that are equal but have different types (like 1, 1.0 and
+    # True) may give different results, so types are included in the key
+    return tuple((type(value), make_key(value))
+                 if isinstance(value, tuple) else (type(value), value)
+                 for value in values)
+
+
+class _Entry(object):
+    __slots__ = ('key', 'value', 'size', 'prev', 'next')
+
+
+class ResultCache(object):
+    # LRU cache of results of optimized loop executions. Its size is
+    # measured in bytes of integers stored in the keys and the values.
+    # Entries are kept in a doubly linked list from the least recently
+    # used to the most recently used one.
+
+    def __init__(self, max_size, lineno):
+        self._max_size = max_size
+        self._lineno = lineno
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._head = _Entry()
+        self._head.prev = self._head.next = self._head
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _link_last(self, entry):
+        entry.prev = self._head.prev
+        entry.next = self._head
+        self._head.prev.next = entry
+        self._head.prev = entry
+
+    def get(self, key):
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._unlink(entry)
+            self._link_last(entry)
+            return entry.value
+
+    def put(self, key, value):
+        size = int_size(key) + int_size(value)
+        if size > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            while self._size + size > self._max_size:
+                oldest = self._head.next
+                self._unlink(oldest)
+                del self._entries[oldest.key]
+                self._size -= oldest.size
+
+            entry = _Entry()
+            entry.key, entry.value, entry.size = key, value, size
+            self._link_last(entry)
+            self._entries[key] = entry
+            self._size += size
+
+    def info(self):
+        with self._lock:
+            return {
+                'lineno': self._lineno,
+                'hits': self._hits,
+                'misses': self._misses,
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self._max_size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._head.prev = self._head.next = self._head
+            self._size = 0
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import byteplay
+
+import recompiler
+from matcode import *
+from recompiler import RecompilationError, UnpredictableArgsError, \
+    coeff_lines, evaluate_known, is_folded, is_known_zero
+
+
+# Recompilation of loops which bodies are linear over GF(2) (e.g. steps
+# of xorshift generators and LFSRs). It's enabled by `gf2_width` option
+# that declares the width of the words stored in the variables. Every
+# variable is expanded to the bits, so XOR, bitwise NOT, shifts by known
+# amounts and bitwise AND with known masks become operations with bit
+# vectors (values must be masked to the width before they're stored,
+# e.g. "~a & 0xFF").
+# Bodies must not contain branches and the loop's counter.
+
+
+class BitForm(object):
+    # Value of a word in the loop's body. Bit "j" of the value is the XOR
+    # of the bits (that the mutable variables had at the beginning of the
+    # iteration) selected by the mask "bits[j]" and bit "j" of the
+    # constant term. Bits of the variable with index "k" have positions
+    # from "k * width" in the masks. The constant term is a number known
+    # during the recompilation or a list of instructions calculating it
+    # (it will be folded). Objects of this class are never modified after
+    # creation.
+
+    __slots__ = ('bits', 'const')
+
+    def __init__(self, bits, const):
+        bits = list(bits)
+        while bits and not bits[-1]:
+            bits.pop()
+        self.bits = tuple(bits)
+        self.const = const
+
+    @classmethod
+    def var(cls, index, width):
+        offset = index * width
+        return cls([1 << (offset + bit) for bit in xrange(width)], 0)
+
+    def is_const(self):
+        return not self.bits
+
+    def bit(self, index):
+        return self.bits[index] if index < len(self.bits) else 0
+
+    def support(self):
+        # Mask of the bits that can be set or None if it's unknown
+        if is_folded(self.const) or self.const < 0:
+            return None
+        res = self.const
+        for index, mask in enumerate(self.bits):
+            if mask:
+                res |= 1 << index
+        return res
+
+    def __eq__(self, other):
+        return (isinstance(other, BitForm) and
+                self.bits == other.bits and self.const == other.const)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def const_operation(instr, first, second):
+    # Combine constant terms by the binary instruction
+    known = evaluate_known(instr, first, second)
+    if known is not None:
+        return known[0]
+    return coeff_lines(first) + coeff_lines(second) + [instr]
+
+
+def xor_forms(instr, first, second):
+    bits = [first.bit(index) ^ second.bit(index)
+            for index in xrange(max(len(first.bits), len(second.bits)))]
+    if is_known_zero(first.const):
+        const = second.const
+    elif is_known_zero(second.const):
+        const = first.const
+    else:
+        const = const_operation(instr, first.const, second.const)
+    return BitForm(bits, const)
+
+
+class BitState(recompiler.RecompilerState):
+    # Values of the variables are tracked as bit forms instead of linear
+    # forms
+
+    def __init__(self, settings):
+        hints = {'period': None, 'lists': {}, 'inplace_lists': set()}
+        super(BitState, self).__init__(settings, hints)
+        self.width = settings['gf2_width']
+
+    def add_var(self, straight):
+        is_new = not self.is_mutable(straight)
+        arg = super(BitState, self).add_var(straight)
+        if is_new:
+            self._values[straight] = BitForm.var(arg[1], self.width)
+        return arg
+
+    def load_var(self, straight):
+        try:
+            return self._values[straight]
+        except KeyError:
+            # The variable isn't changed in the loop, so its value can
+            # be folded
+            load_oper = VARIABLE_OPERATION_MAP[straight[0]][0]
+            return BitForm((), [(load_oper, straight[1])])
+
+    def store_var(self, straight, value):
+        if not isinstance(value, BitForm):
+            raise RecompilationError((
+                'Unsupported value of variable "%s"'
+            ) % var_repr(straight), self, 'unsupported_value')
+        const = value.const
+        if len(value.bits) > self.width or (
+            not is_folded(const) and (const < 0 or const >> self.width)
+        ):
+            raise RecompilationError((
+                'Value of variable "%s" may not fit in %s bits (use a mask)'
+            ) % (var_repr(straight), self.width), self, 'unsupported_value')
+        self._values[straight] = value
+
+    def append_step(self):
+        args = []
+        for index, straight in enumerate(self._vars_storage):
+            form = self._values[straight]
+            if form == BitForm.var(index, self.width):
+                continue
+            args += [straight, (VALUE, form.bits), self.coeff_arg(form.const)]
+        if args:
+            self.append([XOR_STEP] + args)
+
+
+def known_amount(state, form):
+    # Shift amounts and masks applied to values changed in the loop must be
+    # known during the recompilation
+    if not (form.is_const() and not is_folded(form.const) and
+            isinstance(form.const, (int, long))):
+        raise RecompilationError((
+            'Shift amounts and masks of values changed in the loop must be '
+            'known during the recompilation'
+        ), state, 'unpredictable_operands')
+    return form.const
+
+
+def handle_const(state, instr):
+    # Operations that aren't linear over GF(2) are allowed only with
+    # constant operands
+    count = 1 if str(instr[0]).startswith('UNARY_') else 2
+    if len(state.stack) < count:
+        raise IndexError
+    forms = state.stack[-count:]
+    if not all(isinstance(form, BitForm) and form.is_const()
+               for form in forms):
+        raise UnpredictableArgsError
+    if count == 1:
+        known = evaluate_known(instr, forms[0].const)
+        const = (known[0] if known is not None
+                 else coeff_lines(forms[0].const) + [instr])
+    else:
+        const = const_operation(instr, forms[0].const, forms[1].const)
+    state.stack[-count:] = [BitForm((), const)]
+
+
+def handle_xor(state, instr):
+    first, second = state.stack[-2:]
+    state.stack[-2:] = [xor_forms(instr, first, second)]
+
+
+def handle_or(state, instr):
+    first, second = state.stack[-2:]
+    if first.is_const() and second.is_const():
+        handle_const(state, instr)
+        return
+    # OR of values without common bits is their XOR
+    first_support = first.support()
+    second_support = second.support()
+    if not (
+        first_support == 0 or second_support == 0 or
+        (first_support is not None and second_support is not None and
+         not first_support & second_support)
+    ):
+        raise RecompilationError((
+            'Operands of bitwise OR must not have common bits'
+        ), state, 'unpredictable_operands')
+    state.stack[-2:] = [xor_forms(instr, first, second)]
+
+
+def handle_and(state, instr):
+    first, second = state.stack[-2:]
+    if first.is_const() and second.is_const():
+        handle_const(state, instr)
+        return
+    if first.is_const():
+        first, second = second, first
+    mask = known_amount(state, second)
+    bits = [bit_mask if mask >> index & 1 else 0
+            for index, bit_mask in enumerate(first.bits)]
+    const = const_operation(instr, first.const, mask)
+    state.stack[-2:] = [BitForm(bits, const)]
+
+
+def handle_invert(state, instr):
+    # "~a" is "a ^ -1": every bit (including the infinite sign bits) is
+    # inverted, so only the constant term changes. The result is negative,
+    # so it must be masked before it's stored.
+    form = state.stack[-1]
+    known = evaluate_known(instr, form.const)
+    const = (known[0] if known is not None
+             else coeff_lines(form.const) + [instr])
+    state.stack[-1] = BitForm(form.bits, const)
+
+
+def handle_shift(state, instr):
+    first, second = state.stack[-2:]
+    if first.is_const():
+        handle_const(state, instr)
+        return
+    amount = known_amount(state, second)
+    if amount < 0:
+        raise RecompilationError('Negative shift count', state,
+                                 'unpredictable_operands')
+    if instr[0] in (byteplay.BINARY_LSHIFT, byteplay.INPLACE_LSHIFT):
+        bits = (0,) * amount + first.bits
+    else:
+        bits = first.bits[amount:]
+    const = const_operation(instr, first.const, amount)
+    state.stack[-2:] = [BitForm(bits, const)]
+
+
+def handle_load_const(state, instr):
+    arg = instr[1]
+    if isinstance(arg, tuple):
+        for elem in arg:
+            handle_load_const(state, (instr[0], elem))
+        recompiler.handle_build_tuple(state, (byteplay.BUILD_TUPLE, len(arg)))
+        return
+    if not isinstance(arg, (int, long)):
+        raise RecompilationError((
+            'Constant %s has an unallowed type %s instead of an integer'
+        ) % (repr(arg), type(arg)), state, 'unallowed_type')
+    state.stack.append(BitForm((), arg))
+
+
+def handle_load_var(state, instr):
+    oper, name = instr
+    straight = VARIABLE_TYPE_MAP[oper][0], name
+    state.stack.append(state.load_var(straight))
+
+
+def handle_store_var(state, instr):
+    oper, name = instr
+    straight = VARIABLE_TYPE_MAP[oper][0], name
+    state.store_var(straight, state.stack.pop())
+
+
+def handle_load_attr(state, instr):
+    # Attributes can't be stored in the loop, so their values are folded
+    form = state.stack[-1]
+    if not form.is_const():
+        raise UnpredictableArgsError
+    state.stack[-1] = BitForm((), coeff_lines(form.const) + [instr])
+
+
+LOAD_OPERATIONS, STORE_OPERATIONS = zip(*VARIABLE_OPERATION_MAP.values())
+BYTECODE_HANDLERS = [
+    (recompiler.handle_nop, [byteplay.NOP, byteplay.UNARY_POSITIVE]),
+    (recompiler.handle_pop_top, [byteplay.POP_TOP]),
+    (recompiler.create_rot(2), [byteplay.ROT_TWO]),
+    (recompiler.create_rot(3), [byteplay.ROT_THREE]),
+    (recompiler.create_rot(4), [byteplay.ROT_FOUR]),
+    (recompiler.create_dup(1), [byteplay.DUP_TOP]),
+    (recompiler.handle_dup_topx, [byteplay.DUP_TOPX]),
+    (recompiler.handle_build_tuple, [byteplay.BUILD_TUPLE]),
+    (recompiler.handle_unpack_sequence, [byteplay.UNPACK_SEQUENCE]),
+
+    (handle_xor, [byteplay.BINARY_XOR, byteplay.INPLACE_XOR]),
+    (handle_invert, [byteplay.UNARY_INVERT]),
+    (handle_or, [byteplay.BINARY_OR, byteplay.INPLACE_OR]),
+    (handle_and, [byteplay.BINARY_AND, byteplay.INPLACE_AND]),
+    (handle_shift, [
+        byteplay.BINARY_LSHIFT, byteplay.INPLACE_LSHIFT,
+        byteplay.BINARY_RSHIFT, byteplay.INPLACE_RSHIFT,
+    ]),
+    (handle_const, [
+        byteplay.UNARY_NEGATIVE, byteplay.UNARY_NOT,
+        byteplay.BINARY_POWER, byteplay.BINARY_MULTIPLY,
+        byteplay.BINARY_DIVIDE, byteplay.BINARY_FLOOR_DIVIDE,
+        byteplay.BINARY_TRUE_DIVIDE, byteplay.BINARY_MODULO,
+        byteplay.BINARY_ADD, byteplay.BINARY_SUBTRACT,
+        byteplay.INPLACE_POWER, byteplay.INPLACE_MULTIPLY,
+        byteplay.INPLACE_DIVIDE, byteplay.INPLACE_FLOOR_DIVIDE,
+        byteplay.INPLACE_TRUE_DIVIDE, byteplay.INPLACE_MODULO,
+        byteplay.INPLACE_ADD, byteplay.INPLACE_SUBTRACT,
+    ]),
+
+    (handle_load_const, [byteplay.LOAD_CONST]),
+    (handle_load_var, LOAD_OPERATIONS),
+    (handle_store_var, STORE_OPERATIONS),
+    (handle_load_attr, [byteplay.LOAD_ATTR]),
+]
+
+SUPPORTED_OPERATIONS = {}
+for handler, opers in BYTECODE_HANDLERS:
+    for oper in opers:
+        SUPPORTED_OPERATIONS[oper] = handler
+
+
+def walk_body(state, body):
+    for instr in body:
+        oper = instr[0]
+        if isinstance(oper, byteplay.Label):
+            continue
+        if oper == byteplay.SetLineno:
+            state.lineno = instr[1]
+            continue
+        state.instr = instr
+        try:
+            handler = SUPPORTED_OPERATIONS[oper]
+        except KeyError:
+            raise RecompilationError((
+                'Unsupported instruction %s in a loop over GF(2)'
+            ) % repr(instr), state, 'unsupported_instruction')
+        try:
+            handler(state, instr)
+        except UnpredictableArgsError:
+            raise recompiler.unpredictable_args_error(state, instr)
+        except IndexError:
+            raise RecompilationError('Unsupported loop type or invalid stack usage in bytecode',
+                                     state, 'unsupported_instruction')
+    state.instr = None
+
+
+def recompile_body(settings, body):
+    state = BitState(settings)
+
+    elem_straight, counter_status, rem_body = recompiler.browse_counter(
+        state, body,
+    )
+    state.counter_status = counter_status
+    if counter_status != 'n':
+        raise RecompilationError((
+            "Loop's counter can't be used in a loop over GF(2)"
+        ), state, 'unsupported_value')
+    state.manual_store_counter = elem_straight
+
+    recompiler.browse_vars(state, rem_body)
+    state.append(
+        [LOOP, (PARAM, 'iters_count')],
+    )
+    walk_body(state, rem_body)
+    state.append_step()
+    state.append(
+        [END],
+    )
+
+    if settings['opt_dead_vars'] and not state.is_live(elem_straight):
+        state.manual_store_counter = None
+    return state
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import __builtin__
+import operator
 import sys
+from itertools import count, imap, izip, repeat
 
 import byteplay
 
 import run
+from cache import make_key
 from matcode import *
 
 
@@ -78,25 +82,309 @@ class CPMRange(object):
         return CPMRange(self._stop - self._step, self._start - self._step, -self._step)
 
 
-def check_iterable(settings, iterable):
-    if not isinstance(iterable, (xrange, CPMRange)):
+def get_xrange_progression(iterable, iters_count):
+    start = iterable[0]
+    return start, iterable[1] - start, iterable[-1]
+
+
+def get_sequence_progression(iterable, iters_count):
+    # Lists and tuples (e.g. results of "range" made outside of the loop's
+    # header) are accepted if their values form an arithmetic progression
+    # of integers. The values are checked without the Python interpreter
+    # loop, so it's much faster than running the loop.
+    start = iterable[0]
+    last = iterable[-1]
+    if not (isinstance(start, (int, long)) and isinstance(last, (int, long))):
+        raise TypeError('Values of the iterable must be integers')
+    step = iterable[1] - start
+    if not all(imap(operator.eq, iterable, count(start, step))):
+        raise TypeError("Values of the iterable don't form an arithmetic "
+                        "progression")
+    return start, step, last
+
+
+class RepeatedValue(object):
+    # Replacement for `itertools.repeat` with the specified number of
+    # repetitions (see `substitute_iterable_func`). Unlike the original,
+    # it can be inspected without the iteration.
+
+    def __init__(self, value, times):
+        self.value = value
+        self.times = max(times, 0)
+
+    def __iter__(self):
+        return repeat(self.value, self.times)
+
+    def __repr__(self):
+        return 'repeat(%r, %s)' % (self.value, self.times)
+
+
+def get_repeated_value_progression(iterable, iters_count):
+    return iterable.value, 0, iterable.value
+
+
+# Map from a type of the loop's iterable to a pair of functions. The
+# first one returns a number of iterations, the second one gets the
+# iterable and the number of iterations (more than 1) and returns a
+# tuple (start, step, last) describing the arithmetic progression of
+# the values. The functions raise TypeError if the iterable isn't
+# supported.
+ITERABLE_TYPES = {}
+
+
+def register_iterable_type(iterable_type, get_length, get_progression):
+    ITERABLE_TYPES[iterable_type] = get_length, get_progression
+
+
+register_iterable_type(xrange, len, get_xrange_progression)
+# len() doesn't support lengths that don't fit in a machine word
+register_iterable_type(CPMRange, CPMRange.__len__, get_xrange_progression)
+register_iterable_type(list, len, get_sequence_progression)
+register_iterable_type(tuple, len, get_sequence_progression)
+register_iterable_type(RepeatedValue, lambda iterable: iterable.times,
+                       get_repeated_value_progression)
+
+
+def check_iterable(settings, iterable, counter_used):
+    try:
+        get_length, get_progression = ITERABLE_TYPES[type(iterable)]
+    except KeyError:
         raise TypeError(
-            'Iterator has type `%s` instead of type `xrange`. '
-            'Please use `xrange` instead of `range`.' % type(iterable))
+            'Iterator has type `%s` instead of one of supported types: %s' %
+            (type(iterable), ', '.join(sorted(
+                elem.__name__ for elem in ITERABLE_TYPES))))
 
-    iters_count = iterable.__len__()
+    iters_count = get_length(iterable)
     if iters_count <= settings['iters_limit']:
         if settings['verbose']:
             settings['logger'].debug("Execution of %s iterations wasn't "
                                      "optimized" % iters_count)
         return None
 
-    start = iterable[0]
-    step = iterable[1] - start
-    last = iterable[-1]
+    start, step, last = get_progression(iterable, iters_count)
+    if counter_used and not isinstance(start, (int, long)):
+        raise TypeError('Values of the iterable must be integers')
     return start, step, iters_count, last
 
 
+def is_short_iterable(iterable, iters_limit):
+    # Cheap check made before the loop's variables and folded constants
+    # are loaded. If it fails or the iterable has an unknown type, the
+    # complete check is made by `check_iterable`.
+    try:
+        get_length = ITERABLE_TYPES[type(iterable)][0]
+        return get_length(iterable) <= iters_limit
+    except Exception:
+        return False
+
+
+def make_range(*args):
+    try:
+        return xrange(*args)
+    except OverflowError:
+        return CPMRange(*args)
+
+
+def reverse_sequence(*args):
+    if len(args) == 1 and isinstance(args[0], xrange):
+        # A reversed iterator of xrange can't be inspected, so we make
+        # another xrange with the same values
+        seq = args[0]
+        if len(seq) <= 1:
+            return seq
+        step = seq[1] - seq[0]
+        return make_range(seq[-1], seq[0] - step, -step)
+    return reversed(*args)
+
+
+def repeat_value(*args, **kwargs):
+    if len(args) == 2 and not kwargs and isinstance(args[1], (int, long)):
+        return RepeatedValue(*args)
+    return repeat(*args, **kwargs)
+
+
+# Builtins which results are replaced in the loop's header. A list made
+# by "range" is never accessible in the loop, so "xrange" can be used
+# instead of it.
+ITERABLE_FUNC_SUBSTITUTES = [
+    (range, make_range),
+    (reversed, reverse_sequence),
+    (repeat, repeat_value),
+]
+
+
+def substitute_iterable_func(func):
+    for orig, substitute in ITERABLE_FUNC_SUBSTITUTES:
+        if func is orig:
+            return substitute
+    return func
+
+
+def substitute_reversed_func(outer_func, func):
+    # A list made by "range" in "reversed(range(...))" isn't accessible
+    # in the loop too, so "xrange" can be used instead of it
+    if outer_func is reverse_sequence and func is range:
+        return make_range
+    return func
+
+
+# Functions which results depend only on values of their arguments (and
+# which don't change the arguments). Their calls with arguments that
+# aren't changed in the loop are folded, so they are made once before
+# the optimized loop.
+PURE_FUNCS = set()
+
+
+def register_pure_func(func):
+    # Can be used as a decorator
+    PURE_FUNCS.add(func)
+    return func
+
+
+for func in (abs, len, max, min, pow, int, long):
+    register_pure_func(func)
+
+
+def pure_func_names(pure_funcs):
+    # Names that may refer to pure functions in the code (they are used
+    # if the callee can't be found during the recompilation, see
+    # `may_be_pure_callee`)
+    return frozenset(func.__name__ for func in PURE_FUNCS.union(pure_funcs)
+                     if hasattr(func, '__name__'))
+
+
+def is_pure_func(settings, func):
+    try:
+        return func in PURE_FUNCS or func in settings['pure_funcs']
+    except TypeError:  # If the object is unhashable
+        return False
+
+
+def get_callee_value(straight, globals_dict, locals_dict):
+    try:
+        return get_var_value(straight, globals_dict, locals_dict)
+    except KeyError:
+        if straight[0] not in (NAME, GLOBAL):
+            raise
+        return getattr(__builtin__, straight[1])
+
+
+def resolve_callee(settings, straight):
+    # Returns the function that a global variable refers to during the
+    # recompilation. Raises KeyError if it can't be found.
+    globals_dict = settings['func_globals']
+    if straight[0] != GLOBAL or globals_dict is None:
+        raise KeyError(straight[1])
+    try:
+        return get_callee_value(straight, globals_dict, {})
+    except AttributeError:
+        raise KeyError(straight[1])
+
+
+def may_be_pure_callee(settings, straight):
+    # Whether calls of the function can be folded. Global functions are
+    # checked by the objects they refer to during the recompilation (a
+    # global function may shadow a builtin), other functions can be
+    # matched only by names. Local variables aren't known until the
+    # run-time and may shadow pure functions, so their calls are never
+    # folded. All callees are checked again by `check_pure_callees`.
+
+    arg_type = straight[0]
+    if arg_type in (FAST, DEREF):
+        return False
+    try:
+        return is_pure_func(settings, resolve_callee(settings, straight))
+    except KeyError:
+        # The function may be defined after the decoration
+        pass
+    if arg_type == ATTR:
+        name = straight[1][1][-1]
+    else:
+        name = straight[1]
+    return name in settings['pure_names']
+
+
+def check_pure_callees(settings, pure_callees, globals_dict, locals_dict):
+    # Calls of the functions were folded during the recompilation, so the
+    # optimization is correct only if they are really pure. Callees are
+    # pairs of a straight reference and the function that the variable
+    # must refer to (None if any pure function is allowed).
+    for straight, expected in pure_callees:
+        try:
+            func = get_callee_value(straight, globals_dict, locals_dict)
+        except (KeyError, AttributeError):
+            func = None
+        if expected is not None:
+            if func is not expected:
+                raise TypeError('Function "%s" called in the loop is not '
+                                'the builtin "%s"' % (var_repr(straight),
+                                                      expected.__name__))
+        elif func is None or not is_pure_func(settings, func):
+            raise TypeError('Function "%s" called in the loop is not '
+                            'declared pure' % var_repr(straight))
+
+
+def find_callee_push(code, call_index):
+    # Returns an index of the instruction pushing the function object for
+    # the call or None if it can't be found
+    oper, arg = code[call_index]
+    if oper != byteplay.CALL_FUNCTION:
+        return None
+    # Find an instruction pushing the function object (it's followed by
+    # instructions pushing positional and keyword arguments)
+    needed = (arg & 0xFF) + 2 * (arg >> 8)
+    index = call_index - 1
+    while index >= 0:
+        oper, arg = code[index]
+        if oper != byteplay.SetLineno:
+            try:
+                pop, push = byteplay.getse(oper, arg)
+            except ValueError:
+                # Labels and jumps aren't supported
+                return None
+            if needed < push:
+                if needed:
+                    return None
+                break
+            needed += pop - push
+        index -= 1
+    else:
+        return None
+    return index
+
+
+def rewrite_iterable_call(code, get_iter_index):
+    # If the loop's iterable is made by a function call, a call of
+    # `substitute_iterable_func` for the function object must be inserted.
+    # Returns a list of pairs of positions and instructions to insert.
+
+    call_index = get_iter_index - 1
+    index = find_callee_push(code, call_index)
+    if index is None:
+        return []
+    insertions = [(index + 1, [
+        (byteplay.LOAD_CONST, substitute_iterable_func),
+        (byteplay.ROT_TWO, None),
+        (byteplay.CALL_FUNCTION, 1),
+    ])]
+
+    # If the only argument is made by another call (as in
+    # "reversed(range(n))"), the inner function object is passed to
+    # `substitute_reversed_func` with the outer one
+    if code[call_index][1] == 1:
+        inner_index = find_callee_push(code, call_index - 1)
+        if inner_index is not None:
+            insertions.append((inner_index + 1, [
+                (byteplay.DUP_TOPX, 2),
+                (byteplay.LOAD_CONST, substitute_reversed_func),
+                (byteplay.ROT_THREE, None),
+                (byteplay.CALL_FUNCTION, 2),
+                (byteplay.ROT_TWO, None),
+                (byteplay.POP_TOP, None),
+            ]))
+    return insertions
+
+
 def get_var_space(straight, globals_dict, locals_dict):
     arg_type, name = straight
     if arg_type == NAME:
@@ -110,19 +398,51 @@ def get_var_space(straight, globals_dict, locals_dict):
     return None
 
 
+def get_var_value(straight, globals_dict, locals_dict):
+    arg_type = straight[0]
+    if arg_type == ATTR:
+        var_straight, attrs = straight[1]
+        value = get_var_value(var_straight, globals_dict, locals_dict)
+        for attr in attrs:
+            value = getattr(value, attr)
+        return value
+    if arg_type == ITEM:
+        var_straight, index, length = straight[1]
+        container = get_var_value(var_straight, globals_dict, locals_dict)
+        if length is None:
+            # The list is changed in place
+            if not (isinstance(container, list) and index < len(container)):
+                raise TypeError(
+                    'Variable "%s" must be a list with at least %s elements' %
+                    (var_repr(var_straight), index + 1))
+        elif not (isinstance(container, (list, tuple)) and
+                  len(container) == length):
+            # The list will be replaced in the loop. Its elements can be
+            # read before that, so they must be defined (the list is
+            # undefined only if the variable doesn't exist).
+            raise TypeError(
+                'Variable "%s" must be a list with %s elements' %
+                (var_repr(var_straight), length))
+        return container[index]
+
+    space = get_var_space(straight, globals_dict, locals_dict)
+    if space is None:
+        raise KeyError(straight[1])
+    return space[straight[1]]
+
+
 VAR_UNDEFINED_VALUE = 0
 
 
 def load_vars(settings, used_vars, globals_dict, locals_dict):
     vector = []
     for straight in used_vars:
-        space = get_var_space(straight, globals_dict, locals_dict)
-        name = straight[1]
+        name = var_repr(straight)
         try:
-            value = space[name]
+            value = get_var_value(straight, globals_dict, locals_dict)
             check_value = True
             vector.append(value)
-        except (TypeError, KeyError):
+        except (KeyError, AttributeError):
             check_value = False
             vector.append(VAR_UNDEFINED_VALUE)
 
@@ -133,10 +453,179 @@ def load_vars(settings, used_vars, globals_dict, locals_dict):
     return vector
 
 
+def check_aliases(iterable, used_vars, globals_dict, locals_dict):
+    # Attributes and elements of lists changed in the loop are identified
+    # by names of their owners, so the owners with different names must
+    # be different objects. The loop's iterable is read before the loop,
+    # so it must not be changed in place.
+    owners = {}
+    for straight in used_vars:
+        if straight[0] == ATTR:
+            var_straight, attrs = straight[1]
+            if len(attrs) > 1:
+                owner_straight = ATTR, (var_straight, attrs[:-1])
+            else:
+                owner_straight = var_straight
+            name = attrs[-1]
+        elif straight[0] == ITEM and straight[1][2] is None:
+            # The list is changed in place
+            owner_straight = straight[1][0]
+            name = None
+        else:
+            continue
+        try:
+            owner = get_var_value(owner_straight, globals_dict, locals_dict)
+        except (KeyError, AttributeError):
+            continue
+        key = id(owner), name
+        other_straight = owners.setdefault(key, owner_straight)
+        if other_straight != owner_straight:
+            raise TypeError('Variables "%s" and "%s" refer to the same '
+                            'object' % (var_repr(other_straight),
+                                        var_repr(owner_straight)))
+    iterated_straight = owners.get((id(iterable), None))
+    if iterated_straight is not None:
+        raise TypeError('List "%s" is changed in the loop over it' %
+                        var_repr(iterated_straight))
+
+
+def check_words(width, used_vars, vector):
+    # In loops over GF(2) all variables must contain words of the
+    # declared width
+    for straight, value in izip(used_vars, vector):
+        if value < 0 or value >> width:
+            raise TypeError('Variable "%s" must contain a non-negative '
+                            'integer of %s bits' % (var_repr(straight), width))
+
+
+def check_word_consts(width, matcode):
+    # Constant terms of "XOR_STEP" must be words of the width too
+    for instr in matcode:
+        if instr[0] != XOR_STEP:
+            continue
+        for index in xrange(3, len(instr), 3):
+            const = instr[index][1]
+            if not (isinstance(const, (int, long)) and 0 <= const and
+                    not const >> width):
+                raise TypeError('Constant %r used in the loop is not a '
+                                'non-negative integer of %s bits' %
+                                (const, width))
+
+
+def check_booleans(used_vars, vector):
+    for straight, value in izip(used_vars, vector):
+        if not isinstance(value, bool):
+            raise TypeError('Variable "%s" must contain a boolean in a loop '
+                            'over the boolean semiring' % var_repr(straight))
+
+
+def check_boolean_consts(matcode):
+    # Coefficients of "SEMIRING_STEP" must be booleans too
+    for instr in matcode:
+        if instr[0] != SEMIRING_STEP:
+            continue
+        for index in xrange(3, len(instr), 3):
+            coeff = instr[index][1]
+            if not isinstance(coeff, bool):
+                raise TypeError('Constant %r used in the loop over the '
+                                'boolean semiring is not a boolean' %
+                                (coeff,))
+
+
+def binomial(n, k):
+    res = 1
+    for index in xrange(k):
+        res = res * (n - index) // (index + 1)
+    return res
+
+
+def make_params(settings, start, step, iters_count):
+    params = {'start': start, 'step': step, 'iters_count': iters_count}
+    if not isinstance(start, (int, long)):
+        # The counter isn't used in the loop
+        return params
+    # Initial values of the counter powers and coefficients of their
+    # update (see `recompiler.append_lifted_update`)
+    for power in xrange(1, settings['max_degree'] + 1):
+        params['start', power] = start ** power
+        for lower in xrange(power):
+            params['shift', power, lower] = (
+                binomial(power, lower) * step ** (power - lower))
+    return params
+
+
+def make_folded_code(settings, folded_code):
+    # Make a code object evaluating the folded constant with dictionaries
+    # of the globals and the locals (values of local and free variables
+    # are taken from the latter). Returns the code object and names of
+    # the local variables.
+    fast_names = []
+    code_list = []
+    for oper, arg in folded_code:
+        if oper in (byteplay.LOAD_FAST, byteplay.LOAD_DEREF):
+            fast_names.append(arg)
+            oper = byteplay.LOAD_NAME
+        code_list.append((oper, arg))
+    code_list.append((byteplay.RETURN_VALUE, None))
+    code = byteplay.Code(
+        code_list, [], [], False, False, False, '<folded>',
+        settings['code_filename'], 0, None,
+    ).to_code()
+    return code, tuple(fast_names)
+
+
+class FoldedConsts(object):
+    # Values of the constants folded in the loop's body. A constant is
+    # evaluated only when the matcode refers to it in a block that will
+    # be executed (e.g. "100 // d" in "if d != 0" block isn't evaluated
+    # if "d" is zero).
+
+    def __init__(self, folded_codes, globals_dict, locals_dict):
+        self._folded_codes = folded_codes
+        self._globals = globals_dict
+        self._locals = locals_dict
+        self._values = {}
+
+    def __getitem__(self, index):
+        try:
+            return self._values[index]
+        except KeyError:
+            pass
+        code, fast_names = self._folded_codes[index]
+        for name in fast_names:
+            if name not in self._locals:
+                raise UnboundLocalError(
+                    "local variable '%s' referenced before assignment" % name)
+        value = eval(code, self._globals, self._locals)
+        self._values[index] = value
+        return value
+
+    def evaluated(self):
+        # Pairs of indexes and values of the evaluated constants
+        return tuple(sorted(self._values.iteritems()))
+
+
 def define_values(matcode, folded, params):
+    # Constants are evaluated only for instructions that will be executed,
+    # so conditions of the outer blocks are checked first
     new_matcode = []
+    # Stack of pairs of flags for nested conditional blocks: whether the
+    # outer block is executed and whether the condition is true
+    conditions = [(True, True)]
     for instr in matcode:
-        new_instr = [instr[0]]
+        oper = instr[0]
+        if oper == ELSE:
+            outer, cond = conditions[-1]
+            conditions[-1] = outer, not cond
+            continue
+        if oper == ENDIF:
+            conditions.pop()
+            continue
+        if not all(conditions[-1]):
+            if oper == IF:
+                conditions.append((False, False))
+            continue
+        new_instr = [oper]
         for index in xrange(1, len(instr)):
             arg = instr[index]
             arg_type, value = arg
@@ -147,25 +636,125 @@ def define_values(matcode, folded, params):
             else:
                 new_arg = arg
             new_instr.append(new_arg)
-        new_matcode.append(new_instr)
+
+        if oper == IF:
+            conditions.append((True, bool(new_instr[1][1])))
+        else:
+            new_matcode.append(new_instr)
+    return new_matcode
+
+
+def unroll_phases(matcode, start, step):
+    # Replace a loop containing a block of phases (see "matcode.py") with
+    # a loop over whole periods and the remaining iterations. Conditional
+    # blocks must be already resolved.
+
+    new_matcode = []
+    index = 0
+    while index < len(matcode):
+        instr = matcode[index]
+        if not (instr[0] == LOOP and matcode[index + 1][0] == PHASES):
+            new_matcode.append(instr)
+            index += 1
+            continue
+        iters_count = instr[1][1]
+        period = matcode[index + 1][1][1]
+
+        phases = [[]]
+        index += 2
+        while matcode[index][0] != END_PHASES:
+            if matcode[index][0] == NEXT_PHASE:
+                phases.append([])
+            else:
+                phases[-1].append(matcode[index])
+            index += 1
+        tail = []
+        index += 1
+        while matcode[index][0] != END:
+            tail.append(matcode[index])
+            index += 1
+        index += 1
+
+        # The counter value at the iteration with number "shift" is
+        # "start + step * shift"
+        sequence = []
+        for shift in xrange(period):
+            sequence += phases[(start + step * shift) % period] + tail
+        periods_count, rem_iters = divmod(iters_count, period)
+        new_matcode.append([LOOP, (VALUE, periods_count)])
+        new_matcode += sequence
+        new_matcode.append([END])
+        for shift in xrange(rem_iters):
+            new_matcode += phases[(start + step * shift) % period] + tail
     return new_matcode
 
 
-def exec_loop(iterable, settings, matcode, used_vars, real_vars_indexes,
-              need_store_counter, globals_dict, locals_dict, folded):
+def estimate_cost(vector_len, iters_count):
+    # A rough estimate of matrix exponentiation cost. Values of the
+    # variables usually grow linearly with the number of iterations, so
+    # the cost of the last multiplications is proportional to it.
+    return vector_len ** 3 * iters_count
+
+
+def run_matcode(settings, matcode, vector, iters_count):
+    executor = settings['executor']
+    if (
+        executor is None or
+        estimate_cost(len(vector), iters_count) < settings['executor_threshold']
+    ):
+        return run.run_matcode(settings, matcode, vector)
+
+    if settings['verbose']:
+        settings['logger'].debug('Execution of %s iterations was passed to '
+                                 'the executor' % iters_count)
+    # Settings may contain unpicklable objects (e.g. a logger), so we
+    # pass only the options necessary for running the matcode
+    run_settings = {
+        'opt_min_rows': settings['opt_min_rows'],
+        'gf2_width': settings['gf2_width'],
+        'semiring': settings['semiring'],
+    }
+    return executor.submit(
+        run.run_matcode, run_settings, matcode, vector,
+    ).result()
+
+
+def start_loop(iterable, settings, matcode, used_vars, counter_used,
+               pure_callees, folded_codes, globals_dict, locals_dict):
+    # Decide whether the loop will be optimized. Returns None if it won't,
+    # otherwise parameters of the range, a vector of the variables,
+    # folded constants and the matcode with defined values.
     try:
-        # Check whether an iterable has type "xrange" and the required
+        # Check whether an iterable has a supported type and the required
         # number of iterations
-        range_params = check_iterable(settings, iterable)
+        range_params = check_iterable(settings, iterable, counter_used)
         if range_params is None:  # If the number of iterations is too little
             return None
         start, step, iters_count, last = range_params
 
+        check_pure_callees(settings, pure_callees, globals_dict, locals_dict)
+
         # Load necessary variables, check their types and make a vector
         # for further operations with matrixes (including a unit row)
         vector = load_vars(
             settings, used_vars, globals_dict, locals_dict,
         ) + [1]
+        check_aliases(iterable, used_vars, globals_dict, locals_dict)
+        if settings['gf2_width'] is not None:
+            check_words(settings['gf2_width'], used_vars, vector)
+        if settings['semiring'] == 'boolean':
+            check_booleans(used_vars, vector)
+
+        # Folded constants are evaluated only after the checks above
+        # (and only if the matcode refers to them)
+        folded = FoldedConsts(folded_codes, globals_dict, locals_dict)
+        matcode = define_values(matcode, folded, make_params(
+            settings, start, step, iters_count,
+        ))
+        if settings['gf2_width'] is not None:
+            check_word_consts(settings['gf2_width'], matcode)
+        if settings['semiring'] == 'boolean':
+            check_boolean_consts(matcode)
     except TypeError as err:
         generic_err = TypeError("Can't run optimized loop: %s" % err)
         if settings['verbose']:
@@ -173,82 +762,173 @@ def exec_loop(iterable, settings, matcode, used_vars, real_vars_indexes,
         if settings['strict']:
             raise generic_err
         return None
+    return start, step, iters_count, last, vector, folded, matcode
 
-    # Define constant values in matrix code
-    matcode = define_values(matcode, folded, {
-        'start': start, 'step': step, 'iters_count': iters_count,
-    })
 
-    matcode.append([END])
+def exec_loop(loop_params, settings, packed_indexes, need_store_counter,
+              cache):
+    start, step, iters_count, last, vector, folded, matcode = loop_params
 
-    # Run matrix code
-    vector = run.run_matcode(settings, matcode, vector)
+    packed = None
+    if cache is not None:
+        cache_key = make_key(tuple(vector) + folded.evaluated() +
+                             (start, step, iters_count))
+        try:
+            packed = cache.get(cache_key)
+        except TypeError:  # If some values are unhashable
+            cache = None
+    if packed is not None:
+        if settings['verbose']:
+            settings['logger'].debug('Result of %s iterations was taken '
+                                     'from the cache' % iters_count)
+        packed = list(packed)
+    else:
+        matcode = unroll_phases(matcode, start, step)
+
+        matcode.append([END])
+
+        # Run matrix code
+        vector = run_matcode(settings, matcode, vector, iters_count)
+
+        if settings['verbose']:
+            settings['logger'].debug('Execution of %s iterations was optimized '
+                                     'successfully' % iters_count)
+
+        # Pack values of real variables to a list. It will be unpacked in
+        # a main function to values that will be assigned to the
+        # globals and the locals. We can't just modify `locals_dict`
+        # because locals() dictionary is read-only.
+        packed = [vector[index] for index in packed_indexes]
+        if cache is not None:
+            cache.put(cache_key, tuple(packed))
 
-    if settings['verbose']:
-        settings['logger'].debug('Execution of %s iterations was optimized '
-                                 'successfully' % iters_count)
-
-    # Pack values of real variables to a list. It will be unpacked in
-    # a main function to values that will be assigned to the
-    # globals and the locals. We can't just modify `locals_dict`
-    # because locals() dictionary is read-only.
-    packed = [vector[index] for index in real_vars_indexes]
     if need_store_counter:
         packed.append(last)
     return packed
 
 
+def load_code(straight):
+    # Make instructions that push a value of a variable
+    if straight[0] == ATTR:
+        var_straight, attrs = straight[1]
+        return load_code(var_straight) + [
+            (byteplay.LOAD_ATTR, attr) for attr in attrs
+        ]
+    return [(VARIABLE_OPERATION_MAP[straight[0]][0], straight[1])]
+
+
+def store_code(straight):
+    # Make instructions that store a value from the top of the stack
+    # to a variable
+    if straight[0] == ATTR:
+        var_straight, attrs = straight[1]
+        return load_code(var_straight) + [
+            (byteplay.LOAD_ATTR, attr) for attr in attrs[:-1]
+        ] + [
+            (byteplay.STORE_ATTR, attrs[-1]),
+        ]
+    if straight[0] == ITEM:
+        var_straight, index, length = straight[1]
+        return load_code(var_straight) + [
+            (byteplay.LOAD_CONST, index),
+            (byteplay.STORE_SUBSCR, None),
+        ]
+    return [(VARIABLE_OPERATION_MAP[straight[0]][1], straight[1])]
+
+
 def create_head_hook(state, loop_end_label):
     vars_storage = state.vars_storage
-    real_vars_indexes = state.real_vars_indexes
     manual_store_counter = state.manual_store_counter
 
-    unpacked_straight = []
-    for index in real_vars_indexes:
-        unpacked_straight.append(vars_storage[index])
+    # Indexes of the variables which values are packed by "exec_loop" and
+    # instructions that store the unpacked values
+    packed_indexes = []
+    store_content = []
+    replaced_lists = {}
+    for index in state.real_vars_indexes:
+        straight = vars_storage[index]
+        if straight[0] == ITEM and straight[1][2] is not None:
+            var_straight, elem_index, length = straight[1]
+            replaced_lists.setdefault(var_straight, {})[elem_index] = index
+            continue
+        packed_indexes.append(index)
+        store_content += store_code(straight)
+    aliases = dict((var_straight, (var_straight,))
+                   for var_straight in replaced_lists)
+    for group in state.list_aliases or []:
+        for var_straight in group:
+            aliases[var_straight] = group
+    saved_groups = set()
+    for var_straight, items in sorted(replaced_lists.items()):
+        group = aliases[var_straight]
+        if group in saved_groups:
+            continue
+        saved_groups.add(group)
+        # A new list is made of the elements. They are unpacked in
+        # reverse order, so BUILD_LIST gets them in the right order.
+        # Then the list is stored to all variables that share it.
+        for elem_index in xrange(len(items) - 1, -1, -1):
+            packed_indexes.append(items[elem_index])
+        store_content.append((byteplay.BUILD_LIST, len(items)))
+        for alias in group[:-1]:
+            store_content.append((byteplay.DUP_TOP, None))
+            store_content += store_code(alias)
+        store_content += store_code(group[-1])
+    packed_count = len(packed_indexes)
+    folded_codes = tuple(make_folded_code(state.settings, folded_code)
+                         for folded_code in state.consts)
     if manual_store_counter is not None:
-        unpacked_straight.append(manual_store_counter)
+        store_content += store_code(manual_store_counter)
+        packed_count += 1
+
+    # If the number of iterations is obviously too little, the
+    # optimization is skipped before calling globals() and locals()
+    # (which copies fast locals to a dictionary) and evaluating folded
+    # constants. In verbose mode, all checks are made by `start_loop`.
+    precheck_end_label = byteplay.Label()
+    if state.settings['verbose']:
+        content = []
+    else:
+        content = [
+            (byteplay.DUP_TOP, None),
+            (byteplay.LOAD_CONST, is_short_iterable),
+            (byteplay.ROT_TWO, None),
+            (byteplay.LOAD_CONST, state.settings['iters_limit']),
+            (byteplay.CALL_FUNCTION, 2),
+        ]
+        if PYTHON_VERSION < (2, 7):
+            content += [
+                (byteplay.JUMP_IF_TRUE, precheck_end_label),
+                (byteplay.POP_TOP, None),
+            ]
+        else:
+            content += [
+                (byteplay.POP_JUMP_IF_TRUE, precheck_end_label),
+            ]
 
-    content = [
+    content += [
         (byteplay.DUP_TOP, None),
-        (byteplay.LOAD_CONST, exec_loop),
+        (byteplay.LOAD_CONST, start_loop),
         (byteplay.ROT_TWO, None),
         (byteplay.LOAD_CONST, state.settings),
         (byteplay.LOAD_CONST, state.content),
         (byteplay.LOAD_CONST, vars_storage),
-        (byteplay.LOAD_CONST, real_vars_indexes),
-        (byteplay.LOAD_CONST, manual_store_counter is not None),
+        (byteplay.LOAD_CONST, state.counter_key is not None),
+        (byteplay.LOAD_CONST, tuple(state.pure_callees)),
+        (byteplay.LOAD_CONST, folded_codes),
         (byteplay.LOAD_CONST, globals),
         (byteplay.CALL_FUNCTION, 0),
         (byteplay.LOAD_CONST, locals),
         (byteplay.CALL_FUNCTION, 0),
-        (byteplay.BUILD_LIST, 0),
-        (byteplay.DUP_TOP, None),
-        (byteplay.STORE_FAST, state.real_folded_arr),
-    ]
-    if PYTHON_VERSION < (2, 7):
-        for folded_code in state.consts:
-            content += [
-                (byteplay.DUP_TOP, None),
-            ] + folded_code + [
-                (byteplay.LIST_APPEND, None),
-            ]
-    else:
-        for folded_code in state.consts:
-            content += folded_code + [
-                (byteplay.LIST_APPEND, 1),
-            ]
-    content += [
         (byteplay.CALL_FUNCTION, 9),
-        (byteplay.DELETE_FAST, state.real_folded_arr),
         (byteplay.DUP_TOP, None),
         (byteplay.LOAD_CONST, None),
     ]
     head_end_label = byteplay.Label()
 
-    # Let's "res" is a return value of "exec_loop".
+    # Let's "params" is a return value of "start_loop".
     # Now the stack looks like:
-    #     None, res, res, iterator, ...
+    #     None, params, params, iterator, ...
     content += [
         (byteplay.COMPARE_OP, 'is not'),
     ]
@@ -262,24 +942,34 @@ def create_head_hook(state, loop_end_label):
             (byteplay.POP_JUMP_IF_FALSE, head_end_label),
         ]
 
-    # Code below runs if res is not None (optimization was successful).
+    # Code below runs if params is not None (the loop will be optimized).
+    # Now the stack looks like:
+    #     params, iterator, ...
+    content += [
+        (byteplay.LOAD_CONST, exec_loop),
+        (byteplay.ROT_TWO, None),
+        (byteplay.LOAD_CONST, state.settings),
+        (byteplay.LOAD_CONST, packed_indexes),
+        (byteplay.LOAD_CONST, manual_store_counter is not None),
+        (byteplay.LOAD_CONST, state.cache),
+        (byteplay.CALL_FUNCTION, 5),
+    ]
+
+    # Let's "res" is a return value of "exec_loop".
     # Now the stack looks like:
     #     res, iterator, ...
     content += [
-        (byteplay.UNPACK_SEQUENCE, len(unpacked_straight)),
+        (byteplay.UNPACK_SEQUENCE, packed_count),
     ]
     # Store changed variables
-    for straight in unpacked_straight:
-        content.append(
-            (VARIABLE_OPERATION_MAP[straight[0]][1], straight[1])
-        )
+    content += store_content
     # We need to pop the iterator because the loop will be skipped
     content += [
         (byteplay.POP_TOP, None),
         (byteplay.JUMP_ABSOLUTE, loop_end_label),
     ]
 
-    # Code below runs if res is None (optimization failed).
+    # Code below runs if params is None (the optimization is skipped).
     # Now the stack looks like:
     #     None, iterator, ...           (in Python 2.7)
     #     False, None, iterator, ...    (in Python < 2.7)
@@ -287,10 +977,18 @@ def create_head_hook(state, loop_end_label):
         (head_end_label, None),
         (byteplay.POP_TOP, None),
     ]
+    # If the precheck succeeded, the stack looks like:
+    #     iterator, ...                 (in Python 2.7)
+    #     True, iterator, ...           (in Python < 2.7)
     if PYTHON_VERSION < (2, 7):
         content += [
+            (precheck_end_label, None),
             (byteplay.POP_TOP, None),
         ]
+    else:
+        content += [
+            (precheck_end_label, None),
+        ]
     # Right before the loop (before GET_ITER instruction) iterator
     # must be at the top of the stack.
     return content
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import imp
+import logging
+import os
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModuleLoader(object):
+    # PEP 302 loader of a source module which code objects are optimized
+    # before the module is executed
+
+    def __init__(self, importer, filename, is_package):
+        self._importer = importer
+        self._filename = filename
+        self._is_package = is_package
+
+    def is_package(self, fullname):
+        return self._is_package
+
+    def get_source(self, fullname):
+        with open(self._filename, 'rU') as source_file:
+            return source_file.read()
+
+    def get_code(self, fullname):
+        source = self.get_source(fullname)
+        if not source.endswith('\n'):
+            source += '\n'
+        code = compile(source, self._filename, 'exec', 0, True)
+        return self._importer.optimize(fullname, code)
+
+    def load_module(self, fullname):
+        code = self.get_code(fullname)
+
+        # If the module is reloaded, the existing object must be reused
+        is_new = fullname not in sys.modules
+        module = sys.modules.setdefault(fullname, imp.new_module(fullname))
+        module.__file__ = self._filename
+        module.__loader__ = self
+        if self._is_package:
+            module.__path__ = [os.path.dirname(self._filename)]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
+        try:
+            exec code in module.__dict__
+        except:
+            if is_new:
+                sys.modules.pop(fullname, None)
+            raise
+        return sys.modules[fullname]
+
+
+class OptimizingImporter(object):
+    # PEP 302 finder for `sys.meta_path` that optimizes loops in all code
+    # objects of source modules which names start with one of the
+    # prefixes. `upgrade_code` gets a module code object and returns the
+    # new code object and a list of report entries about its loops.
+
+    def __init__(self, prefixes, upgrade_code):
+        if isinstance(prefixes, basestring):
+            prefixes = [prefixes]
+        self._prefixes = tuple(prefixes)
+        self._upgrade_code = upgrade_code
+        # Report entries about optimized loops of imported modules:
+        # {module name: [entry, ...]}
+        self.changes = {}
+
+    def matches(self, fullname):
+        for prefix in self._prefixes:
+            if fullname == prefix or fullname.startswith(prefix + '.'):
+                return True
+        return False
+
+    def find_module(self, fullname, path=None):
+        if not self.matches(fullname):
+            return None
+        try:
+            module_file, filename, description = imp.find_module(
+                fullname.rpartition('.')[2], path)
+        except ImportError:
+            return None
+        if module_file is not None:
+            module_file.close()
+
+        kind = description[2]
+        if kind == imp.PKG_DIRECTORY:
+            filename = os.path.join(filename, '__init__.py')
+            if not os.path.isfile(filename):
+                return None
+            return ModuleLoader(self, filename, True)
+        if kind == imp.PY_SOURCE:
+            return ModuleLoader(self, filename, False)
+        # Compiled and extension modules are imported in a usual way
+        return None
+
+    def optimize(self, fullname, code):
+        try:
+            new_code, loops_report = self._upgrade_code(code)
+        except Exception as err:
+            # The module must be imported even if it can't be optimized
+            logger.warning('Failed to optimize module "%s": %s: %s',
+                           fullname, type(err).__name__, err)
+            return code
+
+        changes = [entry for entry in loops_report
+                   if entry['outcome'] == 'optimized']
+        self.changes[fullname] = changes
+        for entry in changes:
+            logger.info('Optimized loop at line %s in %s, file "%s"',
+                        entry['lineno'], entry['function'], entry['filename'])
+        return new_code
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import byteplay
+
+from matcode import *
+
+
+# If a function calls one of these names or executes such instructions,
+# any of its local variables can be read implicitly
+FRAME_INSPECTING_NAMES = frozenset(['locals', 'vars', 'dir', 'eval', 'execfile'])
+FRAME_INSPECTING_OPERATIONS = frozenset([byteplay.EXEC_STMT, byteplay.IMPORT_STAR])
+
+NAME_LOADING_OPERATIONS = frozenset([
+    byteplay.LOAD_NAME, byteplay.LOAD_GLOBAL, byteplay.LOAD_FAST,
+])
+
+# Instructions after which control is never passed to the next instruction
+NO_FALLTHROUGH_OPERATIONS = frozenset([
+    byteplay.JUMP_ABSOLUTE, byteplay.JUMP_FORWARD, byteplay.CONTINUE_LOOP,
+    byteplay.BREAK_LOOP, byteplay.RETURN_VALUE, byteplay.RAISE_VARARGS,
+])
+
+EXCEPTION_SETUP_OPERATIONS = frozenset([
+    byteplay.SETUP_EXCEPT, byteplay.SETUP_FINALLY,
+] + ([byteplay.SETUP_WITH] if hasattr(byteplay, 'SETUP_WITH') else []))
+
+
+def inspects_frame(code):
+    for oper, arg in code:
+        if oper in FRAME_INSPECTING_OPERATIONS:
+            return True
+        if oper in NAME_LOADING_OPERATIONS and arg in FRAME_INSPECTING_NAMES:
+            return True
+    return False
+
+
+def build_successors(code):
+    # Build a conservative control flow graph: it may contain excess edges
+    # (it only makes the set of live variables bigger), but mustn't miss
+    # any real ones.
+
+    label_indexes = {}
+    for index, (oper, arg) in enumerate(code):
+        if isinstance(oper, byteplay.Label):
+            label_indexes[oper] = index
+
+    # An exception can be raised almost anywhere, so we consider that
+    # every handler can be reached from every instruction
+    handler_indexes = []
+    loop_end_indexes = []
+    for oper, arg in code:
+        if oper in EXCEPTION_SETUP_OPERATIONS:
+            handler_indexes.append(label_indexes[arg])
+        elif oper == byteplay.SETUP_LOOP:
+            loop_end_indexes.append(label_indexes[arg])
+
+    successors = []
+    for index, (oper, arg) in enumerate(code):
+        cur = list(handler_indexes)
+        if oper in byteplay.hasjump:
+            cur.append(label_indexes[arg])
+        if oper == byteplay.BREAK_LOOP:
+            cur += loop_end_indexes
+        elif oper == byteplay.END_FINALLY:
+            # END_FINALLY can resume a pending "break" or "continue"
+            cur += label_indexes.values()
+        if oper not in NO_FALLTHROUGH_OPERATIONS and index + 1 < len(code):
+            cur.append(index + 1)
+        successors.append(cur)
+    return successors
+
+
+# Result of `find_live_in` if any variable can be read implicitly
+ALL_LIVE = None
+
+
+def find_live_in(code):
+    # Returns a list of sets of straight references (FAST, name) of local
+    # variables which values can be read after control reaches every
+    # instruction, or ALL_LIVE if it's impossible to determine. Variables
+    # of other types must be always considered live.
+
+    if inspects_frame(code):
+        return ALL_LIVE
+
+    uses = []
+    defs = []
+    for oper, arg in code:
+        if oper in (byteplay.LOAD_FAST, byteplay.DELETE_FAST):
+            uses.append((FAST, arg))
+            defs.append(None)
+        elif oper == byteplay.STORE_FAST:
+            uses.append(None)
+            defs.append((FAST, arg))
+        else:
+            uses.append(None)
+            defs.append(None)
+
+    successors = build_successors(code)
+    live_in = [frozenset() for instr in code]
+    changed = True
+    while changed:
+        changed = False
+        for index in xrange(len(code) - 1, -1, -1):
+            live = set()
+            for succ in successors[index]:
+                live |= live_in[succ]
+            live.discard(defs[index])
+            if uses[index] is not None:
+                live.add(uses[index])
+            if len(live) != len(live_in[index]):
+                live_in[index] = frozenset(live)
+                changed = True
+    return live_in
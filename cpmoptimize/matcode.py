@@ -12,14 +12,52 @@ def make_enum(variants):
 
         __str__ = __repr__
 
+        def __reduce__(self):
+            # Matcode can be passed to other processes. There variants
+            # become plain integers (they still compare equal).
+            return int, (int(self),)
+
     for index, elem in enumerate(variants):
         globals()[elem] = Variant(index)
 
 
-MATCODE_OPERATIONS = 'MOV ADD SUB MUL LOOP END'.split()
+MATCODE_OPERATIONS = ' '.join([
+    'MOV ADD SUB MUL STEP',
+    'LOOP END',
+    'IF ELSE ENDIF',
+    'PHASES NEXT_PHASE END_PHASES',
+    'XOR_STEP SEMIRING_STEP',
+]).split()
 
 make_enum(MATCODE_OPERATIONS)
 
+# Operation "STEP" is followed by triples of arguments (dest, src, coeff).
+# It assigns to every mentioned destination the sum of the products of
+# "coeff" and values of "src" for all triples with this destination. All
+# assignments are performed simultaneously, i.e. sources have values
+# they had before the instruction.
+#
+# Operations "IF cond", "ELSE" and "ENDIF" make conditional blocks. The
+# condition is a constant value, so the blocks are resolved in function
+# `hook.define_values` before running the matcode.
+#
+# Operations "PHASES period", "NEXT_PHASE" and "END_PHASES" make a block
+# with the code for every possible value of the loop's counter modulo
+# the period. It's placed in the loop's body and is followed only by the
+# update of the counter and its lifted powers. Before running the matcode
+# the loop is unrolled by the period in function `hook.unroll_phases`.
+#
+# Operation "XOR_STEP" is used instead of "STEP" in loops over GF(2) (see
+# "gf2.py"). It's followed by triples of arguments (dest, bits, const).
+# Every bit of the destination is assigned to the XOR of the bits of the
+# variables selected by the corresponding mask in "bits" and the bit of
+# the constant "const". Assignments are performed simultaneously.
+#
+# Operation "SEMIRING_STEP" is used instead of "STEP" in loops over other
+# semirings (see "semirings.py"). Its arguments have the same meaning, but
+# the sums and the products are calculated in the semiring (e.g. "max" is
+# the sum and "+" is the product in the max-plus semiring).
+
 
 MATCODE_ARGUMENT_TYPES = ' '.join([
     # Raw constant value
@@ -32,15 +70,24 @@ MATCODE_ARGUMENT_TYPES = ' '.join([
 
     # Straight variable references
     'NAME GLOBAL FAST DEREF',
+    # Attribute of an object (a pair of a straight reference of a variable
+    # containing the object and a tuple of names in the attributes chain)
+    'ATTR',
+    # Element of a list (a triple of a straight reference of a variable
+    # containing the list, an index and the list's length or None if the
+    # variable isn't changed in the loop)
+    'ITEM',
     # Variable for loop's counter
     'COUNTER',
-    # References to relative stack position
-    'TOS FOLD_TOS',
+    # Variable for a product of a power of loop's counter and a value
+    # (see `recompiler.lift_key`)
+    'LIFTED',
     # List of instructions that makes folded constant value
     'FOLD',
 
-    # Reference to absolute stack position
-    'STACK',
+    # Reference to the unit element of the vector (a source of a
+    # constant term in "STEP" operation)
+    'UNIT',
 
     # Unified mutable variable ID
     'VAR',
@@ -49,27 +96,28 @@ MATCODE_ARGUMENT_TYPES = ' '.join([
 make_enum(MATCODE_ARGUMENT_TYPES)
 
 # Lifecycle of arguments:
-#   1). Before creating a matcode some constants are folded using
-#       method "recompiler.RecompilerState.add_const" from type "FOLD"
-#       to type "CONST". This may occur in method
-#       `recompiler.handle_store_var`.
+#   1). While a loop's body is recompiled, values of the stack slots and the
+#       variables are tracked as linear combinations of values that the
+#       variables had at the beginning of an iteration (see
+#       `recompiler.LinearForm`). Coefficients of these combinations
+#       that are unknown before the run-time are folded using method
+#       "recompiler.RecompilerState.add_const" from type "FOLD" to type
+#       "CONST" (identical coefficients share one constant).
 #   2). There are types used in the matcode generation and passed to method
 #       `recompiler.RecompilerState.append`:
 #           VALUE
 #           CONST PARAM
-#           NAME GLOBAL FAST DEREF COUNTER TOS FOLD_TOS
-#   3). During recompilation, firstly relative stack references with type
-#       "TOS" are replaced by absolute references with type
-#       "STACK". Then arguments with types "NAME", "GLOBAL", "FAST",
-#       "DEREF", "COUNTER" and "STACK" are replaced by arguments with
-#       type "VAR", and arguments with type "FOLD_TOS" are replaced by
-#       arguments with type "CONST". This occurs in private method
+#           NAME GLOBAL FAST DEREF ATTR ITEM COUNTER LIFTED UNIT
+#   3). During recompilation arguments with types "NAME", "GLOBAL", "FAST",
+#       "DEREF", "ATTR", "ITEM", "COUNTER" and "LIFTED" are replaced by
+#       arguments with type "VAR".
+#       This occurs in private method
 #       `recompiler.RecompilerState._translate_arg`.
 #   4). So, there are types used in the matcode after the recompilation and
 #       passed to function `hook.exec_loop`:
 #           VALUE
 #           CONST PARAM
-#           VAR
+#           UNIT VAR
 #   5). During run-time, constant references with types "CONST" and
 #       "PARAM" are replaced by their values (only at this moment they have
 #       become known) with type "VALUE". This occurs in function
@@ -77,7 +125,7 @@ make_enum(MATCODE_ARGUMENT_TYPES)
 #   6). So, there are types used in the matcode before its running and passed
 #       to function `run.run_matcode`:
 #           VALUE
-#           VAR
+#           UNIT VAR
 
 
 # Map from a variable type to bytecode operations working with it
@@ -96,4 +144,16 @@ for arg_type, opers in VARIABLE_OPERATION_MAP.items():
         VARIABLE_TYPE_MAP[oper] = arg_type, bool(index)
 
 
-__all__ = MATCODE_OPERATIONS + MATCODE_ARGUMENT_TYPES + ['VARIABLE_OPERATION_MAP', 'VARIABLE_TYPE_MAP']
+def var_repr(straight):
+    # Make a readable name of a variable by its straight reference
+    arg_type, arg = straight
+    if arg_type == ATTR:
+        var_straight, attrs = arg
+        return '.'.join((var_repr(var_straight),) + attrs)
+    if arg_type == ITEM:
+        var_straight, index, length = arg
+        return '%s[%s]' % (var_repr(var_straight), index)
+    return arg
+
+
+__all__ = MATCODE_OPERATIONS + MATCODE_ARGUMENT_TYPES + ['VARIABLE_OPERATION_MAP', 'VARIABLE_TYPE_MAP', 'var_repr']
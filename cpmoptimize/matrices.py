@@ -1,30 +1,150 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from itertools import izip
+import operator
+from itertools import imap, izip
+
+
+MAX_WINDOW = 8
+# Maximal number of elements in precomputed powers of a matrix
+MAX_WINDOW_TABLE_SIZE = 1 << 16
+
+
+def choose_window(bits_count, side):
+    # Choose the window size for exponentiation that minimizes the
+    # expected number of multiplications (precomputation of 2 ** (window
+    # - 1) odd powers costs as many multiplications, one window is met
+    # in every "window + 1" bits on average). Big matrices are limited
+    # by the memory occupied by the powers.
+
+    best_window, best_cost = 1, bits_count / 2.0
+    for window in xrange(2, MAX_WINDOW + 1):
+        table_len = 1 << (window - 1)
+        if table_len * side * side > MAX_WINDOW_TABLE_SIZE:
+            break
+        cost = table_len + bits_count / (window + 1.0)
+        if cost < best_cost:
+            best_window, best_cost = window, cost
+    return best_window
+
+
+class Semiring(object):
+    # Operations used in products of matrices. "add" is a binary
+    # operation, "sum" reduces an iterable by it.
+
+    def __init__(self, name, add, sum, mul, zero, one):
+        self.name = name
+        self.add = add
+        self.sum = sum
+        self.mul = mul
+        self.zero = zero
+        self.one = one
+
+    def __repr__(self):
+        return 'Semiring(%r)' % self.name
+
+
+ARITHMETIC = Semiring('arithmetic', operator.add, sum, operator.mul, 0, 1)
+MAX_PLUS = Semiring('max_plus', max, max, operator.add, float('-inf'), 0)
+MIN_PLUS = Semiring('min_plus', min, min, operator.add, float('inf'), 0)
+BOOLEAN = Semiring('boolean', operator.or_, any, operator.and_, False, True)
+
+SEMIRINGS = dict((semiring.name, semiring)
+                 for semiring in (ARITHMETIC, MAX_PLUS, MIN_PLUS, BOOLEAN))
 
 
 class Matrix(object):
-    def __init__(self, content):
-        self.content = content
+    # Elements are stored in a flat list row by row. Big integers can't be
+    # stored in an array, so a list is used. Products are calculated in
+    # the semiring of the matrix (ordinary arithmetic by default).
+
+    __slots__ = ('_rows', '_cols', '_data', '_semiring')
+
+    def __init__(self, content, semiring=ARITHMETIC):
+        self._rows = len(content)
+        self._cols = len(content[0]) if content else 0
+        self._data = [elem for row in content for elem in row]
+        self._semiring = semiring
 
     @classmethod
-    def identity(cls, side):
-        return cls([[int(i == j) for j in xrange(side)]
-                    for i in xrange(side)])
+    def _from_data(cls, rows, cols, data, semiring=ARITHMETIC):
+        mat = cls.__new__(cls)
+        mat._rows = rows
+        mat._cols = cols
+        mat._data = data
+        mat._semiring = semiring
+        return mat
+
+    @classmethod
+    def identity(cls, side, semiring=ARITHMETIC):
+        data = [semiring.zero] * (side * side)
+        data[::side + 1] = [semiring.one] * side
+        return cls._from_data(side, side, data, semiring)
+
+    @property
+    def semiring(self):
+        return self._semiring
 
     @property
     def rows(self):
-        return len(self.content)
+        return self._rows
 
     @property
     def cols(self):
-        return len(self.content[0]) if self.content else 0
+        return self._cols
+
+    @property
+    def content(self):
+        # Copy of the elements as a list of rows
+        return [self.row(y) for y in xrange(self._rows)]
+
+    def row(self, y):
+        if y < 0:
+            y += self._rows
+        begin = y * self._cols
+        return self._data[begin:begin + self._cols]
+
+    def col(self, x):
+        if x < 0:
+            x += self._cols
+        return self._data[x::self._cols]
+
+    def _index(self, key):
+        y, x = key
+        if y < 0:
+            y += self._rows
+        if x < 0:
+            x += self._cols
+        return y * self._cols + x
+
+    def __getitem__(self, key):
+        return self._data[self._index(key)]
+
+    def __setitem__(self, key, value):
+        self._data[self._index(key)] = value
+
+    def copy(self):
+        return Matrix._from_data(self._rows, self._cols, list(self._data),
+                                 self._semiring)
+
+    def _mul_into(self, other, out):
+        # Write the product to the list "out" that must have a proper
+        # size and mustn't be a storage of the operands
+        add_all = self._semiring.sum
+        mul = self._semiring.mul
+        cols = other._cols
+        other_cols = [other._data[x::cols] for x in xrange(cols)]
+        index = 0
+        for y in xrange(self._rows):
+            row = self.row(y)
+            for col in other_cols:
+                out[index] = add_all(imap(mul, row, col))
+                index += 1
 
     def _do_mul(self, other):
-        return Matrix([[sum(self.content[y][k] * other.content[k][x] for k in xrange(self.cols))
-                        for x in xrange(other.cols)]
-                       for y in xrange(self.rows)])
+        out = [0] * (self._rows * other._cols)
+        self._mul_into(other, out)
+        return Matrix._from_data(self._rows, other._cols, out, self._semiring)
 
     def __mul__(self, other):
         if not isinstance(other, Matrix):
@@ -33,6 +153,9 @@ class Matrix(object):
         if self.cols != other.rows:
             raise ValueError("First %s matrix isn't matches to second %s matrix by sizes in multiplication" %
                              (self.size_repr(), other.size_repr()))
+        if self._semiring is not other._semiring:
+            raise ValueError("Can't multiply matrices over different semirings %s and %s" %
+                             (self._semiring.name, other._semiring.name))
         return self._do_mul(other)
 
     def __pow__(self, n):
@@ -40,17 +163,49 @@ class Matrix(object):
             raise ValueError("Can't construct power of non-square %s matrix" %
                              self.size_repr())
 
-        res = Matrix.identity(self.rows)
         if not n:
-            return res
-        cur = self
-        while True:
-            if n & 1:
-                res = res._do_mul(cur)
-                if n == 1:
-                    return res
-            cur = cur._do_mul(cur)
-            n >>= 1
+            return Matrix.identity(self.rows, self._semiring)
+        # Sliding window exponentiation: the bits of the exponent are
+        # scanned from the highest one, windows of at most "window" bits
+        # ending with a set bit are multiplied by precomputed odd powers.
+        # Products are written to preallocated buffers.
+        bits_count = len(bin(n)) - 2
+        window = choose_window(bits_count, self._rows)
+        table = self._odd_powers(1 << (window - 1))
+
+        res = None
+        spare = Matrix._from_data(self._rows, self._cols, [0] * len(self._data),
+                                  self._semiring)
+        index = bits_count - 1
+        while index >= 0:
+            if not n >> index & 1:
+                res._mul_into(res, spare._data)
+                res, spare = spare, res
+                index -= 1
+                continue
+            low = max(index - window + 1, 0)
+            while not n >> low & 1:
+                low += 1
+            value = n >> low & ((1 << (index - low + 1)) - 1)
+            if res is None:
+                res = table[value >> 1].copy()
+            else:
+                for i in xrange(index - low + 1):
+                    res._mul_into(res, spare._data)
+                    res, spare = spare, res
+                res._mul_into(table[value >> 1], spare._data)
+                res, spare = spare, res
+            index = low - 1
+        return res
+
+    def _odd_powers(self, count):
+        # Returns a list of powers 1, 3, ..., 2 * count - 1 of the matrix
+        powers = [self]
+        if count > 1:
+            square = self._do_mul(self)
+            for i in xrange(count - 1):
+                powers.append(powers[-1]._do_mul(square))
+        return powers
 
     def size_repr(self):
         return '%sx%s' % (self.rows, self.cols)
@@ -66,4 +221,74 @@ class Matrix(object):
         return 'Matrix %s:\n' % self.size_repr() + str(self)
 
     def transposed(self):
-        return Matrix(map(list, izip(*self.content)))
+        return Matrix(map(list, izip(*self.content)), self._semiring)
+
+
+def parity(value):
+    return bin(value).count('1') & 1
+
+
+class BitMatrix(object):
+    # Square matrix over GF(2) that is applied to column vectors. Every
+    # row is stored in an integer (bit "x" of row "y" is the element in
+    # column "x"), so a row of a product is the XOR of the rows of the
+    # second factor selected by the bits of the row of the first one.
+
+    __slots__ = ('_rows',)
+
+    def __init__(self, rows):
+        self._rows = list(rows)
+
+    @classmethod
+    def identity(cls, side):
+        return cls([1 << index for index in xrange(side)])
+
+    @property
+    def side(self):
+        return len(self._rows)
+
+    def row(self, y):
+        return self._rows[y]
+
+    def __mul__(self, other):
+        if not isinstance(other, BitMatrix):
+            raise TypeError("Can't multiply bit matrix by non-matrix object with type %s" %
+                            type(other))
+        if self.side != other.side:
+            raise ValueError("Bit matrices of sizes %s and %s can't be multiplied" %
+                             (self.side, other.side))
+        other_rows = other._rows
+        res = []
+        for row in self._rows:
+            acc = 0
+            while row:
+                low = row & -row
+                acc ^= other_rows[low.bit_length() - 1]
+                row ^= low
+            res.append(acc)
+        return BitMatrix(res)
+
+    def __pow__(self, n):
+        res = BitMatrix.identity(self.side)
+        cur = self
+        while n:
+            if n & 1:
+                res *= cur
+            n >>= 1
+            if n:
+                cur *= cur
+        return res
+
+    def apply(self, vector):
+        # Multiply the matrix by a vector packed in an integer
+        res = 0
+        for y, row in enumerate(self._rows):
+            if parity(row & vector):
+                res |= 1 << y
+        return res
+
+    def __eq__(self, other):
+        return isinstance(other, BitMatrix) and self._rows == other._rows
+
+    def __ne__(self, other):
+        return not self == other
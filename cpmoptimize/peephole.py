@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from matcode import *
+
+
+# Simplification of the matcode generated by the recompiler. The matcode
+# is parsed to a tree of blocks, every block is simplified and the tree
+# is flattened back.
+#
+# Items of the tree are instructions and blocks:
+#     (IF, cond_instr, then_items, else_items)
+#     (PHASES, phases_instr, [phase_items, ...])
+# "else_items" is None if the conditional block doesn't have "ELSE" part.
+
+
+BLOCK_ENDS = frozenset([ELSE, ENDIF, NEXT_PHASE, END_PHASES])
+
+
+def parse_items(matcode, index):
+    # Returns items until the end of the current block and an index of
+    # the instruction that ends the block
+    items = []
+    while index < len(matcode) and matcode[index][0] not in BLOCK_ENDS:
+        instr = matcode[index]
+        if instr[0] == IF:
+            then_items, index = parse_items(matcode, index + 1)
+            else_items = None
+            if matcode[index][0] == ELSE:
+                else_items, index = parse_items(matcode, index + 1)
+            items.append((IF, instr, then_items, else_items))
+        elif instr[0] == PHASES:
+            phases = []
+            while True:
+                phase_items, index = parse_items(matcode, index + 1)
+                phases.append(phase_items)
+                if matcode[index][0] == END_PHASES:
+                    break
+            items.append((PHASES, instr, phases))
+        else:
+            items.append(instr)
+        index += 1
+    return items, index
+
+
+def is_block(item):
+    return isinstance(item, tuple)
+
+
+def flatten_items(items, res):
+    for item in items:
+        if not is_block(item):
+            res.append(item)
+        elif item[0] == IF:
+            res.append(item[1])
+            flatten_items(item[2], res)
+            if item[3] is not None:
+                res.append([ELSE])
+                flatten_items(item[3], res)
+            res.append([ENDIF])
+        else:
+            res.append(item[1])
+            for index, phase_items in enumerate(item[2]):
+                if index:
+                    res.append([NEXT_PHASE])
+                flatten_items(phase_items, res)
+            res.append([END_PHASES])
+    return res
+
+
+def simplify_step(instr):
+    # Merge triples with the same destination and source and constant
+    # coefficients, remove zero terms and destinations which values
+    # aren't changed. Returns None if the instruction has no effect.
+
+    dests = []
+    # Map from a destination to a list of its triples
+    terms = {}
+    # Map from a pair of a destination and a source to an index of the
+    # triple with a constant coefficient in the destination's list
+    value_terms = {}
+    for index in xrange(1, len(instr), 3):
+        dest, src, coeff = instr[index:index + 3]
+        if dest not in terms:
+            dests.append(dest)
+            terms[dest] = []
+        dest_terms = terms[dest]
+        if coeff[0] == VALUE:
+            term_index = value_terms.get((dest, src))
+            if term_index is not None:
+                prev_coeff = dest_terms[term_index][2]
+                dest_terms[term_index] = \
+                    dest, src, (VALUE, prev_coeff[1] + coeff[1])
+                continue
+            value_terms[dest, src] = len(dest_terms)
+        dest_terms.append((dest, src, coeff))
+
+    new_instr = [STEP]
+    for dest in dests:
+        dest_terms = [term for term in terms[dest]
+                      if not (term[2][0] == VALUE and term[2][1] == 0)]
+        if dest_terms == [(dest, dest, (VALUE, 1))]:
+            # The value isn't changed
+            continue
+        if not dest_terms:
+            # The destination must be mentioned to be assigned to zero
+            dest_terms = terms[dest][:1]
+        for term in dest_terms:
+            new_instr.extend(term)
+    if len(new_instr) == 1:
+        return None
+    return new_instr
+
+
+def simplify_items(items):
+    res = []
+    for item in items:
+        if not is_block(item):
+            if item[0] == STEP:
+                item = simplify_step(item)
+                if item is None:
+                    continue
+            res.append(item)
+            continue
+
+        if item[0] == IF:
+            oper, cond_instr, then_items, else_items = item
+            then_items = simplify_items(then_items)
+            if else_items is not None:
+                else_items = simplify_items(else_items)
+                if not else_items:
+                    else_items = None
+            if then_items == (else_items or []):
+                # The code doesn't depend on the condition
+                res += then_items
+            else:
+                res.append((IF, cond_instr, then_items, else_items))
+            continue
+
+        oper, phases_instr, phases = item
+        phases = [simplify_items(phase_items) for phase_items in phases]
+        if all(phase_items == phases[0] for phase_items in phases):
+            # The code doesn't depend on the counter's remainder
+            res += phases[0]
+        else:
+            res.append((PHASES, phases_instr, phases))
+    return res
+
+
+STEP_INSTRS = frozenset([STEP, XOR_STEP, SEMIRING_STEP])
+
+
+def matcode_size(matcode):
+    # Number of operations in the matcode (every term of "STEP",
+    # "XOR_STEP" and "SEMIRING_STEP" is considered as a separate
+    # operation)
+    return sum((len(instr) - 1) // 3 if instr[0] in STEP_INSTRS else 1
+               for instr in matcode)
+
+
+def optimize_matcode(matcode):
+    items, index = parse_items(matcode, 0)
+    return flatten_items(simplify_items(items), [])
@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import operator
+from fractions import gcd
+
 import byteplay
 
+import hook
 from matcode import *
 
 
 class RecompilationError(Exception):
-    def __init__(self, message, state):
+    # Besides the message, the error keeps the reason's category, the
+    # name of the instruction being recompiled and the counter status
+    # for recompilation reports
+
+    def __init__(self, message, state, category):
+        self.reason = message
+        self.category = category
+        self.lineno = state.lineno
+        self.instruction = None if state.instr is None else str(state.instr[0])
+        self.counter_status = state.counter_status
         self.message = "Can't optimize loop: %s" % message
         if state.lineno is not None:
             self.message += ' at line %s' % state.lineno
@@ -21,28 +34,238 @@ class UnpredictableArgsError(Exception):
     pass
 
 
+class RecompileAgainError(Exception):
+    # The loop's body must be recompiled from scratch because new hints
+    # about it were found (see `recompile_body`)
+    pass
+
+
+def unpredictable_args_error(state, instr):
+    return RecompilationError(('All operands of instruction %s must be a constant ' +
+                               'or must have a predictable value') % instr[0],
+                              state, 'unpredictable_operands')
+
+
+def is_folded(coeff):
+    return isinstance(coeff, list)
+
+
+def is_known_zero(coeff):
+    return not is_folded(coeff) and coeff == 0
+
+
+def coeff_lines(coeff):
+    # Make a list of instructions that calculates a coefficient
+    if is_folded(coeff):
+        return coeff
+    return [(byteplay.LOAD_CONST, coeff)]
+
+
+def add_coeffs(first, second):
+    if not is_folded(first) and not is_folded(second):
+        return first + second
+    if is_known_zero(first):
+        return second
+    if is_known_zero(second):
+        return first
+    return coeff_lines(first) + coeff_lines(second) + [
+        (byteplay.BINARY_ADD, None),
+    ]
+
+
+def mul_coeffs(first, second):
+    if not is_folded(first) and not is_folded(second):
+        return first * second
+    if is_known_zero(first) or is_known_zero(second):
+        return 0
+    if not is_folded(first) and first == 1:
+        return second
+    if not is_folded(second) and second == 1:
+        return first
+    return coeff_lines(first) + coeff_lines(second) + [
+        (byteplay.BINARY_MULTIPLY, None),
+    ]
+
+
+def neg_coeff(coeff):
+    if not is_folded(coeff):
+        return -coeff
+    return coeff + [(byteplay.UNARY_NEGATIVE, None)]
+
+
+# Key of a constant term in a linear form
+UNIT_KEY = UNIT, None
+
+
+class LinearForm(object):
+    # Linear combination of values that mutable variables had at the
+    # beginning of the iteration (they are identified by straight
+    # references) and a constant term (identified by UNIT_KEY).
+    # Coefficients are either numbers known during the recompilation or
+    # lists of instructions calculating them (these instructions will be
+    # folded and executed once before the loop). Objects of this class
+    # are never modified after creation.
+
+    def __init__(self, coeffs):
+        self._coeffs = dict((key, coeff) for key, coeff in coeffs.iteritems()
+                            if not is_known_zero(coeff))
+
+    @classmethod
+    def const(cls, coeff):
+        return cls({UNIT_KEY: coeff})
+
+    @classmethod
+    def var(cls, straight):
+        return cls({straight: 1})
+
+    @property
+    def coeffs(self):
+        return self._coeffs
+
+    def is_const(self):
+        return all(key == UNIT_KEY for key in self._coeffs)
+
+    def const_coeff(self):
+        return self._coeffs.get(UNIT_KEY, 0)
+
+    def __add__(self, other):
+        coeffs = dict(self._coeffs)
+        for key, coeff in other.coeffs.iteritems():
+            coeffs[key] = add_coeffs(coeffs.get(key, 0), coeff)
+        return LinearForm(coeffs)
+
+    def __neg__(self):
+        return LinearForm(dict((key, neg_coeff(coeff))
+                               for key, coeff in self._coeffs.iteritems()))
+
+    def __sub__(self, other):
+        return self + -other
+
+    def scaled(self, factor):
+        return LinearForm(dict((key, mul_coeffs(coeff, factor))
+                               for key, coeff in self._coeffs.iteritems()))
+
+    def __eq__(self, other):
+        return self._coeffs == other.coeffs
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class SpecialValue(object):
+    # Base class for values in the stack slots that aren't numbers. They
+    # can't be operands of arithmetic operations.
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        raise UnpredictableArgsError
+
+    def _unsupported(self, *args):
+        raise UnpredictableArgsError
+
+    __add__ = __radd__ = __sub__ = __rsub__ = __neg__ = _unsupported
+
+
+class ListRef(SpecialValue):
+    # Reference to a list. The list object is identified by a straight
+    # reference of a variable that contained it at the beginning of the
+    # iteration or by a pair (None, number) if it was created in the body.
+    # Length of the list is None if the variable isn't changed in the
+    # loop (then only elements with known indexes are accessible).
+
+    __slots__ = ('obj', 'length')
+
+    def __init__(self, obj, length):
+        self.obj = obj
+        self.length = length
+
+    def item_key(self, index):
+        return ITEM, (self.obj, index, self.length)
+
+
+class RangeIterator(SpecialValue):
+    # Iterator over numbers known during the recompilation. Loops over it
+    # are unrolled.
+
+    __slots__ = ('values', 'position')
+
+    def __init__(self, values, position):
+        self.values = values
+        self.position = position
+
+
+class TupleValue(SpecialValue):
+    # Tuple of values in the stack slots. Such tuples are made by parallel
+    # assignments of 4 and more values and can be only unpacked.
+
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+
 class RecompilerState(object):
-    def __init__(self, settings):
+    def __init__(self, settings, hints):
         self._settings = settings
+        self.hints = hints
         self.lineno = settings['head_lineno']
 
+        # Linear forms of values in the stack slots
         self.stack = []
         self._content = []
-        # List of straight references of all used variables
+        # List of straight references of all mutable variables
         self._vars_storage = []
         # List of indexes of really existing variables in
         # self._vars_storage (we need to save their values at the end of
         # the loop)
         self._real_vars_indexes = []
-        # Map from a straight variable reference to a pair of variable
-        # index in a unified storage (actually in
-        # self._vars_storage) and its effective unified
-        # reference (VAR, index) or (CONST, const_no)
+        # Map from a straight variable reference to a variable index in a
+        # unified storage (actually in self._vars_storage)
         self._vars_map = {}
+        # Map from a straight reference of a mutable variable to a
+        # linear form of its current value
+        self._values = {}
         # Storage for folded instructions sets of constants. This
         # instructions will be executed during run-time once. Calculated
         # values will be inserted into matrices.
         self._consts = []
+        # Map from instructions sets of constants to their indexes in
+        # self._consts (identical sets share one index)
+        self._consts_indexes = {}
+
+        # Straight reference of a variable that contains the counter value
+        # at the beginning of the iteration (None if the counter isn't
+        # maintained)
+        self.counter_key = None
+        # If the body is recompiled for every value of the counter modulo
+        # the period, there is the current value
+        self.phase = None
+        # List of straight references of lifted variables (see
+        # `lift_key`) in order of their registration
+        self._lifted = []
+        # Set of attribute names that are stored in the loop's body
+        self.stored_attrs = set()
+        # Number of lists created in the body
+        self._new_lists_count = 0
+        # Errors that are raised if they aren't resolved by new hints
+        # (see `may_become_list`)
+        self.deferred_errors = []
+        # List of tuples of variables that contain the same list after
+        # an iteration
+        self.list_aliases = None
+        # Blocks of the inner loops (pairs of a label of the loop's end
+        # and a stack size)
+        self.blocks = ()
+        # Instruction that is being recompiled
+        self.instr = None
+        # Usage of the counter in the body (see `browse_counter`)
+        self.counter_status = None
+        # Straight references of functions which calls were folded (they
+        # must be checked in the run-time, see `handle_pure_call`) paired
+        # with the functions they must refer to (None if any pure
+        # function is allowed)
+        self.pure_callees = []
 
     @property
     def settings(self):
@@ -61,83 +284,88 @@ class RecompilerState(object):
         return self._vars_storage
 
     @property
-    def real_vars_indexes(self):
-        return self._real_vars_indexes
-
-    _real_folded_arr = '__cpm::folded'
+    def lifted(self):
+        return self._lifted
 
     @property
-    def real_folded_arr(self):
-        return self._real_folded_arr
+    def real_vars_indexes(self):
+        return self._real_vars_indexes
 
     def add_const(self, straight):
         arg_type, arg = straight
-        if arg_type == FOLD_TOS:
-            lines = self.stack[-arg - 1]
-            if lines is None:
-                raise ValueError(
-                    'Unpredictable value to fold for FOLD_TOS'
-                )
-        elif arg_type == FOLD:
-            lines = arg
-        else:
+        if arg_type != FOLD:
             raise ValueError((
                 "Can't add constant from argument with type %s " +
                 "to matrix code"
             ) % arg_type)
-        index = len(self._consts)
-        self._consts.append(lines)
+        # Types are a part of the key because equal constants of
+        # different types (e.g. 1 and 1.0) give different results
+        try:
+            key = tuple((oper, type(value), value) for oper, value in arg)
+            index = self._consts_indexes.get(key)
+        except TypeError:  # If the instructions contain unhashable arguments
+            key = index = None
+        if index is None:
+            index = len(self._consts)
+            self._consts.append(arg)
+            if key is not None:
+                self._consts_indexes[key] = index
         return CONST, index
 
-    def add_var(self, straight, mutation):
-        # If a variable was changed at least once in a loop's body, we need
-        # mark it as mutable at the beginning of compilation.
-        # During the compilation its value can become predictable.
-        try:
-            index, unified = self._vars_map[straight]
+    def coeff_arg(self, coeff):
+        # Make an argument of the matcode from a coefficient
+        if is_folded(coeff):
+            return self.add_const((FOLD, coeff))
+        return VALUE, coeff
 
-            if mutation and unified[0] != VAR:
-                unified = VAR, index
-                self.store_var(straight, unified)
+    def add_var(self, straight):
+        # Register a mutable variable. Variables that weren't registered
+        # are considered constant in the loop's body.
+        try:
+            index = self._vars_map[straight]
         except KeyError:
             index = len(self._vars_storage)
             self._vars_storage.append(straight)
-            var_type = straight[0]
-            if var_type in (NAME, GLOBAL, FAST, DEREF):
+            if straight[0] in (NAME, GLOBAL, FAST, DEREF, ATTR, ITEM):
                 self._real_vars_indexes.append(index)
-
-            if mutation:
-                unified = VAR, index
-            else:
-                load_oper = VARIABLE_OPERATION_MAP[var_type][0]
-                unified = self.add_const((FOLD, [
-                    (load_oper, straight[1]),
-                ]))
-            self._vars_map[straight] = [index, unified]
-        return unified
+            self._vars_map[straight] = index
+            self._values[straight] = LinearForm.var(straight)
+        return VAR, index
+
+    def add_lifted(self, lifted):
+        if lifted in self._vars_map:
+            return
+        # Updating the product of the counter power and a value requires
+        # the products with all lower powers
+        power, base = lifted[1]
+        if power > 1:
+            lift_key(self, power - 1, base)
+        self.add_var(lifted)
+        self._lifted.append(lifted)
 
     def _translate_arg(self, arg):
         # Translate argument of types used in matcode generation to
-        # argument with type VALUE, CONST or VAR (make unified
-        # reference from straight)
+        # argument with type VALUE, CONST, PARAM, UNIT or VAR (make
+        # unified reference from straight)
 
         arg_type = arg[0]
 
-        if arg_type in (VALUE, CONST, PARAM):
+        if arg_type in (VALUE, CONST, PARAM, UNIT):
             return arg
-        if arg_type == FOLD_TOS:
-            return self.add_const(arg)
 
-        if arg_type not in VARIABLE_OPERATION_MAP.keys() + [COUNTER, TOS]:
+        if arg_type not in VARIABLE_OPERATION_MAP.keys() + [
+            ATTR, ITEM, COUNTER, LIFTED,
+        ]:
             raise ValueError((
                 "Can't add variable from argument with type %s " +
                 "to matrix code"
             ) % arg_type)
-        if arg_type == TOS:
-            # If argument type was TOS, translate it to argument with
-            # type STACK first (make absolute reference from relative)
-            arg = STACK, len(self.stack) - 1 - arg[1]
-        return self.add_var(arg, True)
+        return self.add_var(arg)
+
+    def insert(self, index, instr):
+        oper = instr[0]
+        args = map(self._translate_arg, instr[1:])
+        self._content.insert(index, [oper] + args)
 
     def append(self, *instrs):
         for instr in instrs:
@@ -145,11 +373,379 @@ class RecompilerState(object):
             args = map(self._translate_arg, instr[1:])
             self._content.append([oper] + args)
 
+    def is_mutable(self, straight):
+        return straight in self._vars_map
+
     def load_var(self, straight):
-        return self._vars_map[straight][1]
+        try:
+            return self._values[straight]
+        except KeyError:
+            # The variable isn't changed in the loop, so its value can
+            # be folded
+            load_oper = VARIABLE_OPERATION_MAP[straight[0]][0]
+            return LinearForm.const([(load_oper, straight[1])])
+
+    def store_var(self, straight, value):
+        lists = self.hints['lists']
+        if isinstance(value, ListRef) or straight in lists:
+            length = value.length if isinstance(value, ListRef) else None
+            if straight not in lists and length is not None:
+                lists[straight] = length
+                raise RecompileAgainError
+            if length is None or lists[straight] != length:
+                raise RecompilationError((
+                    'Variable "%s" must contain lists of the same length '
+                    'during the loop'
+                ) % var_repr(straight), self, 'lists')
+        elif isinstance(value, SpecialValue):
+            raise RecompilationError((
+                'Unsupported value of variable "%s"'
+            ) % var_repr(straight), self, 'unsupported_value')
+        self._values[straight] = value
+
+    def add_list_var(self, straight, length):
+        # Register a variable that contains lists of the same length
+        ref = ListRef(straight, length)
+        for index in xrange(length):
+            self.add_var(ref.item_key(index))
+        self._values[straight] = ref
+
+    def new_list(self, forms):
+        if not all(isinstance(form, LinearForm) for form in forms):
+            raise RecompilationError('Nested lists are unsupported',
+                                     self, 'lists')
+        self._new_lists_count += 1
+        ref = ListRef((None, self._new_lists_count), len(forms))
+        for index, form in enumerate(forms):
+            self._values[ref.item_key(index)] = form
+        return ref
+
+    def list_ref(self, value):
+        # Returns a reference to a list if the value is a list changed in
+        # the loop (otherwise returns None)
+        if isinstance(value, ListRef):
+            return value
+        straight = folded_straight(value)
+        if straight in self.hints['inplace_lists']:
+            return ListRef(straight, None)
+        return None
+
+    def item_key(self, ref, index_form):
+        index = index_form.const_coeff()
+        if not (
+            index_form.is_const() and
+            not is_folded(index) and isinstance(index, (int, long))
+        ):
+            raise RecompilationError((
+                'Index of a list changed in the loop must be known '
+                'during the recompilation'
+            ), self, 'lists')
+        if ref.length is None:
+            if index < 0:
+                raise RecompilationError((
+                    'Negative indexes of lists that are changed in place '
+                    'are unsupported'
+                ), self, 'lists')
+        else:
+            if index < 0:
+                index += ref.length
+            if not 0 <= index < ref.length:
+                raise RecompilationError('List index out of range',
+                                         self, 'lists')
+        key = ref.item_key(index)
+        if ref.obj[0] is not None:
+            self.add_var(key)
+        return key
+
+    def checkpoint(self):
+        return len(self._content), len(self._consts)
+
+    def rollback(self, checkpoint):
+        # Remove instructions and constants added after the checkpoint
+        content_len, consts_len = checkpoint
+        del self._content[content_len:]
+        del self._consts[consts_len:]
+        for key, index in self._consts_indexes.items():
+            if index >= consts_len:
+                del self._consts_indexes[key]
+
+    def save(self):
+        # Save the state of the values (before the recompilation of a
+        # branch)
+        return list(self.stack), dict(self._values), self.lineno, self.blocks
+
+    def restore(self, saved):
+        stack, values, self.lineno, self.blocks = saved
+        self.stack = list(stack)
+        self._values = dict(values)
+        # Variables registered after saving keep their initial values
+        for straight in self._vars_storage:
+            self._values.setdefault(straight, LinearForm.var(straight))
+
+    def append_step(self):
+        # Append an instruction that assigns current values to all
+        # mutable variables that were changed
+
+        # Elements of lists in variables get values of elements of the
+        # lists the variables contain now
+        new_items = {}
+        owners = {}
+        for straight, length in sorted(self.hints['lists'].iteritems()):
+            ref = self._values[straight]
+            owners.setdefault(ref.obj, []).append(straight)
+            if ref.obj != straight:
+                var_ref = ListRef(straight, length)
+                for index in xrange(length):
+                    new_items[var_ref.item_key(index)] = \
+                        self._values[ref.item_key(index)]
+        self._values.update(new_items)
+        # Variables containing the same list after an iteration will
+        # contain the same list after the loop
+        aliases = sorted(tuple(elem) for elem in owners.itervalues()
+                         if len(elem) > 1)
+        if self.list_aliases is None:
+            self.list_aliases = aliases
+        elif self.list_aliases != aliases:
+            raise RecompilationError((
+                'Lists are shared by different variables in different '
+                'branches'
+            ), self, 'lists')
+
+        # The counter isn't changed yet, so the lifted variables are
+        # products of its current powers and new values of their bases.
+        # New lifted variables may be registered during this loop.
+        index = 0
+        while index < len(self._lifted):
+            lifted = self._lifted[index]
+            power, base = lifted[1]
+            if base != UNIT_KEY:
+                self._values[lifted] = lift_form(
+                    self, power, self._values[base])
+            index += 1
+
+        args = []
+        for straight in self._vars_storage:
+            form = self._values[straight]
+            if form == LinearForm.var(straight):
+                continue
+            if not form.coeffs:
+                args += [straight, UNIT_KEY, (VALUE, 0)]
+            for key, coeff in form.coeffs.iteritems():
+                args += [straight, key, self.coeff_arg(coeff)]
+        if args:
+            self.append([STEP] + args)
+
+    def is_live(self, straight):
+        # Whether a variable value can be read after the loop
+        if straight[0] == ITEM:
+            var_straight, index, length = straight[1]
+            return length is None or self.is_live(var_straight)
+        live_vars = self._settings['live_vars']
+        return straight[0] != FAST or live_vars is None or straight in live_vars
+
+    def remove_dead_vars(self):
+        # Remove instructions that calculate values which will never be
+        # read, then remove variables that are not used by remaining
+        # instructions and needn't be saved after the loop. This reduces
+        # the size of matrices.
+
+        referenced = set()
+        for instr in self._content:
+            for arg in instr[1:]:
+                if arg[0] == VAR:
+                    referenced.add(arg[1])
+        # Values of real variables that weren't referenced in the matcode
+        # can't be changed by the loop, so we needn't save them
+        outputs = set(
+            index for index in self._real_vars_indexes
+            if (
+                index in referenced or
+                is_replaced_item(self._vars_storage[index])
+            ) and self.is_live(self._vars_storage[index])
+        )
+
+        live_after = [set() for instr in self._content]
+        propagate_liveness(self._content, 0, len(self._content),
+                           set(outputs), live_after)
+        content = []
+        for instr, live in zip(self._content, live_after):
+            instr = remove_dead_stores(instr, live)
+            if instr is not None:
+                content.append(instr)
+        self._content = content
+
+        used = set(outputs)
+        for instr in self._content:
+            for arg in instr[1:]:
+                if arg[0] == VAR:
+                    used.add(arg[1])
+        new_indexes = {}
+        new_storage = []
+        for index, straight in enumerate(self._vars_storage):
+            if index in used:
+                new_indexes[index] = len(new_storage)
+                new_storage.append(straight)
+
+        for instr in self._content:
+            for arg_index in xrange(1, len(instr)):
+                arg = instr[arg_index]
+                if arg[0] == VAR:
+                    instr[arg_index] = VAR, new_indexes[arg[1]]
+        self._real_vars_indexes = [new_indexes[index]
+                                   for index in self._real_vars_indexes
+                                   if index in outputs]
+        self._vars_storage = new_storage
+        self._vars_map = None
+        self._values = None
+
+
+def is_replaced_item(straight):
+    # Whether the straight reference is an element of a list that is
+    # replaced in the loop. The list is saved after the loop as a new
+    # object, so all its elements are needed.
+    return straight[0] == ITEM and straight[1][2] is not None
+
+
+CONTROL_OPERATIONS = (
+    LOOP, END, IF, ELSE, ENDIF, PHASES, NEXT_PHASE, END_PHASES,
+)
+
+
+def iter_assignments(instr):
+    # Yields pairs of an index of a variable changed by the matcode
+    # instruction and a list of indexes of variables read to calculate
+    # its new value
+    oper = instr[0]
+    if oper in CONTROL_OPERATIONS:
+        return
+    if oper == STEP:
+        for index in xrange(1, len(instr), 3):
+            dest, src = instr[index:index + 2]
+            yield dest[1], [src[1]] if src[0] == VAR else []
+        return
+    dest, src = instr[1], instr[2]
+    reads = [src[1]] if src[0] == VAR else []
+    if oper != MOV:
+        reads.append(dest[1])
+    yield dest[1], reads
+
+
+BLOCK_OPENING_OPERATIONS = (LOOP, IF, PHASES)
+BLOCK_CLOSING_OPERATIONS = (END, ENDIF, END_PHASES)
+
+# Map from an operation closing a block with alternatives to operations
+# that open the block and separate the alternatives
+ALTERNATIVES_OPERATIONS = {
+    ENDIF: (IF, ELSE),
+    END_PHASES: (PHASES, NEXT_PHASE),
+}
+
+
+def find_block_start(content, index, start_oper):
+    # Find an instruction with operation start_oper that begins a block
+    # containing instruction content[index] (skipping nested blocks)
+    depth = 0
+    index -= 1
+    while True:
+        oper = content[index][0]
+        if not depth and oper == start_oper:
+            return index
+        if oper in BLOCK_CLOSING_OPERATIONS:
+            depth += 1
+        elif oper in BLOCK_OPENING_OPERATIONS:
+            depth -= 1
+        index -= 1
+
+
+def find_alternatives(content, end_index):
+    # Returns an index of an instruction opening a block which is closed
+    # by instruction content[end_index] and a list of ranges of its
+    # alternatives
+    start_oper, sep_oper = ALTERNATIVES_OPERATIONS[content[end_index][0]]
+    ranges = []
+    alt_end = end_index
+    depth = 0
+    index = end_index - 1
+    while True:
+        oper = content[index][0]
+        if not depth and oper in (start_oper, sep_oper):
+            ranges.append((index + 1, alt_end))
+            alt_end = index
+            if oper == start_oper:
+                return index, ranges
+        if oper in BLOCK_CLOSING_OPERATIONS:
+            depth += 1
+        elif oper in BLOCK_OPENING_OPERATIONS:
+            depth -= 1
+        index -= 1
+
+
+def propagate_liveness(content, begin, end, live, live_after):
+    # Propagate a set of live variables backward through instructions
+    # content[begin:end] and add variables that are live after every
+    # instruction to live_after. Returns a set of variables live before
+    # content[begin].
+
+    index = end - 1
+    while index >= begin:
+        instr = content[index]
+        if instr[0] == END:
+            loop_index = find_block_start(content, index, LOOP)
+
+            # The end of the loop's body is followed by its beginning
+            # or by the code after the loop
+            body_live = set(live)
+            while True:
+                entry_live = propagate_liveness(
+                    content, loop_index + 1, index, set(body_live),
+                    live_after,
+                )
+                if entry_live <= body_live:
+                    break
+                body_live |= entry_live
+            live |= entry_live
+            index = loop_index - 1
+            continue
+        if instr[0] in ALTERNATIVES_OPERATIONS:
+            # Values are live before the block if they are live before
+            # any of its alternatives (branches or phases)
+            start_index, ranges = find_alternatives(content, index)
+            entry_live = set()
+            for alt_begin, alt_end in ranges:
+                entry_live |= propagate_liveness(
+                    content, alt_begin, alt_end, set(live), live_after,
+                )
+            live = entry_live
+            index = start_index - 1
+            continue
 
-    def store_var(self, straight, unified):
-        self._vars_map[straight][1] = unified
+        live_after[index] |= live
+        # All assignments in the instruction are performed simultaneously
+        changed = set()
+        reads = set()
+        for dest, srcs in iter_assignments(instr):
+            changed.add(dest)
+            if dest in live:
+                reads.update(srcs)
+        live -= changed
+        live |= reads
+        index -= 1
+    return live
+
+
+def remove_dead_stores(instr, live):
+    # Remove assignments to variables that aren't live after the
+    # instruction. Returns None if the instruction becomes useless.
+    oper = instr[0]
+    if oper in CONTROL_OPERATIONS:
+        return instr
+    if oper == STEP:
+        args = []
+        for index in xrange(1, len(instr), 3):
+            if instr[index][1] in live:
+                args += instr[index:index + 3]
+        return [STEP] + args if args else None
+    return instr if instr[1][1] in live else None
 
 
 def handle_nop(state, instr):
@@ -162,22 +758,8 @@ def handle_pop_top(state, instr):
 
 def create_rot(count):
     def handle_rot(state, instr):
-        for index in xrange(-1, count - 1):
-            if state.stack[-index - 2] is None:
-                state.append(
-                    [MOV, (TOS, index), (TOS, index + 1)],
-                )
-        if state.stack[-1] is None:
-            state.append(
-                [MOV, (TOS, count - 1), (TOS, -1)],
-            )
-        if state.settings['opt_clear_stack']:
-            # Stack clearing is busy because program will works
-            # slower if big values will remains on the stack
-            state.append(
-                [MOV, (TOS, -1), (VALUE, 0)],
-            )
-
+        if len(state.stack) < count:
+            raise IndexError
         state.stack[-count:] = (
             [state.stack[-1]] + state.stack[-count:-1]
         )
@@ -186,12 +768,8 @@ def create_rot(count):
 
 def create_dup(count):
     def handle_dup(state, instr):
-        for index in xrange(count):
-            if state.stack[-count + index] is None:
-                state.append(
-                    [MOV, (TOS, index - count), (TOS, index)],
-                )
-
+        if len(state.stack) < count:
+            raise IndexError
         state.stack += state.stack[-count:]
     return handle_dup
 
@@ -201,191 +779,529 @@ def handle_dup_topx(state, instr):
 
 
 def handle_unary_negative(state, instr):
-    if state.stack[-1] is not None:
-        state.stack[-1].append(instr)
+    state.stack[-1] = -state.stack[-1]
+
+
+# Map from an operation to a function that calculates its result
+# during the recompilation if all operands are known
+KNOWN_OPERATIONS = {
+    byteplay.UNARY_NOT: operator.not_,
+    byteplay.UNARY_INVERT: operator.invert,
+    byteplay.BINARY_POWER: operator.pow,
+    byteplay.BINARY_DIVIDE: operator.div,
+    byteplay.BINARY_FLOOR_DIVIDE: operator.floordiv,
+    byteplay.BINARY_TRUE_DIVIDE: operator.truediv,
+    byteplay.BINARY_MODULO: operator.mod,
+    byteplay.BINARY_LSHIFT: operator.lshift,
+    byteplay.BINARY_RSHIFT: operator.rshift,
+    byteplay.BINARY_AND: operator.and_,
+    byteplay.BINARY_XOR: operator.xor,
+    byteplay.BINARY_OR: operator.or_,
+}
+for oper, func in KNOWN_OPERATIONS.items():
+    if str(oper).startswith('BINARY_'):
+        inplace_name = 'INPLACE_' + str(oper)[len('BINARY_'):]
+        KNOWN_OPERATIONS[getattr(byteplay, inplace_name)] = func
+
+KNOWN_COMPARISONS = {
+    '<': operator.lt, '<=': operator.le,
+    '==': operator.eq, '!=': operator.ne,
+    '>': operator.gt, '>=': operator.ge,
+}
+
+
+def evaluate_known(instr, *args):
+    # Returns a list with the result of the instruction if it can be
+    # calculated during the recompilation (otherwise returns None)
+    oper, arg = instr
+    if oper == byteplay.COMPARE_OP:
+        func = KNOWN_COMPARISONS.get(arg)
     else:
-        state.append(
-            [MOV, (TOS, -1), (TOS, 0)],
-            [MOV, (TOS, 0), (VALUE, 0)],
-            [SUB, (TOS, 0), (TOS, -1)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, -1), (VALUE, 0)],
-            )
+        func = KNOWN_OPERATIONS.get(oper)
+    if func is None or any(is_folded(elem) for elem in args):
+        return None
+    try:
+        return [func(*args)]
+    except Exception:
+        # The error will be raised in the run-time (if the instruction
+        # is really executed)
+        return None
 
 
 def handle_unary_const(state, instr):
-    if state.stack[-1] is not None:
-        state.stack[-1].append(instr)
-    else:
+    form = state.stack[-1]
+    if not form.is_const():
         raise UnpredictableArgsError
+    coeff = form.const_coeff()
+    known = evaluate_known(instr, coeff)
+    state.stack[-1] = LinearForm.const(
+        known[0] if known is not None else coeff_lines(coeff) + [instr],
+    )
 
 
-def handle_binary_multiply(state, instr):
-    if state.stack[-2] is not None and state.stack[-1] is not None:
-        state.stack[-2] += state.stack[-1] + [instr]
-        state.stack.pop()
-    elif state.stack[-2] is not None:
-        state.append(
-            [MUL, (TOS, 0), (FOLD_TOS, 1)],
-            [MOV, (TOS, 1), (TOS, 0)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, 0), (VALUE, 0)],
-            )
+def lift_key(state, power, key):
+    # Returns a key of the product of the counter value (at the beginning
+    # of the iteration) raised to the power and the value of the key.
+    # Such products are maintained as separate "lifted" variables. After
+    # every iteration they are updated according to the binomial theorem.
+
+    if key == state.counter_key:
+        power += 1
+        key = UNIT_KEY
+    elif key[0] == LIFTED:
+        lower, key = key[1]
+        power += lower
+    if not power:
+        return key
+    if power == 1 and key == UNIT_KEY:
+        return state.counter_key
+    if power > state.settings['max_degree']:
+        raise RecompilationError((
+            'Degree of a polynomial of the counter is more than %s'
+        ) % state.settings['max_degree'], state, 'polynomial_degree')
+    lifted = LIFTED, (power, key)
+    state.add_lifted(lifted)
+    return lifted
 
-        state.stack[-2] = None
-        state.stack.pop()
-    elif state.stack[-1] is not None:
-        state.append(
-            [MUL, (TOS, 1), (FOLD_TOS, 0)],
-        )
 
-        state.stack.pop()
-    else:
-        raise RecompilationError((
-            'Multiplication of two unpredictable values is unsupported'
-        ), state)
+def lift_form(state, power, form):
+    # Multiply the form by the counter value raised to the power
+    return LinearForm(dict((lift_key(state, power, key), coeff)
+                           for key, coeff in form.coeffs.iteritems()))
 
 
-def handle_binary_add(state, instr):
-    if state.stack[-2] is not None and state.stack[-1] is not None:
-        state.stack[-2] += state.stack[-1] + [instr]
-        state.stack.pop()
-    elif state.stack[-2] is not None:
-        state.append(
-            [ADD, (TOS, 0), (FOLD_TOS, 1)],
-            [MOV, (TOS, 1), (TOS, 0)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, 0), (VALUE, 0)],
-            )
+def counter_power(state, key):
+    # Returns a power of the counter if the key refers to it (or None)
+    if key == UNIT_KEY:
+        return 0
+    if key == state.counter_key:
+        return 1
+    if key[0] == LIFTED and key[1][1] == UNIT_KEY:
+        return key[1][0]
+    return None
 
-        state.stack[-2] = None
-        state.stack.pop()
-    elif state.stack[-1] is not None:
-        state.append(
-            [ADD, (TOS, 1), (FOLD_TOS, 0)],
-        )
 
-        state.stack.pop()
-    else:
-        state.append(
-            [ADD, (TOS, 1), (TOS, 0)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, 0), (VALUE, 0)],
-            )
+def is_polynomial(state, form):
+    return all(counter_power(state, key) is not None for key in form.coeffs)
 
-        state.stack.pop()
 
+def multiply_forms(state, first, second):
+    if first.is_const():
+        return second.scaled(first.const_coeff())
+    if second.is_const():
+        return first.scaled(second.const_coeff())
 
-def handle_binary_subtract(state, instr):
-    if state.stack[-2] is not None and state.stack[-1] is not None:
-        state.stack[-2] += state.stack[-1] + [instr]
-        state.stack.pop()
-    elif state.stack[-2] is not None:
-        state.append(
-            [SUB, (TOS, 0), (FOLD_TOS, 1)],
-            [MOV, (TOS, 1), (VALUE, 0)],
-            [SUB, (TOS, 1), (TOS, 0)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, 0), (VALUE, 0)],
-            )
+    # The product is still linear if one of the factors is a polynomial
+    # of the counter
+    if not is_polynomial(state, first):
+        first, second = second, first
+    if not is_polynomial(state, first):
+        raise RecompilationError((
+            'Multiplication of two unpredictable values is unsupported'
+        ), state, 'unpredictable_operands')
+    res = LinearForm({})
+    for key, coeff in first.coeffs.iteritems():
+        res += lift_form(
+            state, counter_power(state, key), second,
+        ).scaled(coeff)
+    return res
 
-        state.stack[-2] = None
-        state.stack.pop()
-    elif state.stack[-1] is not None:
-        state.append(
-            [SUB, (TOS, 1), (FOLD_TOS, 0)],
-        )
 
-        state.stack.pop()
-    else:
-        state.append(
-            [SUB, (TOS, 1), (TOS, 0)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, 0), (VALUE, 0)],
-            )
+def handle_binary_multiply(state, instr):
+    first, second = state.stack[-2:]
+    if isinstance(second, ListRef):
+        first, second = second, first
+    if isinstance(first, ListRef):
+        # Repetition of a list
+        count = second.const_coeff()
+        if not (
+            second.is_const() and
+            not is_folded(count) and isinstance(count, (int, long))
+        ):
+            raise RecompilationError((
+                'Length of a list created in the loop must be known '
+                'during the recompilation'
+            ), state, 'lists')
+        forms = [state.load_var(first.item_key(index))
+                 for index in xrange(first.length)]
+        state.stack[-2:] = [state.new_list(forms * count)]
+        return
+    state.stack[-2:] = [multiply_forms(state, first, second)]
+
+
+def handle_binary_power(state, instr):
+    first, second = state.stack[-2:]
+    exponent = second.const_coeff()
+    if (
+        first.is_const() or not second.is_const() or
+        is_folded(exponent) or not isinstance(exponent, (int, long)) or
+        exponent < 0
+    ):
+        handle_binary_const(state, instr)
+        return
+
+    res = LinearForm.const(1)
+    for index in xrange(exponent):
+        res = multiply_forms(state, res, first)
+    state.stack[-2:] = [res]
+
+
+def handle_binary_add(state, instr):
+    first, second = state.stack[-2:]
+    state.stack[-2:] = [first + second]
+
 
-        state.stack.pop()
+def handle_binary_subtract(state, instr):
+    first, second = state.stack[-2:]
+    state.stack[-2:] = [first - second]
 
 
 def handle_binary_const(state, instr):
-    if state.stack[-2] is not None and state.stack[-1] is not None:
-        state.stack[-2] += state.stack[-1] + [instr]
-        state.stack.pop()
+    first, second = state.stack[-2:]
+    if not (first.is_const() and second.is_const()):
+        raise UnpredictableArgsError
+    first_coeff = first.const_coeff()
+    second_coeff = second.const_coeff()
+    known = evaluate_known(instr, first_coeff, second_coeff)
+    if known is not None:
+        res = known[0]
     else:
+        res = coeff_lines(first_coeff) + coeff_lines(second_coeff) + [instr]
+    state.stack[-2:] = [LinearForm.const(res)]
+
+
+# Maximal period of the counter values modulo constants
+MAX_PERIOD = 32
+
+
+def handle_binary_modulo(state, instr):
+    first, second = state.stack[-2:]
+    if first.is_const():
+        handle_binary_const(state, instr)
+        return
+
+    # A remainder of the counter (or a linear function of it) can be found
+    # if the body is recompiled for every value of the counter modulo a
+    # small constant
+    counter_key = state.counter_key
+    factor = first.coeffs.get(counter_key)
+    divisor = second.const_coeff()
+    if not (
+        second.is_const() and
+        not is_folded(divisor) and isinstance(divisor, (int, long)) and
+        0 < abs(divisor) <= MAX_PERIOD and
+        factor is not None and not is_folded(factor) and
+        all(key in (counter_key, UNIT_KEY) for key in first.coeffs)
+    ):
         raise UnpredictableArgsError
 
+    period = abs(divisor)
+    cur_period = state.hints['period']
+    if cur_period is None or cur_period % period != 0:
+        common_period = cur_period or 1
+        common_period *= period // gcd(common_period, period)
+        if common_period > MAX_PERIOD:
+            raise RecompilationError((
+                'Period of remainders of the counter is more than %s'
+            ) % MAX_PERIOD, state, 'counter_period')
+        state.hints['period'] = common_period
+        raise RecompileAgainError
+
+    # The counter is congruent to the phase modulo the period
+    dividend = (
+        LinearForm.const(factor * state.phase) +
+        LinearForm.const(first.const_coeff())
+    ).const_coeff()
+    if is_folded(dividend):
+        res = dividend + [(byteplay.LOAD_CONST, divisor), instr]
+    else:
+        res = dividend % divisor
+    state.stack[-2:] = [LinearForm.const(res)]
+
 
 def handle_load_const(state, instr):
     arg = instr[1]
+    if isinstance(arg, tuple):
+        # Tuples of constants are made by the peephole optimizer of
+        # CPython (e.g. in "a, b, c, d = 0, 0, 0, 1")
+        for elem in arg:
+            handle_load_const(state, (instr[0], elem))
+        handle_build_tuple(state, (byteplay.BUILD_TUPLE, len(arg)))
+        return
     if not isinstance(arg, state.settings['types']):
         allowed_types = ', '.join(map(repr, state.settings['types']))
         raise RecompilationError((
             'Constant %s has an unallowed type %s instead of ' +
             'one of allowed types: %s'
-        ) % (repr(arg), type(arg), allowed_types), state)
-    state.stack.append([instr])
+        ) % (repr(arg), type(arg), allowed_types), state, 'unallowed_type')
+    state.stack.append(LinearForm.const(arg))
 
 
 def handle_load_var(state, instr):
     oper, name = instr
     straight = VARIABLE_TYPE_MAP[oper][0], name
-    unified = state.load_var(straight)
-    if unified[0] == CONST:
-        state.stack.append([
-            (byteplay.LOAD_FAST, state.real_folded_arr),
-            (byteplay.LOAD_CONST, unified[1]),
-            (byteplay.BINARY_SUBSCR, None),
-        ])
-    else:
-        state.append(
-            [MOV, (TOS, -1), straight],
-        )
-
-        state.stack.append(None)
+    state.stack.append(state.load_var(straight))
 
 
 def handle_store_var(state, instr):
     oper, name = instr
     straight = VARIABLE_TYPE_MAP[oper][0], name
-    lines = state.stack[-1]
-    if lines is not None:
-        if (
-            len(lines) == 3 and
-            lines[0] == (byteplay.LOAD_FAST, state.real_folded_arr) and
-            lines[1][0] == byteplay.LOAD_CONST and
-            isinstance(lines[1][1], int) and
-            lines[2] == (byteplay.BINARY_SUBSCR, None)
-        ):
-            const_ref = CONST, lines[1][1]
-        else:
-            const_ref = state.add_const((FOLD_TOS, 0))
-        state.append(
-            [MOV, straight, const_ref],
-        )
-        state.store_var(straight, const_ref)
+    state.store_var(straight, state.stack.pop())
+
+
+def folded_straight(value):
+    # Returns a straight reference of a variable (or of a chain of its
+    # attributes) if the value is its folded value (otherwise returns
+    # None)
+
+    if not isinstance(value, LinearForm) or not value.is_const():
+        return None
+    lines = value.const_coeff()
+    if not is_folded(lines):
+        return None
+    oper, name = lines[0]
+    if oper not in VARIABLE_TYPE_MAP or VARIABLE_TYPE_MAP[oper][1]:
+        return None
+    straight = VARIABLE_TYPE_MAP[oper][0], name
+    attrs = []
+    for attr_oper, attr_name in lines[1:]:
+        if attr_oper != byteplay.LOAD_ATTR:
+            return None
+        attrs.append(attr_name)
+    if attrs:
+        return ATTR, (straight, tuple(attrs))
+    return straight
+
+
+def attr_straight(state, obj, name):
+    # Make a straight reference of an attribute that is changed in the
+    # loop. The object must be a value of a variable (or of a chain of
+    # its attributes) that isn't changed in the loop.
+
+    straight = folded_straight(obj)
+    if straight is None:
+        raise RecompilationError((
+            'Object with attribute "%s" changed in the loop must be stored '
+            'in a variable that is not changed in the loop'
+        ) % name, state, 'attributes')
+    if straight[0] == ATTR:
+        var_straight, attrs = straight[1]
+        return ATTR, (var_straight, attrs + (name,))
+    return ATTR, (straight, (name,))
+
+
+def handle_load_attr(state, instr):
+    name = instr[1]
+    if name not in state.stored_attrs:
+        # The attribute isn't changed in the loop, so its value can be
+        # folded
+        handle_unary_const(state, instr)
+        return
+    straight = attr_straight(state, state.stack[-1], name)
+    if straight not in state.hints['lists']:
+        state.add_var(straight)
+    state.stack[-1] = state.load_var(straight)
+
+
+def handle_store_attr(state, instr):
+    straight = attr_straight(state, state.stack.pop(), instr[1])
+    value = state.stack.pop()
+    if straight not in state.hints['lists'] and not isinstance(value, ListRef):
+        state.add_var(straight)
+    state.store_var(straight, value)
+
+
+def handle_build_list(state, instr):
+    count = instr[1]
+    if len(state.stack) < count:
+        raise IndexError
+    begin = len(state.stack) - count
+    ref = state.new_list(state.stack[begin:])
+    state.stack[begin:] = [ref]
+
+
+def handle_build_tuple(state, instr):
+    count = instr[1]
+    if len(state.stack) < count:
+        raise IndexError
+    begin = len(state.stack) - count
+    state.stack[begin:] = [TupleValue(tuple(state.stack[begin:]))]
+
+
+def handle_unpack_sequence(state, instr):
+    # Unpacking of a tuple made in the body is a permutation of the stack
+    # slots. Lists changed in the loop can be unpacked if their length is
+    # known.
+    count = instr[1]
+    value = state.stack[-1]
+    if isinstance(value, TupleValue):
+        items = value.items
+    elif isinstance(value, ListRef) and value.length is not None:
+        items = [state.load_var(value.item_key(index))
+                 for index in xrange(value.length)]
     else:
-        state.append(
-            [MOV, straight, (TOS, 0)],
-        )
-        if state.settings['opt_clear_stack']:
-            state.append(
-                [MOV, (TOS, 0), (VALUE, 0)],
-            )
-        state.store_var(straight, straight)
+        error = RecompilationError((
+            'Only tuples and lists of known length can be unpacked'
+        ), state, 'unsupported_value')
+        if not may_become_list(value, None):
+            raise error
+        state.deferred_errors.append(error)
+        state.stack[-1:] = [LinearForm.const(0)] * count
+        return
+    if len(items) != count:
+        raise RecompilationError((
+            'Unpacking of %s values to %s variables'
+        ) % (len(items), count), state, 'unsupported_value')
+    state.stack[-1:] = items[::-1]
+
+
+def may_become_list(container, index):
+    # Whether the container can turn out to be a list changed in the loop
+    # (it will be found out when the list is stored). Then an error of
+    # its usage is raised only after the recompilation of the whole body.
+    if not isinstance(container, LinearForm):
+        return False
+    if folded_straight(container) is not None:
+        return not (isinstance(index, LinearForm) and index.is_const())
+    return (
+        len(container.coeffs) == 1 and container.coeffs.values() == [1] and
+        container.coeffs.keys()[0][0] in (NAME, GLOBAL, FAST, DEREF, ATTR)
+    )
+
+
+def handle_binary_subscr(state, instr):
+    container, index = state.stack[-2:]
+    ref = state.list_ref(container)
+    if ref is None:
+        if may_become_list(container, index):
+            state.deferred_errors.append(unpredictable_args_error(state, instr))
+            state.stack[-2:] = [LinearForm.const(0)]
+            return
+        handle_binary_const(state, instr)
+        return
+    state.stack[-2:] = [state.load_var(state.item_key(ref, index))]
+
+
+def handle_store_subscr(state, instr):
+    value, container, index = state.stack[-3:]
+    del state.stack[-3:]
+    ref = state.list_ref(container)
+    if ref is None and folded_straight(container) is None and \
+            may_become_list(container, index):
+        state.deferred_errors.append(unpredictable_args_error(state, instr))
+        return
+    if ref is None:
+        straight = folded_straight(container)
+        if straight is None:
+            raise RecompilationError((
+                'List changed in the loop must be stored in a variable'
+            ), state, 'lists')
+        # The list isn't replaced in the loop and is changed in place
+        state.hints['inplace_lists'].add(straight)
+        raise RecompileAgainError
+    if not isinstance(value, LinearForm):
+        raise RecompilationError('Nested lists are unsupported', state, 'lists')
+    if ref.obj[0] is not None and ref.length is not None:
+        # Variables could contain the same list before the iteration
+        raise RecompilationError((
+            'Lists replaced in the loop can be changed in place only in '
+            'the iteration when they were created'
+        ), state, 'lists')
+    state.store_var(state.item_key(ref, index), value)
+
+
+# Functions making ranges that can be unrolled in inner loops
+RANGE_FUNCTIONS = 'xrange', 'range'
+# Maximal number of iterations of an unrolled inner loop
+MAX_UNROLLED_ITERATIONS = 256
+
+
+def handle_pure_call(state, instr, func, args):
+    # A call of a function declared pure (see `hook.PURE_FUNCS`) with
+    # arguments that aren't changed in the loop is folded. Returns False
+    # if the call can't be folded.
+
+    straight = folded_straight(func)
+    if not (
+        straight is not None and
+        hook.may_be_pure_callee(state.settings, straight) and
+        all(isinstance(arg, LinearForm) and arg.is_const() for arg in args)
+    ):
+        return False
+    for arg in args:
+        if folded_straight(arg) in state.hints['inplace_lists']:
+            raise RecompilationError((
+                'List changed in the loop can\'t be passed to pure '
+                'function "%s"'
+            ) % var_repr(straight), state, 'lists')
+
+    lines = list(func.const_coeff())
+    for arg in args:
+        lines += coeff_lines(arg.const_coeff())
+    lines.append(instr)
+    if (straight, None) not in state.pure_callees:
+        state.pure_callees.append((straight, None))
+    state.stack[-len(args) - 1:] = [LinearForm.const(lines)]
+    return True
+
+
+def handle_call_function(state, instr):
+    argc = instr[1]
+    if len(state.stack) < argc + 1:
+        raise IndexError
+    func = state.stack[-argc - 1]
+    args = state.stack[len(state.stack) - argc:]
+    if handle_pure_call(state, instr, func, args):
+        return
+
+    func_lines = None
+    if isinstance(func, LinearForm) and func.is_const():
+        func_lines = func.const_coeff()
+    if not (
+        is_folded(func_lines) and len(func_lines) == 1 and
+        func_lines[0][0] in (byteplay.LOAD_GLOBAL, byteplay.LOAD_NAME) and
+        func_lines[0][1] in RANGE_FUNCTIONS and 1 <= argc <= 3
+    ):
+        raise RecompilationError('Unsupported instruction %s' % repr(instr),
+                                 state, 'unsupported_instruction')
+
+    # Loops over ranges with known arguments are unrolled
+    values = []
+    for arg in args:
+        value = arg.const_coeff()
+        if not (
+            arg.is_const() and
+            not is_folded(value) and isinstance(value, (int, long))
+        ):
+            raise RecompilationError((
+                'Arguments of %s in the loop must be known during the '
+                'recompilation (e.g. literals)'
+            ) % func_lines[0][1], state, 'inner_loop')
+        values.append(value)
+    try:
+        if len(xrange(*values)) > MAX_UNROLLED_ITERATIONS:
+            raise RecompilationError((
+                'Inner loop has more than %s iterations'
+            ) % MAX_UNROLLED_ITERATIONS, state, 'inner_loop')
+    except (ValueError, OverflowError):
+        raise RecompilationError((
+            'Invalid arguments of %s in the loop'
+        ) % func_lines[0][1], state, 'inner_loop')
+    state.stack[-argc - 1:] = [RangeIterator(tuple(xrange(*values)), 0)]
+
+
+def handle_get_iter(state, instr):
+    if not isinstance(state.stack[-1], RangeIterator):
+        raise RecompilationError('Unsupported inner loop type',
+                                 state, 'inner_loop')
 
-    state.stack.pop()
+
+def handle_setup_loop(state, instr):
+    state.blocks += ((instr[1], len(state.stack)),)
+
+
+def handle_pop_block(state, instr):
+    state.blocks = state.blocks[:-1]
 
 
 LOAD_OPERATIONS, STORE_OPERATIONS = zip(*VARIABLE_OPERATION_MAP.values())
@@ -403,12 +1319,13 @@ BYTECODE_HANDLERS = [
         byteplay.UNARY_NOT, byteplay.UNARY_INVERT,
     ]),
 
-    (handle_binary_const, [byteplay.BINARY_POWER]),
+    (handle_binary_power, [byteplay.BINARY_POWER]),
     (handle_binary_multiply, [byteplay.BINARY_MULTIPLY]),
     (handle_binary_const, [
         byteplay.BINARY_DIVIDE, byteplay.BINARY_FLOOR_DIVIDE,
-        byteplay.BINARY_TRUE_DIVIDE, byteplay.BINARY_MODULO,
+        byteplay.BINARY_TRUE_DIVIDE,
     ]),
+    (handle_binary_modulo, [byteplay.BINARY_MODULO]),
     (handle_binary_add, [byteplay.BINARY_ADD]),
     (handle_binary_subtract, [byteplay.BINARY_SUBTRACT]),
     (handle_binary_const, [
@@ -416,12 +1333,13 @@ BYTECODE_HANDLERS = [
         byteplay.BINARY_AND, byteplay.BINARY_XOR, byteplay.BINARY_OR,
     ]),
 
-    (handle_binary_const, [byteplay.INPLACE_POWER]),
+    (handle_binary_power, [byteplay.INPLACE_POWER]),
     (handle_binary_multiply, [byteplay.INPLACE_MULTIPLY]),
     (handle_binary_const, [
         byteplay.INPLACE_DIVIDE, byteplay.INPLACE_FLOOR_DIVIDE,
-        byteplay.INPLACE_TRUE_DIVIDE, byteplay.INPLACE_MODULO,
+        byteplay.INPLACE_TRUE_DIVIDE,
     ]),
+    (handle_binary_modulo, [byteplay.INPLACE_MODULO]),
     (handle_binary_add, [byteplay.INPLACE_ADD]),
     (handle_binary_subtract, [byteplay.INPLACE_SUBTRACT]),
     (handle_binary_const, [
@@ -429,10 +1347,24 @@ BYTECODE_HANDLERS = [
         byteplay.INPLACE_AND, byteplay.INPLACE_XOR, byteplay.INPLACE_OR,
     ]),
 
+    (handle_binary_const, [byteplay.COMPARE_OP]),
+
     (handle_dup_topx, [byteplay.DUP_TOPX]),
     (handle_load_const, [byteplay.LOAD_CONST]),
     (handle_load_var, LOAD_OPERATIONS),
     (handle_store_var, STORE_OPERATIONS),
+    (handle_load_attr, [byteplay.LOAD_ATTR]),
+    (handle_store_attr, [byteplay.STORE_ATTR]),
+
+    (handle_build_list, [byteplay.BUILD_LIST]),
+    (handle_build_tuple, [byteplay.BUILD_TUPLE]),
+    (handle_unpack_sequence, [byteplay.UNPACK_SEQUENCE]),
+    (handle_binary_subscr, [byteplay.BINARY_SUBSCR]),
+    (handle_store_subscr, [byteplay.STORE_SUBSCR]),
+    (handle_call_function, [byteplay.CALL_FUNCTION]),
+    (handle_get_iter, [byteplay.GET_ITER]),
+    (handle_setup_loop, [byteplay.SETUP_LOOP]),
+    (handle_pop_block, [byteplay.POP_BLOCK]),
 ]
 
 SUPPORTED_OPERATIONS = {}
@@ -441,13 +1373,232 @@ for handler, opers in BYTECODE_HANDLERS:
         SUPPORTED_OPERATIONS[oper] = handler
 
 
+# Map from a conditional jump operation to a tuple of flags: whether the
+# jump is performed if the condition is true, whether the condition is
+# popped if the jump is performed and whether it's popped otherwise
+CONDITIONAL_JUMPS = {}
+if hasattr(byteplay, 'POP_JUMP_IF_FALSE'):
+    CONDITIONAL_JUMPS.update({
+        byteplay.POP_JUMP_IF_FALSE: (False, True, True),
+        byteplay.POP_JUMP_IF_TRUE: (True, True, True),
+        byteplay.JUMP_IF_FALSE_OR_POP: (False, False, True),
+        byteplay.JUMP_IF_TRUE_OR_POP: (True, False, True),
+    })
+else:
+    # Python < 2.7
+    CONDITIONAL_JUMPS.update({
+        byteplay.JUMP_IF_FALSE: (False, False, False),
+        byteplay.JUMP_IF_TRUE: (True, False, False),
+    })
+
+UNCONDITIONAL_JUMPS = (byteplay.JUMP_ABSOLUTE, byteplay.JUMP_FORWARD)
+
+# Maximal number of paths through a loop's body with different outcomes
+# of the branches
+MAX_BODY_PATHS = 64
+
+
+class BodyWalker(object):
+    # Recompiles all paths through a loop's body. Conditions of the
+    # branches must be constant during the loop, so their values can be
+    # calculated once before it. The matcode for different outcomes is
+    # placed to conditional blocks.
+
+    def __init__(self, state, body):
+        self._state = state
+        self._body = body
+        self._labels = {}
+        for index, (oper, arg) in enumerate(body):
+            if isinstance(oper, byteplay.Label):
+                self._labels[oper] = index
+        self._paths_count = 0
+
+    def _jump_target(self, label):
+        if label is self._state.settings['head_label']:
+            # Jump to the next iteration
+            return len(self._body)
+        try:
+            return self._labels[label]
+        except KeyError:
+            raise RecompilationError('Unsupported jump outside the loop',
+                                     self._state, 'unsupported_jump')
+
+    def walk(self, index, decisions):
+        # Recompile the body from instruction with the specified index.
+        # "decisions" is a list of pairs of conditions and their values
+        # in the current path.
+
+        state = self._state
+        body = self._body
+        while index < len(body):
+            instr = body[index]
+            oper = instr[0]
+            if isinstance(oper, byteplay.Label):
+                index += 1
+                continue
+            if oper == byteplay.SetLineno:
+                state.lineno = instr[1]
+                index += 1
+                continue
+            state.instr = instr
+            if oper in UNCONDITIONAL_JUMPS:
+                index = self._jump_target(instr[1])
+                continue
+            if oper in CONDITIONAL_JUMPS:
+                self._walk_branch(index, decisions)
+                return
+            if oper == byteplay.FOR_ITER:
+                index = self._next_item(index)
+                continue
+            if oper == byteplay.BREAK_LOOP and state.blocks:
+                label, stack_size = state.blocks[-1]
+                del state.stack[stack_size:]
+                state.blocks = state.blocks[:-1]
+                index = self._jump_target(label)
+                continue
+
+            try:
+                SUPPORTED_OPERATIONS[oper](state, instr)
+            except UnpredictableArgsError:
+                raise unpredictable_args_error(state, instr)
+            except IndexError:
+                raise RecompilationError('Unsupported loop type or invalid stack usage in bytecode',
+                                         state, 'unsupported_instruction')
+            except KeyError:
+                raise RecompilationError('Unsupported instruction %s' % repr(instr),
+                                         state, 'unsupported_instruction')
+            index += 1
+
+        state.instr = None
+        self._paths_count += 1
+        if self._paths_count > MAX_BODY_PATHS:
+            raise RecompilationError((
+                'Too many combinations of branches (more than %s)'
+            ) % MAX_BODY_PATHS, state, 'unpredictable_branch')
+        state.append_step()
+
+    def _next_item(self, index):
+        # Unroll an iteration of an inner loop. Returns an index of the
+        # next instruction.
+        state = self._state
+        iterator = state.stack[-1] if state.stack else None
+        if not isinstance(iterator, RangeIterator):
+            raise RecompilationError('Unsupported inner loop type',
+                                     state, 'inner_loop')
+        if iterator.position == len(iterator.values):
+            state.stack.pop()
+            return self._jump_target(self._body[index][1])
+        state.stack[-1] = RangeIterator(iterator.values,
+                                        iterator.position + 1)
+        state.stack.append(LinearForm.const(
+            iterator.values[iterator.position]))
+        return index + 1
+
+    def _walk_branch(self, index, decisions):
+        state = self._state
+        oper, label = self._body[index]
+        jump_if_true, pop_on_jump, pop_otherwise = CONDITIONAL_JUMPS[oper]
+
+        try:
+            cond = state.stack[-1]
+        except IndexError:
+            raise RecompilationError('Unsupported loop type or invalid stack usage in bytecode',
+                                     state, 'unsupported_instruction')
+        if not cond.is_const():
+            raise RecompilationError((
+                'Condition of a branch depends on values changed in the loop'
+            ), state, 'unpredictable_branch')
+        coeff = cond.const_coeff()
+
+        if not is_folded(coeff):
+            outcomes = [bool(coeff)]
+        else:
+            outcomes = [value for prev, value in decisions if prev == coeff][:1]
+        need_block = not outcomes
+        if need_block:
+            outcomes = [True, False]
+            state.append([IF, state.coeff_arg(coeff)])
+
+        saved = state.save()
+        for outcome in outcomes:
+            if need_block and not outcome:
+                state.append([ELSE])
+            state.restore(saved)
+
+            jump = outcome == jump_if_true
+            if pop_on_jump if jump else pop_otherwise:
+                state.stack.pop()
+            self.walk(
+                self._jump_target(label) if jump else index + 1,
+                decisions + [(coeff, outcome)],
+            )
+        if need_block:
+            state.append([ENDIF])
+
+
+def walk_phases(state, body):
+    # Every path through the loop's body is performed as one simultaneous
+    # assignment. If the body uses remainders of the counter modulo
+    # constants, it's recompiled separately for every phase (value of
+    # the counter modulo the period).
+
+    saved = state.save()
+    checkpoint = state.checkpoint()
+    period = state.hints['period']
+    while True:
+        lifted_count = len(state.lifted)
+        if period is None:
+            BodyWalker(state, body).walk(0, [])
+        else:
+            state.append([PHASES, (VALUE, period)])
+            for phase in xrange(period):
+                if phase:
+                    state.append([NEXT_PHASE])
+                state.restore(saved)
+                state.phase = phase
+                BodyWalker(state, body).walk(0, [])
+            state.append([END_PHASES])
+
+        # Lifted variables registered in some path must be updated in all
+        # paths, so the body is recompiled again
+        if len(state.lifted) == lifted_count:
+            return
+        state.rollback(checkpoint)
+        state.restore(saved)
+
+
+def append_lifted_update(state, loop_index):
+    # Initialize the lifted variables before the loop and update them
+    # before the counter increment (by the binomial theorem)
+    init_args = []
+    update_args = []
+    for lifted in state.lifted:
+        power, base = lifted[1]
+        init_args += [lifted, base, (PARAM, ('start', power))]
+        for lower in xrange(power + 1):
+            if lower == power:
+                coeff = VALUE, 1
+            else:
+                coeff = PARAM, ('shift', power, lower)
+            update_args += [lifted, lift_key(state, lower, base), coeff]
+    if init_args:
+        state.insert(loop_index, [STEP] + init_args)
+        state.append([STEP] + update_args)
+
+
 def browse_vars(state, body):
     # Browse used in loop's body variables to determine their mutability
 
+    lists = state.hints['lists']
+    for straight, length in sorted(lists.items()):
+        state.add_list_var(straight, length)
     for oper, arg in body:
+        if oper == byteplay.STORE_ATTR:
+            state.stored_attrs.add(arg)
         try:
             arg_type, mutation = VARIABLE_TYPE_MAP[oper]
-            state.add_var((arg_type, arg), mutation)
+            if mutation and (arg_type, arg) not in lists:
+                state.add_var((arg_type, arg))
         except KeyError:
             pass
 
@@ -461,30 +1612,51 @@ def browse_counter(state, body):
             raise KeyError
     except KeyError:
         raise RecompilationError((
-            'Unsupported iterator usage in instruction %s' % repr(instr)
-        ), state)
+            'Unsupported iterator usage in instruction %s' % repr(store_instr)
+        ), state, 'unsupported_instruction')
     load_instr = VARIABLE_OPERATION_MAP[arg_type][0], name
 
-    if state.settings['opt_min_rows']:
-        status = 'n'  # A loop counter was not used
-        for index in xrange(1, len(body)):
-            instr = body[index]
-            if instr == store_instr:
-                status = 'w'  # The counter was changed at least once
-                break
-            if instr == load_instr:
-                status = 'r'  # The counter was not changed but was read at least once
-    else:
+    status = 'n'  # A loop counter was not used
+    for index in xrange(1, len(body)):
+        instr = body[index]
+        if instr == store_instr:
+            status = 'w'  # The counter was changed at least once
+            break
+        if instr == load_instr:
+            status = 'r'  # The counter was not changed but was read at least once
+    if not state.settings['opt_min_rows'] and status == 'r':
         status = 'w'
     return (arg_type, name), status, body[1:]
 
 
 def recompile_body(settings, body):
-    state = RecompilerState(settings)
+    # Hints are facts about the loop's body that are found during the
+    # recompilation and affect the code generated before. Every time a
+    # new hint is found, the body is recompiled from scratch.
+    hints = {
+        # Period of remainders of the counter (see `handle_binary_modulo`)
+        'period': None,
+        # Map from straight references of variables containing lists of
+        # the same length in the loop to this length
+        'lists': {},
+        # Set of straight references of variables containing lists that
+        # are changed in place
+        'inplace_lists': set(),
+    }
+    while True:
+        try:
+            return recompile_with_hints(settings, body, hints)
+        except RecompileAgainError:
+            pass
+
+
+def recompile_with_hints(settings, body, hints):
+    state = RecompilerState(settings, hints)
 
     elem_straight, counter_status, rem_body = browse_counter(
         state, body,
     )
+    state.counter_status = counter_status
     if counter_status == 'w':
         # If real counter is mutable, we need special variable to
         # store real counter value
@@ -502,7 +1674,7 @@ def recompile_body(settings, body):
         # We must mark real counter as mutable at the beginning of the
         # loop, because first instruction (counter storing) was removed
         # from rem_body and system doesn't know that counter is mutable
-        state.add_var(elem_straight, True)
+        state.add_var(elem_straight)
         state.manual_store_counter = None
 
     browse_vars(state, rem_body)
@@ -511,30 +1683,20 @@ def recompile_body(settings, body):
         state.append(
             [MOV, counter_service, (PARAM, 'start')],
         )
+    loop_index = len(state.content)
     state.append(
         [LOOP, (PARAM, 'iters_count')],
     )
     if counter_status == 'w':
-        state.append(
-            [MOV, elem_straight, (COUNTER, None)],
-        )
-
-    for instr in rem_body:
-        oper = instr[0]
-        if oper == byteplay.SetLineno:
-            state.lineno = instr[1]
-            continue
-
-        try:
-            SUPPORTED_OPERATIONS[oper](state, instr)
-        except UnpredictableArgsError:
-            raise RecompilationError(('All operands of instruction %s must be a constant ' +
-                                      'or must have a predictable value') % oper, state)
-        except IndexError:
-            raise RecompilationError('Unsupported loop type or invalid stack usage in bytecode', state)
-        except KeyError:
-            raise RecompilationError('Unsupported instruction %s' % repr(instr), state)
+        state.add_var(counter_service)
+        state.store_var(elem_straight, LinearForm.var(counter_service))
 
+    if counter_status != 'n':
+        state.counter_key = counter_service
+    walk_phases(state, rem_body)
+    if state.deferred_errors:
+        raise state.deferred_errors[0]
+    append_lifted_update(state, loop_index)
     if counter_status != 'n':
         state.append(
             [ADD, counter_service, (PARAM, 'step')],
@@ -546,4 +1708,10 @@ def recompile_body(settings, body):
         state.append(
             [SUB, counter_service, (PARAM, 'step')],
         )
+
+    if settings['opt_dead_vars']:
+        if (state.manual_store_counter is not None and
+                not state.is_live(state.manual_store_counter)):
+            state.manual_store_counter = None
+        state.remove_dead_vars()
     return state
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import weakref
+from itertools import count
+
+
+COUNTER_STATUS_NAMES = {'n': 'unused', 'r': 'read', 'w': 'written'}
+
+# Outcomes of loop analysis
+OPTIMIZED = 'optimized'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def make_entry(settings, outcome, lineno, state=None, error=None):
+    # Make a report entry about the loop. Besides the outcome, it contains
+    # the reason of a failure or the parameters of the optimized loop.
+
+    entry = {
+        'function': settings['code_name'],
+        'filename': settings['code_filename'],
+        'lineno': lineno,
+        'outcome': outcome,
+        'instruction': None,
+        'category': None,
+        'reason': None,
+        'matrix_size': None,
+        'folded_consts': None,
+        'matcode_size': None,
+        'unoptimized_matcode_size': None,
+        'counter_status': None,
+    }
+    if error is not None:
+        entry['instruction'] = error.instruction
+        entry['category'] = error.category
+        entry['reason'] = error.reason
+        counter_status = error.counter_status
+    elif state is not None:
+        # A matrix contains a row for every variable and the unit row
+        entry['matrix_size'] = len(state.vars_storage) + 1
+        entry['folded_consts'] = len(state.consts)
+        entry['unoptimized_matcode_size'], entry['matcode_size'] = \
+            state.matcode_sizes
+        counter_status = state.counter_status
+    else:
+        counter_status = None
+    entry['counter_status'] = COUNTER_STATUS_NAMES.get(counter_status)
+    return entry
+
+
+# Lists of entries of all optimized functions and imported modules. The
+# map is from a registration number to a pair of a weak reference to the
+# function (None for modules) and the list, so reports of functions that
+# were garbage collected are removed.
+_reports = {}
+_reports_count = count()
+# The lock is reentrant because weak reference callbacks can be called
+# during the garbage collection at any moment
+_reports_lock = threading.RLock()
+
+
+def _remove_report(key):
+    with _reports_lock:
+        _reports.pop(key, None)
+
+
+def register_report(report, owner=None):
+    with _reports_lock:
+        key = next(_reports_count)
+        if owner is not None:
+            owner = weakref.ref(owner, lambda ref: _remove_report(key))
+        _reports[key] = owner, report
+
+
+def get_report(outcome=None):
+    # Returns copies of entries about all analyzed loops (optionally,
+    # only with the specified outcome)
+
+    with _reports_lock:
+        reports = [report for key, (owner, report) in sorted(_reports.items())]
+    return [dict(entry) for report in reports for entry in report
+            if outcome is None or entry['outcome'] == outcome]
+
+
+def dump_report(fp=None, outcome=None, **kwargs):
+    # Serialize the report to JSON. If a file object is passed, the report
+    # is written to it, otherwise the string is returned.
+
+    kwargs.setdefault('sort_keys', True)
+    report = get_report(outcome)
+    if fp is None:
+        return json.dumps(report, **kwargs)
+    json.dump(report, fp, **kwargs)
+
+
+def clear_report():
+    with _reports_lock:
+        _reports.clear()
@@ -1,10 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from itertools import izip
-
 from matcode import *
-from matrices import Matrix
+from matrices import ARITHMETIC, SEMIRINGS, BitMatrix, Matrix
 
 
 class InvalidMatcodeError(RuntimeError):
@@ -12,49 +10,97 @@ class InvalidMatcodeError(RuntimeError):
 
 
 def handle_mov(table, dest, src):
-    table[dest[1]][dest[1]] = 0
+    table[dest[1], dest[1]] = 0
     if src[0] == VALUE:
-        table[-1][dest[1]] = src[1]
+        table[-1, dest[1]] = src[1]
     else:
-        table[src[1]][dest[1]] = 1
+        table[src[1], dest[1]] = 1
 
 
 def handle_add(table, dest, src):
     if src[0] == VALUE:
-        table[-1][dest[1]] = src[1]
+        table[-1, dest[1]] = src[1]
     else:
-        table[src[1]][dest[1]] = 1
+        table[src[1], dest[1]] = 1
 
 
 def handle_sub(table, dest, src):
     if src[0] == VALUE:
-        table[-1][dest[1]] = -src[1]
+        table[-1, dest[1]] = -src[1]
     else:
-        table[src[1]][dest[1]] = -1
+        table[src[1], dest[1]] = -1
 
 
 def handle_mul(table, dest, src):
     if src[0] == VALUE:
-        table[dest[1]][dest[1]] = src[1]
+        table[dest[1], dest[1]] = src[1]
     else:
         raise InvalidMatcodeError
 
 
+def handle_step(table, *args):
+    if len(args) % 3 != 0:
+        raise InvalidMatcodeError
+    for index in xrange(0, len(args), 3):
+        dest = args[index]
+        table[dest[1], dest[1]] = 0
+    for index in xrange(0, len(args), 3):
+        dest, src, coeff = args[index:index + 3]
+        if dest[0] != VAR or coeff[0] != VALUE:
+            raise InvalidMatcodeError
+        if src[0] == UNIT:
+            table[-1, dest[1]] += coeff[1]
+        elif src[0] == VAR:
+            table[src[1], dest[1]] += coeff[1]
+        else:
+            raise InvalidMatcodeError
+
+
+def handle_semiring_step(table, *args):
+    # The same as "STEP", but sums and products are calculated in the
+    # semiring of the table
+    if len(args) % 3 != 0:
+        raise InvalidMatcodeError
+    semiring = table.semiring
+    for index in xrange(0, len(args), 3):
+        dest = args[index]
+        table[dest[1], dest[1]] = semiring.zero
+    for index in xrange(0, len(args), 3):
+        dest, src, coeff = args[index:index + 3]
+        if dest[0] != VAR or coeff[0] != VALUE:
+            raise InvalidMatcodeError
+        if src[0] == UNIT:
+            key = -1, dest[1]
+        elif src[0] == VAR:
+            key = src[1], dest[1]
+        else:
+            raise InvalidMatcodeError
+        table[key] = semiring.add(table[key], coeff[1])
+
+
 MATCODE_MAP = {
     MOV: handle_mov,
     ADD: handle_add,
     SUB: handle_sub,
     MUL: handle_mul,
+    STEP: handle_step,
+    SEMIRING_STEP: handle_semiring_step,
 }
 
 
+def get_semiring(settings):
+    # Loops over other semirings than the ordinary arithmetic are made
+    # with `semiring` option (see "semirings.py")
+    return SEMIRINGS[settings['semiring'] or ARITHMETIC.name]
+
+
 def skip_rows(mat):
     need_unit_row = False
     unskipped_indexes = []
     fix_mat = Matrix.identity(mat.rows)
     for index in xrange(mat.rows - 1):
-        cur_row = mat.content[index]
-        cur_col = [row[index] for row in mat.content]
+        cur_row = mat.row(index)
+        cur_col = mat.col(index)
 
         index_can_be_skipped = False
         prev_value_coeff = cur_col[index]
@@ -67,7 +113,7 @@ def skip_rows(mat):
         ):
             # If a new variable value is a constant
             if prev_value_coeff == 0:
-                handle_mov(fix_mat.content, (VAR, index), (VALUE, const_coeff))
+                handle_mov(fix_mat, (VAR, index), (VALUE, const_coeff))
                 index_can_be_skipped = True
             # Or the value wasn't changed
             elif prev_value_coeff == 1 and const_coeff == 0:
@@ -84,21 +130,22 @@ def skip_rows(mat):
     for y in unskipped_indexes:
         row = []
         for x in unskipped_indexes:
-            row.append(mat.content[y][x])
+            row.append(mat[y, x])
         lite_content.append(row)
     return Matrix(lite_content), unskipped_indexes, fix_mat
 
 
 def restore_rows(lite_mat, unskipped_indexes, fix_mat):
     mat = Matrix.identity(fix_mat.rows)
-    for y, row in izip(unskipped_indexes, lite_mat.content):
-        for x, elem in izip(unskipped_indexes, row):
-            mat.content[y][x] = elem
+    for lite_y, y in enumerate(unskipped_indexes):
+        for lite_x, x in enumerate(unskipped_indexes):
+            mat[y, x] = lite_mat[lite_y, lite_x]
     return mat * fix_mat
 
 
 def run_loop(settings, matcode, index, vector_len):
-    mat = Matrix.identity(vector_len)
+    semiring = get_semiring(settings)
+    mat = Matrix.identity(vector_len, semiring)
     while True:
         instr = matcode[index]
         oper = instr[0]
@@ -113,17 +160,21 @@ def run_loop(settings, matcode, index, vector_len):
                     settings, matcode, index + 1, vector_len,
                 )
 
-                need_min_rows = settings['opt_min_rows']
+                # Skipping of rows relies on the ordinary arithmetic
+                need_min_rows = (settings['opt_min_rows'] and
+                                 semiring is ARITHMETIC)
                 if need_min_rows:
                     sub_mat, unskipped, fix_mat = skip_rows(sub_mat)
                 cur_mat = sub_mat ** instr[1][1]
                 if need_min_rows:
                     cur_mat = restore_rows(cur_mat, unskipped, fix_mat)
             else:
-                if len(instr) != 3 or instr[1][0] != VAR:
+                if oper not in (STEP, SEMIRING_STEP) and (
+                    len(instr) != 3 or instr[1][0] != VAR
+                ):
                     raise InvalidMatcodeError
-                cur_mat = Matrix.identity(vector_len)
-                MATCODE_MAP[oper](cur_mat.content, instr[1], instr[2])
+                cur_mat = Matrix.identity(vector_len, semiring)
+                MATCODE_MAP[oper](cur_mat, *instr[1:])
         except InvalidMatcodeError as err:
             if err.args:
                 raise err
@@ -135,6 +186,82 @@ def run_loop(settings, matcode, index, vector_len):
         index += 1
 
 
+def handle_xor_step(rows, width, *args):
+    # Replace rows of the bits of the destinations (the last bit of the
+    # vector is the unit)
+    if len(args) % 3 != 0:
+        raise InvalidMatcodeError
+    unit_bit = 1 << (len(rows) - 1)
+    for index in xrange(0, len(args), 3):
+        dest, bits, const = args[index:index + 3]
+        if dest[0] != VAR or bits[0] != VALUE or const[0] != VALUE:
+            raise InvalidMatcodeError
+        # Constants are checked by `hook.check_word_consts`
+        masks, const = bits[1], const[1]
+        offset = dest[1] * width
+        for bit in xrange(width):
+            row = masks[bit] if bit < len(masks) else 0
+            if const >> bit & 1:
+                row |= unit_bit
+            rows[offset + bit] = row
+
+
+def run_bit_loop(settings, matcode, index, side):
+    # Bit matrices are applied to column vectors, so the transformation
+    # of every next instruction is the left factor
+    mat = BitMatrix.identity(side)
+    while True:
+        instr = matcode[index]
+        oper = instr[0]
+        if oper == END:
+            return mat, index
+
+        try:
+            if oper == LOOP:
+                if len(instr) != 2 or instr[1][0] != VALUE:
+                    raise InvalidMatcodeError
+                sub_mat, index = run_bit_loop(
+                    settings, matcode, index + 1, side,
+                )
+                cur_mat = sub_mat ** instr[1][1]
+            elif oper == XOR_STEP:
+                rows = [1 << y for y in xrange(side)]
+                handle_xor_step(rows, settings['gf2_width'], *instr[1:])
+                cur_mat = BitMatrix(rows)
+            else:
+                raise InvalidMatcodeError
+        except InvalidMatcodeError as err:
+            if err.args:
+                raise err
+            raise InvalidMatcodeError((
+                'Invalid matrix code instruction: %s'
+            ) % ' '.join(map(repr, instr)))
+
+        mat = cur_mat * mat
+        index += 1
+
+
+def run_bit_matcode(settings, matcode, vector):
+    # Values of the variables are words of the same width. Their bits are
+    # packed to one integer with the unit bit at the end.
+    width = settings['gf2_width']
+    vars_count = len(vector) - 1
+    side = vars_count * width + 1
+    mat = run_bit_loop(settings, matcode, 0, side)[0]
+
+    packed = 1 << (side - 1)
+    for index in xrange(vars_count):
+        packed |= vector[index] << (index * width)
+    packed = mat.apply(packed)
+    word_mask = (1 << width) - 1
+    return [packed >> (index * width) & word_mask
+            for index in xrange(vars_count)] + [1]
+
+
 def run_matcode(settings, matcode, vector):
+    if settings['gf2_width'] is not None:
+        return run_bit_matcode(settings, matcode, vector)
     mat = run_loop(settings, matcode, 0, len(vector))[0]
-    return (Matrix([vector]) * mat).content[0]
+    # The last element of the vector is the unit of the semiring
+    vector = vector[:-1] + [mat.semiring.one]
+    return (Matrix([vector], mat.semiring) * mat).row(0)
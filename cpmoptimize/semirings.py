@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import byteplay
+
+import hook
+import recompiler
+from matcode import *
+from matrices import BOOLEAN, SEMIRINGS
+from recompiler import RecompilationError, UnpredictableArgsError, \
+    UNIT_KEY, coeff_lines, evaluate_known, is_folded, neg_coeff
+
+
+# Recompilation of loops which bodies are linear over other semirings
+# than the ordinary arithmetic. It's enabled by `semiring` option:
+#     "max_plus" - "max" is the sum and "+" is the product (e.g.
+#                  "best = max(best, other + c)"),
+#     "min_plus" - the same with "min",
+#     "boolean"  - "or" is the sum and "and" is the product (e.g.
+#                  "reach = reach or prev").
+# Bodies must not contain branches and the loop's counter.
+
+
+def is_zero(semiring, coeff):
+    return not is_folded(coeff) and coeff == semiring.zero
+
+
+def is_one(semiring, coeff):
+    return not is_folded(coeff) and coeff == semiring.one
+
+
+def fold_operation(func, first, second):
+    return [(byteplay.LOAD_CONST, func)] + coeff_lines(first) + \
+        coeff_lines(second) + [(byteplay.CALL_FUNCTION, 2)]
+
+
+def add_coeffs(semiring, first, second):
+    if is_zero(semiring, first):
+        return second
+    if is_zero(semiring, second):
+        return first
+    if not is_folded(first) and not is_folded(second):
+        return semiring.add(first, second)
+    return fold_operation(semiring.add, first, second)
+
+
+def mul_coeffs(semiring, first, second):
+    if is_zero(semiring, first) or is_zero(semiring, second):
+        return semiring.zero
+    if is_one(semiring, first):
+        return second
+    if is_one(semiring, second):
+        return first
+    if not is_folded(first) and not is_folded(second):
+        return semiring.mul(first, second)
+    return fold_operation(semiring.mul, first, second)
+
+
+class SemiringForm(object):
+    # Sum (in the semiring) of the products of values that mutable
+    # variables had at the beginning of the iteration and coefficients.
+    # A constant term is identified by UNIT_KEY. Objects of this class
+    # are never modified after creation.
+
+    __slots__ = ('semiring', 'coeffs')
+
+    def __init__(self, semiring, coeffs):
+        self.semiring = semiring
+        self.coeffs = dict((key, coeff) for key, coeff in coeffs.iteritems()
+                           if not is_zero(semiring, coeff))
+
+    @classmethod
+    def const(cls, semiring, coeff):
+        return cls(semiring, {UNIT_KEY: coeff})
+
+    @classmethod
+    def var(cls, semiring, straight):
+        return cls(semiring, {straight: semiring.one})
+
+    def is_const(self):
+        return all(key == UNIT_KEY for key in self.coeffs)
+
+    def const_coeff(self):
+        return self.coeffs.get(UNIT_KEY, self.semiring.zero)
+
+    def __add__(self, other):
+        # Sum in the semiring
+        coeffs = dict(self.coeffs)
+        for key, coeff in other.coeffs.iteritems():
+            coeffs[key] = add_coeffs(self.semiring, coeffs.get(
+                key, self.semiring.zero), coeff)
+        return SemiringForm(self.semiring, coeffs)
+
+    def scaled(self, factor):
+        # Product in the semiring
+        return SemiringForm(self.semiring, dict(
+            (key, mul_coeffs(self.semiring, coeff, factor))
+            for key, coeff in self.coeffs.iteritems()))
+
+    def __eq__(self, other):
+        return isinstance(other, SemiringForm) and self.coeffs == other.coeffs
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class SemiringState(recompiler.RecompilerState):
+    # Values of the variables are tracked as forms over the semiring
+
+    def __init__(self, settings):
+        hints = {'period': None, 'lists': {}, 'inplace_lists': set()}
+        super(SemiringState, self).__init__(settings, hints)
+        self.semiring = SEMIRINGS[settings['semiring']]
+
+    def add_var(self, straight):
+        is_new = not self.is_mutable(straight)
+        arg = super(SemiringState, self).add_var(straight)
+        if is_new:
+            self._values[straight] = SemiringForm.var(self.semiring, straight)
+        return arg
+
+    def const(self, coeff):
+        return SemiringForm.const(self.semiring, coeff)
+
+    def load_var(self, straight):
+        try:
+            return self._values[straight]
+        except KeyError:
+            # The variable isn't changed in the loop, so its value can
+            # be folded
+            load_oper = VARIABLE_OPERATION_MAP[straight[0]][0]
+            return self.const([(load_oper, straight[1])])
+
+    def store_var(self, straight, value):
+        if not isinstance(value, SemiringForm):
+            raise RecompilationError((
+                'Unsupported value of variable "%s"'
+            ) % var_repr(straight), self, 'unsupported_value')
+        self._values[straight] = value
+
+    def append_step(self):
+        args = []
+        for straight in self._vars_storage:
+            form = self._values[straight]
+            if form == SemiringForm.var(self.semiring, straight):
+                continue
+            if not form.coeffs:
+                args += [straight, UNIT_KEY, (VALUE, self.semiring.zero)]
+            for key, coeff in form.coeffs.iteritems():
+                args += [straight, key, self.coeff_arg(coeff)]
+        if args:
+            self.append([SEMIRING_STEP] + args)
+
+
+def nonlinear_error(state, operation):
+    return RecompilationError((
+        '%s of two values changed in the loop is not linear in the %s '
+        'semiring'
+    ) % (operation, state.semiring.name), state, 'unpredictable_operands')
+
+
+def handle_const(state, instr):
+    # Other operations are allowed only with constant operands
+    count = 1 if str(instr[0]).startswith('UNARY_') else 2
+    if len(state.stack) < count:
+        raise IndexError
+    forms = state.stack[-count:]
+    if not all(isinstance(form, SemiringForm) and form.is_const()
+               for form in forms):
+        raise UnpredictableArgsError
+    coeffs = [form.const_coeff() for form in forms]
+    known = evaluate_known(instr, *coeffs)
+    if known is not None:
+        res = known[0]
+    else:
+        res = sum(map(coeff_lines, coeffs), []) + [instr]
+    state.stack[-count:] = [state.const(res)]
+
+
+def handle_binary_add(state, instr):
+    first, second = state.stack[-2:]
+    if state.semiring is BOOLEAN:
+        handle_const(state, instr)
+        return
+    # Addition is the product in the max-plus and min-plus semirings
+    if second.is_const():
+        res = first.scaled(second.const_coeff())
+    elif first.is_const():
+        res = second.scaled(first.const_coeff())
+    else:
+        raise nonlinear_error(state, 'Sum')
+    state.stack[-2:] = [res]
+
+
+def handle_binary_subtract(state, instr):
+    first, second = state.stack[-2:]
+    if state.semiring is BOOLEAN or first.is_const():
+        handle_const(state, instr)
+        return
+    if not second.is_const():
+        raise nonlinear_error(state, 'Difference')
+    state.stack[-2:] = [first.scaled(neg_coeff(second.const_coeff()))]
+
+
+def callee_straight(func):
+    # Returns a straight reference of a variable containing the function
+    # if it isn't changed in the loop (otherwise returns None)
+    if not (isinstance(func, SemiringForm) and func.is_const()):
+        return None
+    lines = func.const_coeff()
+    if not (is_folded(lines) and len(lines) == 1):
+        return None
+    oper, name = lines[0]
+    if oper not in VARIABLE_TYPE_MAP or VARIABLE_TYPE_MAP[oper][1]:
+        return None
+    return VARIABLE_TYPE_MAP[oper][0], name
+
+
+def is_semiring_sum(state, straight):
+    # Whether the function is the sum of the semiring ("max" or "min").
+    # If the variable can't be found during the recompilation, it's
+    # matched by the name and checked in the run-time.
+    func = state.semiring.add
+    if state.semiring is BOOLEAN or straight[0] in (FAST, DEREF):
+        return False
+    try:
+        return hook.resolve_callee(state.settings, straight) is func
+    except KeyError:
+        return straight[0] in (NAME, GLOBAL) and straight[1] == func.__name__
+
+
+def handle_call_function(state, instr):
+    argc = instr[1]
+    if len(state.stack) < argc + 1:
+        raise IndexError
+    func = state.stack[-argc - 1]
+    args = state.stack[len(state.stack) - argc:]
+    straight = callee_straight(func)
+    if straight is not None and argc >= 2 and \
+            is_semiring_sum(state, straight):
+        # "max" or "min" is the sum in the semiring
+        res = args[0]
+        for arg in args[1:]:
+            res += arg
+        callee = straight, state.semiring.add
+    elif straight is not None and \
+            hook.may_be_pure_callee(state.settings, straight):
+        if not all(arg.is_const() for arg in args):
+            raise UnpredictableArgsError
+        lines = list(func.const_coeff())
+        for arg in args:
+            lines += coeff_lines(arg.const_coeff())
+        res = state.const(lines + [instr])
+        callee = straight, None
+    else:
+        raise RecompilationError('Unsupported instruction %s' % repr(instr),
+                                 state, 'unsupported_instruction')
+    # The function is checked in the run-time (see
+    # `hook.check_pure_callees`)
+    if callee not in state.pure_callees:
+        state.pure_callees.append(callee)
+    state.stack[-argc - 1:] = [res]
+
+
+def handle_load_const(state, instr):
+    arg = instr[1]
+    if isinstance(arg, tuple):
+        for elem in arg:
+            handle_load_const(state, (instr[0], elem))
+        recompiler.handle_build_tuple(state, (byteplay.BUILD_TUPLE, len(arg)))
+        return
+    if not isinstance(arg, state.settings['types'] + (bool,)):
+        allowed_types = ', '.join(map(repr, state.settings['types']))
+        raise RecompilationError((
+            'Constant %s has an unallowed type %s instead of ' +
+            'one of allowed types: %s'
+        ) % (repr(arg), type(arg), allowed_types), state, 'unallowed_type')
+    state.stack.append(state.const(arg))
+
+
+def handle_load_var(state, instr):
+    oper, name = instr
+    straight = VARIABLE_TYPE_MAP[oper][0], name
+    state.stack.append(state.load_var(straight))
+
+
+def handle_store_var(state, instr):
+    oper, name = instr
+    straight = VARIABLE_TYPE_MAP[oper][0], name
+    state.store_var(straight, state.stack.pop())
+
+
+def handle_load_attr(state, instr):
+    # Attributes can't be stored in the loop, so their values are folded
+    form = state.stack[-1]
+    if not form.is_const():
+        raise UnpredictableArgsError
+    state.stack[-1] = state.const(coeff_lines(form.const_coeff()) + [instr])
+
+
+LOAD_OPERATIONS, STORE_OPERATIONS = zip(*VARIABLE_OPERATION_MAP.values())
+BYTECODE_HANDLERS = [
+    (recompiler.handle_nop, [byteplay.NOP, byteplay.UNARY_POSITIVE]),
+    (recompiler.handle_pop_top, [byteplay.POP_TOP]),
+    (recompiler.create_rot(2), [byteplay.ROT_TWO]),
+    (recompiler.create_rot(3), [byteplay.ROT_THREE]),
+    (recompiler.create_rot(4), [byteplay.ROT_FOUR]),
+    (recompiler.create_dup(1), [byteplay.DUP_TOP]),
+    (recompiler.handle_dup_topx, [byteplay.DUP_TOPX]),
+    (recompiler.handle_build_tuple, [byteplay.BUILD_TUPLE]),
+    (recompiler.handle_unpack_sequence, [byteplay.UNPACK_SEQUENCE]),
+
+    (handle_binary_add, [byteplay.BINARY_ADD, byteplay.INPLACE_ADD]),
+    (handle_binary_subtract, [
+        byteplay.BINARY_SUBTRACT, byteplay.INPLACE_SUBTRACT,
+    ]),
+    (handle_const, [
+        byteplay.UNARY_NEGATIVE, byteplay.UNARY_NOT, byteplay.UNARY_INVERT,
+        byteplay.BINARY_POWER, byteplay.BINARY_MULTIPLY,
+        byteplay.BINARY_DIVIDE, byteplay.BINARY_FLOOR_DIVIDE,
+        byteplay.BINARY_TRUE_DIVIDE, byteplay.BINARY_MODULO,
+        byteplay.BINARY_LSHIFT, byteplay.BINARY_RSHIFT,
+        byteplay.BINARY_AND, byteplay.BINARY_XOR, byteplay.BINARY_OR,
+        byteplay.INPLACE_POWER, byteplay.INPLACE_MULTIPLY,
+        byteplay.INPLACE_DIVIDE, byteplay.INPLACE_FLOOR_DIVIDE,
+        byteplay.INPLACE_TRUE_DIVIDE, byteplay.INPLACE_MODULO,
+        byteplay.INPLACE_LSHIFT, byteplay.INPLACE_RSHIFT,
+        byteplay.INPLACE_AND, byteplay.INPLACE_XOR, byteplay.INPLACE_OR,
+        byteplay.COMPARE_OP,
+    ]),
+    (handle_call_function, [byteplay.CALL_FUNCTION]),
+
+    (handle_load_const, [byteplay.LOAD_CONST]),
+    (handle_load_var, LOAD_OPERATIONS),
+    (handle_store_var, STORE_OPERATIONS),
+    (handle_load_attr, [byteplay.LOAD_ATTR]),
+]
+
+SUPPORTED_OPERATIONS = {}
+for handler, opers in BYTECODE_HANDLERS:
+    for oper in opers:
+        SUPPORTED_OPERATIONS[oper] = handler
+
+
+# Jumps of "or" and "and" operators. The flag shows whether the
+# operator is "or" (the sum in the boolean semiring).
+BOOLEAN_OPERATOR_JUMPS = {}
+if hasattr(byteplay, 'JUMP_IF_TRUE_OR_POP'):
+    BOOLEAN_OPERATOR_JUMPS.update({
+        byteplay.JUMP_IF_TRUE_OR_POP: True,
+        byteplay.JUMP_IF_FALSE_OR_POP: False,
+    })
+
+
+def combine_operands(state, is_sum, first, second):
+    if is_sum:
+        return first + second
+    if second.is_const():
+        return first.scaled(second.const_coeff())
+    if first.is_const():
+        return second.scaled(first.const_coeff())
+    raise nonlinear_error(state, 'Conjunction')
+
+
+def walk_body(state, body):
+    # Left operands of "or" and "and" operators waiting for the right
+    # ones (triples of the label where the right operand is ready, the
+    # operator's flag and the left operand)
+    pending = []
+    for instr in body:
+        oper = instr[0]
+        if isinstance(oper, byteplay.Label):
+            # Operators like "a or b or c" share the label
+            while pending and pending[-1][0] is oper:
+                label, is_sum, first = pending.pop()
+                second = state.stack.pop()
+                state.stack.append(combine_operands(
+                    state, is_sum, first, second))
+            continue
+        if oper == byteplay.SetLineno:
+            state.lineno = instr[1]
+            continue
+        state.instr = instr
+        if oper in BOOLEAN_OPERATOR_JUMPS and state.semiring is BOOLEAN:
+            pending.append((instr[1], BOOLEAN_OPERATOR_JUMPS[oper],
+                            state.stack.pop()))
+            continue
+        try:
+            handler = SUPPORTED_OPERATIONS[oper]
+        except KeyError:
+            raise RecompilationError((
+                'Unsupported instruction %s in a loop over the %s semiring'
+            ) % (repr(instr), state.semiring.name), state,
+                'unsupported_instruction')
+        try:
+            handler(state, instr)
+        except UnpredictableArgsError:
+            raise recompiler.unpredictable_args_error(state, instr)
+        except IndexError:
+            raise RecompilationError('Unsupported loop type or invalid stack usage in bytecode',
+                                     state, 'unsupported_instruction')
+    if pending:
+        raise RecompilationError('Unsupported jump in the loop', state,
+                                 'unsupported_jump')
+    state.instr = None
+
+
+def recompile_body(settings, body):
+    state = SemiringState(settings)
+
+    elem_straight, counter_status, rem_body = recompiler.browse_counter(
+        state, body,
+    )
+    state.counter_status = counter_status
+    if counter_status != 'n':
+        raise RecompilationError((
+            "Loop's counter can't be used in a loop over the %s semiring"
+        ) % state.semiring.name, state, 'unsupported_value')
+    state.manual_store_counter = elem_straight
+
+    recompiler.browse_vars(state, rem_body)
+    state.append(
+        [LOOP, (PARAM, 'iters_count')],
+    )
+    walk_body(state, rem_body)
+    state.append_step()
+    state.append(
+        [END],
+    )
+
+    if settings['opt_dead_vars'] and not state.is_live(elem_straight):
+        state.manual_store_counter = None
+    return state
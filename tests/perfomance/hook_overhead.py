@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure latency that the optimization adds to calls with small n"""
+
+import json
+import sys
+import timeit
+
+import tests_common as common
+from cpmoptimize import cpmoptimize
+
+
+# Number of iterations that is never reached in this benchmark, so the
+# optimization is always skipped in the run-time
+SKIPPED_ITERS_LIMIT = 10 ** 9
+
+ARGUMENTS = [0, 1, 2, 5, 10, 30, 100, 300, 1000, 3000, 10000]
+BODY_SIZES = [1, 2, 4, 8]
+
+# Every measure is the minimal time of a call among the repetitions
+REPEAT = 5
+MIN_MEASURE_TIME = 0.1
+
+# Table's columns widths
+ARG_COL_WIDTH = 6
+TIME_COL_WIDTH = 10
+RATIO_COL_WIDTH = 20
+
+DEFAULT_OUTPUT = 'hook_overhead.json'
+
+
+def make_naive(body_size):
+    # Make a function with a loop changing the specified number of
+    # variables. The first variable is increased by the argument, every
+    # next one is increased by the previous one (so the values grow
+    # polynomially and the time isn't spent on long arithmetic).
+
+    names = ['v%s' % index for index in xrange(body_size)]
+    lines = [
+        'def naive(n, x):',
+        '    %s = %s' % (', '.join(names), ', '.join(['1'] * body_size)),
+        '    for i in xrange(n):',
+        '        v0 += x',
+    ]
+    for index in xrange(1, body_size):
+        lines.append('        %s += %s' % (names[index], names[index - 1]))
+    lines.append('    return %s' % names[-1])
+    namespace = {}
+    source = '\n'.join(lines) + '\n'
+    exec compile(source, '<body of size %s>' % body_size, 'exec') in namespace
+    return namespace['naive']
+
+
+def make_methods(body_size):
+    naive = make_naive(body_size)
+    return [
+        ('naive', naive),
+        ('skipped', cpmoptimize(iters_limit=SKIPPED_ITERS_LIMIT)(naive)),
+        ('cpm', cpmoptimize(iters_limit=0)(naive)),
+    ]
+
+
+def measure_latency(func, arg):
+    # Returns minimal time of a call (in seconds)
+
+    timer = timeit.Timer(lambda: func(arg, 3))
+    number = 1
+    while timer.timeit(number) < MIN_MEASURE_TIME:
+        number *= 2
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def format_latency(value):
+    return '%.2lf' % (value * 10 ** 6)
+
+
+def run_body_size(body_size, results):
+    methods = make_methods(body_size)
+    print 'Body with %s variable(s), time of a call in microseconds:\n' % body_size
+
+    cols = [('arg', ARG_COL_WIDTH)]
+    for desc, func in methods:
+        width = TIME_COL_WIDTH if desc == 'naive' else RATIO_COL_WIDTH
+        cols.append((desc, width))
+    cols.append(('match', ARG_COL_WIDTH))
+
+    table = common.Table(cols)
+    table.head()
+    for arg in ARGUMENTS:
+        table.append(arg)
+        control_time = None
+        data_set = set()
+        for desc, func in methods:
+            cur_time = measure_latency(func, arg)
+            data_set.add(func(arg, 3))
+            results.append({
+                'body_size': body_size,
+                'arg': arg,
+                'method': desc,
+                'latency': cur_time,
+            })
+
+            cell = format_latency(cur_time)
+            if control_time is None:
+                control_time = cur_time
+            else:
+                cell += (' (%+.2lf)' % ((cur_time - control_time) * 10 ** 6)
+                         ).rjust(RATIO_COL_WIDTH - len(cell))
+            table.append(cell)
+        table.append(str(len(data_set) == 1))
+    table.footer()
+
+
+if __name__ == '__main__':
+    # Results are saved to a JSON file (its name can be passed as an
+    # argument), so they can be compared with results of other versions
+    output = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_OUTPUT
+
+    results = []
+    for body_size in BODY_SIZES:
+        run_body_size(body_size, results)
+
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print '[*] Saved results to "%s"' % output
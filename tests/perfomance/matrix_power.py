@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare binary and sliding window exponentiation of matrices"""
+
+import random
+
+import tests_common as common
+from cpmoptimize.matrices import Matrix
+
+
+SIDE = 4
+
+random.seed(42)
+base = Matrix([[random.randint(-3, 3) for x in xrange(SIDE)]
+               for y in xrange(SIDE)])
+
+
+def dense_exponent(n):
+    # Make an exponent of the same length as "n" with random bits (the
+    # highest bit is set)
+    bits_count = len(bin(n)) - 2
+    generator = random.Random(n)
+    return generator.getrandbits(bits_count) | (1 << (bits_count - 1))
+
+
+def binary_power(mat, n):
+    # The previous implementation of Matrix.__pow__: right-to-left
+    # binary exponentiation with products written to preallocated
+    # buffers (the last square isn't calculated)
+    res = None
+    cur = mat.copy()
+    spare = Matrix._from_data(mat.rows, mat.cols, [0] * (mat.rows * mat.cols))
+    while True:
+        if n & 1:
+            if res is None:
+                if n == 1:
+                    return cur
+                res = cur.copy()
+            else:
+                res._mul_into(cur, spare._data)
+                res, spare = spare, res
+                if n == 1:
+                    return res
+        cur._mul_into(cur, spare._data)
+        cur, spare = spare, cur
+        n >>= 1
+
+
+def binary_exp(n):
+    """Binary exponentiation (previous Matrix.__pow__)"""
+
+    return tuple(binary_power(base, dense_exponent(n)).row(0))
+
+
+def sliding_window(n):
+    """Sliding window exponentiation (Matrix.__pow__)"""
+
+    return tuple((base ** dense_exponent(n)).row(0))
+
+
+if __name__ == '__main__':
+    common.run(
+        'matrix_power', 'dense random exponents',
+        [
+            ('binary', binary_exp),
+            ('window', sliding_window),
+        ],
+        [
+            (None, 'linear', common.linear_scale(200000, 10)),
+        ],
+    )
@@ -1,8 +1,14 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
+import gc
 import itertools
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
 
 PYTHON_VERSION = sys.version_info
 
@@ -11,7 +17,15 @@ if PYTHON_VERSION < (2, 7):
 else:
     import unittest
 
-from cpmoptimize import cpmoptimize, RecompilationError
+from cpmoptimize import cpmoptimize, install_import_hook, RecompilationError, \
+    clear_report, dump_report, get_report, cpm_pure
+from cpmoptimize import xrange as cpm_xrange, MAX_ASYNC_CALLS
+from cpmoptimize.cache import int_size, ResultCache
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 
 LOOP_ITERATIONS = 12345
@@ -25,6 +39,94 @@ def generalized_fib_func(a_start, iterator):
     return a
 
 
+def invariant_branches_func(flag, mode):
+    a = 12
+    b = 22
+    for i in xrange(LOOP_ITERATIONS):
+        if flag:
+            a += 1
+        elif mode == 2 and GLOBAL_CONST > 5:
+            b += a * 2
+        else:
+            continue
+        c = a if flag else b - GLOBAL_CONST
+        if not flag:
+            b -= c
+            if mode + 1 == 3 or not flag:
+                a = a * 3 - b
+                continue
+        a, b = b, a + c
+    return a, b, i
+
+
+def counter_sum_func(iterable):
+    a = 12
+    b = 22
+    for i in iterable:
+        a, b = b, a + i * 3
+    return a, b, i
+
+
+def counter_period_func(start, stop, step):
+    a = 12
+    b = 22
+    shifts = (3, -1, 0, 5)
+    for i in xrange(start, stop, step):
+        if i % 3 == 0:
+            a += b
+        elif (2 * i + 1) % 4 == 1:
+            b -= a * 2
+        else:
+            a, b = b, a + shifts[i % 4]
+        b += i % 6
+    return a, b
+
+
+class Model(object):
+    def __init__(self):
+        self.a = 12
+        self.b = 22
+        self.factor = 3
+        self.stats = Stats()
+
+    def run(self, count):
+        for i in xrange(count):
+            self.a, self.b = self.b, self.a + self.b * self.factor
+            self.stats.total += self.a - i
+        return self.a, self.b, self.stats.total
+
+
+class Stats(object):
+    def __init__(self):
+        self.total = 7
+
+
+def object_attributes_func():
+    model = Model()
+    res = model.run(LOOP_ITERATIONS)
+    for i in xrange(LOOP_ITERATIONS):
+        model.stats.total -= model.factor * 2
+    return res, model.a, model.stats.total
+
+
+@cpm_pure
+def pure_scale(value, factor=2):
+    return value * factor + 1
+
+
+def impure_scale(value):
+    return value * 2 + 1
+
+
+def pure_calls_func(n, k, offset):
+    a = 1
+    b = 0
+    for i in xrange(n):
+        a, b = b + pure_scale(k) * i, a + abs(offset) - max(k, 5)
+        b += pure_scale(k, max(offset, GLOBAL_CONST)) - pure_scale(offset)
+    return a, b
+
+
 def dump_locals(dictionary):
     return tuple(sorted(dictionary.items(), key=lambda item: item[0]))
 
@@ -38,13 +140,13 @@ def check_correctness(args=None, kwargs=None, strict=True, iters_limit=0):
     def decorator(func):
         def testcase_method(self):
             expected = func(*args, **kwargs)
-            options_variants = itertools.product([False, True], repeat=2)
+            options_variants = itertools.product([False, True], repeat=3)
             actual_variants = []
-            for opt_min_rows, opt_clear_stack in options_variants:
+            for opt_min_rows, opt_clear_stack, opt_dead_vars in options_variants:
                 bound_decorator = cpmoptimize(
                     strict=strict, iters_limit=iters_limit,
                     opt_min_rows=opt_min_rows, opt_clear_stack=opt_clear_stack,
-                    verbose=True)
+                    opt_dead_vars=opt_dead_vars, verbose=True)
                 # Debug messages will be generated in verbose mode (so, we can
                 # check that this process doesn't cause exceptions),
                 # but they won't be shown here (`logging` module
@@ -267,8 +369,362 @@ class TestIntCalculations(unittest.TestCase):
 
         return dump_locals(locals())
 
+    @check_correctness()
+    def test_deep_linear_expressions():
+        a = 12
+        b = 22
+        k = 3
+        k2 = -5
+        offset = 17
+
+        for i in xrange(LOOP_ITERATIONS):
+            a, b = b - (a - i) * 2, (a + b * k) * k2 + offset
+            a = -(a * (k - k2)) + (b - a) * 0 + k * (i + b + 1)
+
+        return dump_locals(locals())
+
+    test_invariant_branches_then = check_correctness(
+        args=(True, 2))(invariant_branches_func)
+    test_invariant_branches_elif = check_correctness(
+        args=(False, 2))(invariant_branches_func)
+    test_invariant_branches_else = check_correctness(
+        args=(0, 3))(invariant_branches_func)
+
+    test_counter_period = check_correctness(
+        args=(5, 1000, 1))(counter_period_func)
+    test_counter_period_with_step = check_correctness(
+        args=(-23, 1001, 7))(counter_period_func)
+    test_counter_period_with_negative_step = check_correctness(
+        args=(1000, -7, -5))(counter_period_func)
+
+    @check_correctness()
+    def test_polynomials_of_counter():
+        a = 12
+        b = 22
+        x = 5
+        for i in xrange(-30, LOOP_ITERATIONS, 3):
+            a += i * i - 2 * i ** 3 + (i + 1) * 5
+            b -= (i - 7) * x * 2
+            x += 3
+        return dump_locals(locals())
+
+    @check_correctness()
+    def test_polynomials_of_modified_counter():
+        a = 12
+        b = 22
+        for i in xrange(LOOP_ITERATIONS, 0, -2):
+            if GLOBAL_CONST > 5:
+                a += i ** 2 * b
+            i = i * 2 + a
+            b += 1
+        return dump_locals(locals())
+
+    def test_object_attributes(self):
+        expected = object_attributes_func()
+        orig_run = Model.run
+        Model.run = cpmoptimize()(orig_run.im_func)
+        try:
+            self.assertEqual(expected,
+                             cpmoptimize()(object_attributes_func)())
+        finally:
+            Model.run = orig_run
+
+    def test_aliased_attribute_owners(self):
+        def func(first, second):
+            for i in xrange(LOOP_ITERATIONS):
+                first.total += 1
+                second.total += 1
+            return first.total
+
+        stats = Stats()
+        expected = func(stats, stats)
+        stats = Stats()
+        optimized = cpmoptimize(iters_limit=0, strict=False)(func)
+        self.assertEqual(expected, optimized(stats, stats))
+        with self.assertRaisesRegexp(TypeError, 'refer to the same object'):
+            cpmoptimize(iters_limit=0)(func)(stats, stats)
+        first, second = Stats(), Stats()
+        self.assertEqual(func(Stats(), Stats()),
+                         cpmoptimize(iters_limit=0)(func)(first, second))
+
+    def test_aliased_lists(self):
+        def func(first, second):
+            for i in xrange(LOOP_ITERATIONS):
+                first[0] += 1
+                second[0] += 1
+            return first[0]
+
+        counts = [1, 2]
+        expected = func(counts, counts)
+        counts = [1, 2]
+        optimized = cpmoptimize(iters_limit=0, strict=False)(func)
+        self.assertEqual(expected, optimized(counts, counts))
+        with self.assertRaisesRegexp(TypeError, 'refer to the same object'):
+            cpmoptimize(iters_limit=0)(func)(counts, counts)
+
+    @check_correctness()
+    def test_lists_replaced_in_loop():
+        dp = [1, 0, 0, 0]
+        total = 0
+        for i in xrange(LOOP_ITERATIONS):
+            new = [0] * 4
+            for j in xrange(4):
+                new[j] = dp[j - 1] + dp[(j + 1) % 4] * 2
+                if j == 2:
+                    continue
+                new[j] += dp[j]
+                if j == 3 and GLOBAL_CONST > 0:
+                    break
+            dp, prev = new, [new[0] - total, dp[1]]
+            total += dp[3] - prev[1]
+        return dump_locals(locals())
+
+    def test_replaced_list_of_other_length(self):
+        def func(n):
+            dp = [1, 1, 1]
+            for i in xrange(n):
+                dp = [dp[1], dp[0] + 1]
+            return dp
+
+        optimized = cpmoptimize(iters_limit=0, strict=False)(func)
+        self.assertEqual(func(LOOP_ITERATIONS), optimized(LOOP_ITERATIONS))
+        with self.assertRaisesRegexp(TypeError,
+                                     'must be a list with 2 elements'):
+            cpmoptimize(iters_limit=0)(func)(LOOP_ITERATIONS)
+
+    @check_correctness()
+    def test_lists_changed_in_place():
+        counts = [1, 2, 3, 4]
+        model = Model()
+        model.values = [5, 6]
+        for i in xrange(LOOP_ITERATIONS):
+            counts[0], counts[1] = counts[1], counts[0] + counts[2]
+            counts[i % 2 + 2] += 1
+            for j in xrange(1, 3):
+                model.values[j - 1] -= counts[j] * 2
+        return counts, model.values
+
+    @check_correctness()
+    def test_branches_on_values_assigned_in_loop():
+        a = 12
+        b = 22
+
+        for i in xrange(LOOP_ITERATIONS):
+            mode = 3
+            if mode > 2:
+                mode = GLOBAL_CONST
+            if mode == GLOBAL_CONST:
+                a, b = b, a + b
+            else:
+                a = 0
+
+        return dump_locals(locals())
+
+    @check_correctness(args=[0])
+    def test_folded_consts_in_skipped_branches(divisor):
+        # Constants of branches that aren't executed must not be
+        # evaluated (otherwise "100 // divisor" raises ZeroDivisionError)
+        a = 0
+        b = 0
+        for i in xrange(LOOP_ITERATIONS):
+            if divisor != 0:
+                a += 100 // divisor
+            if divisor and 100 // divisor > 3:
+                b += 1
+            else:
+                b += 2
+        return a, b
+
+    @check_correctness()
+    def test_opt_dead_vars():
+        a = 12
+        b = 22
+        c = 32
+
+        for i in xrange(LOOP_ITERATIONS):
+            c = a * 3 + 7
+            d = c - b
+            e = d * 2
+            a, b = b, a + d
+            c = e + i
+
+        return a, b
+
+    @check_correctness(strict=False)
+    def test_opt_dead_vars_in_outer_loop():
+        a = 12
+        b = 22
+        res = []
+
+        for j in xrange(3):
+            for i in xrange(LOOP_ITERATIONS):
+                a, b = b, a + b * 3
+                c = a - 7
+            res.append(b)
+            if j == 1:
+                del c
+            else:
+                c = j
+
+        return res, c
+
     test_fib = check_correctness(
         args=(0, xrange(LOOP_ITERATIONS)))(generalized_fib_func)
+    test_progression_list = check_correctness(
+        args=(range(-7, LOOP_ITERATIONS * 3, 3),))(counter_sum_func)
+    test_progression_tuple = check_correctness(
+        args=(tuple(range(LOOP_ITERATIONS, 0, -2)),))(counter_sum_func)
+
+    @check_correctness()
+    def test_iterables_in_header():
+        a = 1
+        b = 2
+        for i in range(5, LOOP_ITERATIONS):
+            a, b = b + i, a
+        for j in reversed(xrange(-3, LOOP_ITERATIONS, 7)):
+            a += j
+        for k in itertools.repeat(3, LOOP_ITERATIONS):
+            b += k * 2
+        for m in itertools.repeat(None, LOOP_ITERATIONS):
+            a -= b
+        for n in reversed(range(2, LOOP_ITERATIONS, 3)):
+            b += n
+        for p in reversed(range(1)):
+            a += p
+        return dump_locals(locals())
+
+    @check_correctness()
+    def test_lists_passed_to_functions_in_header():
+        # Lists made by "range" are accessible in functions other than
+        # "reversed", so they mustn't be replaced
+        def extend(values):
+            values.append(LOOP_ITERATIONS)
+            return values
+
+        a = 1
+        for i in extend(range(5, LOOP_ITERATIONS)):
+            a += i * 2
+        for j in sorted(range(LOOP_ITERATIONS, 0, -3)):
+            a -= j
+        return a, i, j
+
+    @check_correctness(strict=False)
+    def test_progression_changed_in_loop():
+        # The list is changed during the iteration over it, so the loop
+        # isn't optimized
+        values = range(1, 9)
+        total = 0
+        for value in values:
+            values[7] = 100
+            total += value
+        return total, values
+
+    @check_correctness()
+    def test_nested_functions():
+        step = 3
+
+        def make_counter(start):
+            def count(n):
+                res = start
+                for i in xrange(n):
+                    res = res * 2 + step
+                return res
+            return count
+
+        square_sum = lambda n: sum(i * i for i in xrange(n))
+        a = make_counter(5)(LOOP_ITERATIONS)
+        for i in xrange(LOOP_ITERATIONS):
+            step += a
+        return a, step, square_sum(100)
+
+    @check_correctness()
+    def test_parallel_assignment_of_many_values():
+        a, b, c, d = 0, 0, 0, 1
+        for i in xrange(LOOP_ITERATIONS):
+            a, b, c, d = b, c, d, a + b + c + d
+        return a, b, c, d
+
+    @check_correctness()
+    def test_unpacking_of_lists():
+        stages = [1, 2, 3, 4, 5, 6]
+        for i in xrange(LOOP_ITERATIONS):
+            first, second, third, fourth, fifth, sixth = stages
+            stages = [second, third, fourth, fifth, sixth + i, first]
+            total, delta = 0, 0
+        return stages, total, delta
+
+    @check_correctness(strict=False)
+    def test_many_loops():
+        res = []
+        a = 1
+        for i in xrange(LOOP_ITERATIONS):
+            a = a * 3 + i
+        res.append(a)
+        for j in xrange(3):
+            b = j
+            for i in xrange(LOOP_ITERATIONS):
+                b += a
+            res.append(b)
+        squares = [i * i for i in xrange(10)]
+        for i in xrange(LOOP_ITERATIONS):
+            a -= 2
+        res.append(a)
+        for i in range(len(squares)):
+            res.append(squares[i])
+        return res
+
+    test_pure_function_calls = check_correctness(
+        args=(LOOP_ITERATIONS, 3, -7))(pure_calls_func)
+
+    @check_correctness()
+    def test_generators():
+        def fib_numbers(count, n):
+            for j in xrange(count):
+                a, b = 0, 1
+                for i in xrange(n * j):
+                    a, b = b, a + b
+                yield a
+
+        return list(fib_numbers(5, LOOP_ITERATIONS))
+
+    def test_class_decorator(self):
+        class Sequences(object):
+            def __init__(self, start):
+                self.start = start
+
+            def arith_sum(self, n):
+                res = 0
+                for i in xrange(n):
+                    res += self.start + i
+                return res
+
+            @staticmethod
+            def fib(n):
+                a, b = 0, 1
+                for i in xrange(n):
+                    a, b = b, a + b
+                return a
+
+            @classmethod
+            def geom_sum(cls, n):
+                res = 0
+                for i in xrange(n):
+                    res = res * 2 + 1
+                return cls, res
+
+        orig_init = Sequences.__dict__['__init__']
+        expected = (Sequences(7).arith_sum(LOOP_ITERATIONS),
+                    Sequences.fib(LOOP_ITERATIONS),
+                    Sequences.geom_sum(LOOP_ITERATIONS))
+        cpmoptimize(iters_limit=0)(Sequences)
+        self.assertEqual(expected,
+                         (Sequences(7).arith_sum(LOOP_ITERATIONS),
+                          Sequences.fib(LOOP_ITERATIONS),
+                          Sequences.geom_sum(LOOP_ITERATIONS)))
+        for name in ('arith_sum', 'fib', 'geom_sum'):
+            self.assertTrue(hasattr(getattr(Sequences, name), 'cache_info'))
+        # Methods without loops are left untouched
+        self.assertIs(orig_init, Sequences.__dict__['__init__'])
 
 
 def check_exception(exception, regexp, args=None, kwargs=None, iters_limit=0):
@@ -279,12 +735,12 @@ def check_exception(exception, regexp, args=None, kwargs=None, iters_limit=0):
 
     def decorator(func):
         def testcase_method(self):
-            options_variants = itertools.product([False, True], repeat=2)
-            for opt_min_rows, opt_clear_stack in options_variants:
+            options_variants = itertools.product([False, True], repeat=3)
+            for opt_min_rows, opt_clear_stack, opt_dead_vars in options_variants:
                 bound_decorator = cpmoptimize(
                     strict=True, iters_limit=iters_limit,
                     opt_min_rows=opt_min_rows, opt_clear_stack=opt_clear_stack,
-                    verbose=True)
+                    opt_dead_vars=opt_dead_vars, verbose=True)
                 with self.assertRaisesRegexp(exception, regexp):
                     bound_decorator(func)(*args, **kwargs)
 
@@ -296,13 +752,32 @@ def check_exception(exception, regexp, args=None, kwargs=None, iters_limit=0):
 
 
 class TestExceptions(unittest.TestCase):
+    @check_exception(RecompilationError,
+                     r"^Can't optimize loop: .+ in count, file ")
+    def test_nested_function_error():
+        def count(n):
+            res = 1
+            for i in xrange(2, n + 1):
+                res *= i
+            return res
+        return count(LOOP_ITERATIONS)
+
     @check_exception(RecompilationError,
                      r"^Can't optimize loop: Unsupported instruction .+ "
                      r"at line \d+ in ")
     def test_unsupported_instruction():
         res = 0
         for i in xrange(LOOP_ITERATIONS):
-            if i < 100:
+            res += len(str(i))
+        return res
+
+    @check_exception(RecompilationError,
+                     r"^Can't optimize loop: Condition of a branch depends "
+                     r"on values changed in the loop at line \d+ in ")
+    def test_unpredictable_branch_condition():
+        res = 0
+        for i in xrange(LOOP_ITERATIONS):
+            if res:
                 res += 1
             else:
                 res += 2
@@ -313,6 +788,36 @@ class TestExceptions(unittest.TestCase):
                      r"two unpredictable values is unsupported "
                      r"at line \d+ in ")
     def test_unpredictable_multiplication_operands():
+        a = 1
+        b = 2
+        for i in xrange(LOOP_ITERATIONS):
+            a, b = a * b, b + 1
+        return a
+
+    @check_exception(RecompilationError,
+                     r"^Can't optimize loop: Object with attribute \"total\" "
+                     r"changed in the loop must be stored in a variable ")
+    def test_attributes_of_unsupported_objects():
+        models = [Stats(), Stats()]
+        for i in xrange(LOOP_ITERATIONS):
+            models[0].total += 1
+        return models[0].total
+
+    @check_exception(RecompilationError,
+                     r"^Can't optimize loop: Index of a list changed in the "
+                     r"loop must be known during the recompilation ")
+    def test_unpredictable_list_index():
+        counts = [1, 2, 3]
+        index = 0
+        for i in xrange(LOOP_ITERATIONS):
+            counts[index] += 1
+            index = counts[1] - 2
+        return counts
+
+    @check_exception(RecompilationError,
+                     r"^Can't optimize loop: Degree of a polynomial of "
+                     r"the counter is more than \d+ at line \d+ in ")
+    def test_too_big_polynomial_degree():
         res = 1
         for i in xrange(2, LOOP_ITERATIONS + 1):
             res *= i
@@ -341,7 +846,12 @@ class TestExceptions(unittest.TestCase):
     test_unsupported_iterator_type = check_exception(
         TypeError, r"^Can't run optimized loop: "
                    r"Iterator has type .+ instead of ",
-        args=(0, range(LOOP_ITERATIONS)))(generalized_fib_func)
+        args=(0, iter(range(LOOP_ITERATIONS))))(generalized_fib_func)
+
+    test_list_without_progression = check_exception(
+        TypeError, r"^Can't run optimized loop: "
+                   r"Values of the iterable don't form an arithmetic ",
+        args=(range(LOOP_ITERATIONS) + [5],))(counter_sum_func)
 
     test_unallowed_variable_type = check_exception(
         TypeError, r"^Can't run optimized loop: "
@@ -358,6 +868,81 @@ class TestSettings(unittest.TestCase):
     # Otherwise it would have fallen with TypeError (because variable "a" has
     # an unallowed type).
 
+    def test_functions_without_optimized_loops(self):
+        def without_loops(a, b):
+            return sum([x * b for x in a])
+
+        def with_unsupported_loop(n):
+            res = 1
+            for i in xrange(2, n + 1):
+                res *= i
+            return res
+
+        decorator = cpmoptimize(strict=False)
+        self.assertIs(without_loops, decorator(without_loops))
+        self.assertIs(with_unsupported_loop, decorator(with_unsupported_loop))
+        # The functions get the same methods as optimized ones
+        self.assertEqual([], without_loops.report())
+        self.assertEqual(['failed'], [entry['outcome'] for entry in
+                                      with_unsupported_loop.report()])
+        self.assertEqual([], with_unsupported_loop.cache_info())
+        with_unsupported_loop.cache_clear()
+        if futures is not None:
+            self.assertEqual(
+                120, with_unsupported_loop.async_call(5).result(timeout=10))
+
+    def test_iters_limit_of_long_ranges(self):
+        def func(iterable):
+            res = 0
+            for i in iterable:
+                res += i
+            return res
+
+        n = 10 ** 30
+        optimized = cpmoptimize(iters_limit=LOOP_ITERATIONS)(func)
+        self.assertEqual(n * (n - 1) // 2, optimized(cpm_xrange(n)))
+        self.assertEqual(func(cpm_xrange(5)), optimized(cpm_xrange(5)))
+        self.assertEqual(func(xrange(LOOP_ITERATIONS)),
+                         optimized(xrange(LOOP_ITERATIONS)))
+
+    def test_iters_limit_in_non_verbose_mode(self):
+        # Short loops are skipped before calling `start_loop` (except in
+        # verbose mode), so the float variable is checked only if the
+        # number of iterations exceeds the limit
+        limit = 20
+        optimized = cpmoptimize(iters_limit=limit)(generalized_fib_func)
+        for make_iterable in (xrange, cpm_xrange, range,
+                              lambda n: tuple(xrange(0, 3 * n, 3))):
+            for n in (0, limit - 1, limit):
+                self.assertEqual(generalized_fib_func(0.5, make_iterable(n)),
+                                 optimized(0.5, make_iterable(n)))
+            with self.assertRaisesRegexp(TypeError,
+                                         r"^Can't run optimized loop: "):
+                optimized(0.5, make_iterable(limit + 1))
+            self.assertEqual(generalized_fib_func(0, make_iterable(limit + 1)),
+                             optimized(0, make_iterable(limit + 1)))
+
+        # Iterables of unknown types are checked by `start_loop`
+        with self.assertRaisesRegexp(TypeError, 'Iterator has type'):
+            optimized(0, iter(xrange(limit - 1)))
+        self.assertEqual(
+            generalized_fib_func(0.5, iter(xrange(limit - 1))),
+            cpmoptimize(iters_limit=limit, strict=False)(
+                generalized_fib_func)(0.5, iter(xrange(limit - 1))))
+
+    def test_max_degree(self):
+        def func(n):
+            res = 0
+            for i in xrange(n):
+                res += i * i
+            return res
+
+        self.assertEqual(func(LOOP_ITERATIONS),
+                         cpmoptimize(max_degree=2)(func)(LOOP_ITERATIONS))
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'Degree of a polynomial'):
+            cpmoptimize(max_degree=1)(func)
+
     @check_correctness(strict=False)
     def test_recompilation_error_in_non_strict_mode():
         res = 1
@@ -365,10 +950,593 @@ class TestSettings(unittest.TestCase):
             res *= i
         return res
 
+    @check_correctness(strict=False)
+    def test_lazy_folded_consts():
+        # Folded constants must not be evaluated if the optimization is
+        # skipped because of the variable type
+        a = 0.5
+        y = 0
+        for i in xrange(LOOP_ITERATIONS):
+            if y:
+                a += 1 / y
+        return a
+
+    def test_pure_funcs(self):
+        helpers = Stats()
+        helpers.impure_scale = impure_scale
+
+        def func(n, k):
+            res = 0
+            for i in xrange(n):
+                res += helpers.impure_scale(k)
+            return res
+
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'Unsupported instruction'):
+            cpmoptimize()(func)
+        optimized = cpmoptimize(iters_limit=0, pure_funcs=[impure_scale])(func)
+        self.assertEqual(func(LOOP_ITERATIONS, 3), optimized(LOOP_ITERATIONS, 3))
+
+        # Functions are checked in the run-time. If the attribute refers
+        # to another function, the optimization is skipped.
+        helpers.impure_scale = lambda value: value - 1
+        self.assertEqual(func(10, 3), cpmoptimize(
+            iters_limit=0, pure_funcs=[impure_scale], strict=False)(func)(10, 3))
+        with self.assertRaisesRegexp(TypeError, 'not declared pure'):
+            optimized(10, 3)
+
+    def test_shadowed_pure_funcs(self):
+        source = (
+            'def func(n, k):\n'
+            '    res = 0\n'
+            '    for i in xrange(n):\n'
+            '        res += max(k, 1) + maximum(k, 2)\n'
+            '    return res\n'
+        )
+        # Global functions are matched by the objects, not by the names
+        namespace = {'maximum': max}
+        exec source in namespace
+        optimized = cpmoptimize(iters_limit=0)(namespace['func'])
+        self.assertEqual(namespace['func'](LOOP_ITERATIONS, 3),
+                         optimized(LOOP_ITERATIONS, 3))
+        namespace = {'max': lambda first, second: first - second,
+                     'maximum': max}
+        exec source in namespace
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'Unsupported instruction'):
+            cpmoptimize()(namespace['func'])
+
+        def local_shadow(n, k):
+            max = min
+            res = 0
+            for i in xrange(n):
+                res += max(k, 1)
+            return res
+
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'Unsupported instruction'):
+            cpmoptimize()(local_shadow)
+
     test_runtime_error_in_non_strict_mode = check_correctness(
         args=(0, range(LOOP_ITERATIONS)),
         strict=False)(generalized_fib_func)
 
 
+def xorshift_func(state, iterable):
+    for i in iterable:
+        state ^= (state << 13) & 0xFFFFFFFFFFFFFFFF
+        state ^= state >> 7
+        state ^= (state << 17) & 0xFFFFFFFFFFFFFFFF
+    return state
+
+
+class TestGF2(unittest.TestCase):
+    def check_func(self, func, width, *args):
+        optimized = cpmoptimize(iters_limit=0, gf2_width=width)(func)
+        self.assertEqual(func(*args), optimized(*args))
+
+    def test_xorshift(self):
+        self.check_func(xorshift_func, 64, 88172645463325252,
+                        xrange(LOOP_ITERATIONS))
+
+    def test_jump_ahead(self):
+        # The state after 2 ** 64 steps is found by the period of the
+        # generator (every non-zero state is repeated after 2 ** 64 - 1
+        # steps)
+        optimized = cpmoptimize(iters_limit=0, gf2_width=64)(xorshift_func)
+        self.assertEqual(xorshift_func(123, xrange(1)),
+                         optimized(123, cpm_xrange(2 ** 64)))
+
+    def test_several_words(self):
+        def func(first, second, n, key):
+            for i in xrange(n):
+                tmp = first
+                first = second
+                tmp ^= (tmp << 23) & 0xFFFFFFFFFFFFFFFF
+                second = tmp ^ second ^ (tmp >> 17) ^ (second >> 26) ^ key
+            return first, second
+
+        self.check_func(func, 64, 1, 2, LOOP_ITERATIONS, GLOBAL_CONST)
+
+    def test_rotation(self):
+        def func(value, n):
+            mask = 0xFFFF
+            for i in xrange(n):
+                value = ((value << 5) | (value >> 11)) & 0xFFFF
+                value ^= mask >> 3
+            return value
+
+        self.check_func(func, 16, 0x1234, LOOP_ITERATIONS)
+
+    def test_lfsr(self):
+        def func(state, n):
+            for i in xrange(n):
+                bit = (state ^ (state >> 2) ^ (state >> 3) ^ (state >> 5)) & 1
+                state = (state >> 1) | (bit << 15)
+            return state
+
+        self.check_func(func, 16, 0xACE1, LOOP_ITERATIONS)
+
+    def test_inversion(self):
+        def func(first, second, n):
+            for i in xrange(n):
+                first, second = (~second & 0xFFFF,
+                                 (first ^ ~(second >> 3)) & 0xFF0F)
+            return first, second
+
+        self.check_func(func, 16, 0x1234, 0xBEEF, LOOP_ITERATIONS)
+        self.check_func(func, 16, 0x1234, 0xBEEF, LOOP_ITERATIONS + 1)
+
+    def test_recompilation_errors(self):
+        def unmasked_shift(state, n):
+            for i in xrange(n):
+                state ^= state << 1
+            return state
+
+        def counter_usage(state, n):
+            for i in xrange(n):
+                state ^= i
+            return state
+
+        def unmasked_inversion(state, n):
+            for i in xrange(n):
+                state = ~state
+            return state
+
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'may not fit in 8 bits'):
+            cpmoptimize(gf2_width=8)(unmasked_shift)
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'may not fit in 8 bits'):
+            cpmoptimize(gf2_width=8)(unmasked_inversion)
+        with self.assertRaisesRegexp(RecompilationError, "counter can't"):
+            cpmoptimize(gf2_width=8)(counter_usage)
+
+    def test_values_wider_than_word(self):
+        optimized = cpmoptimize(iters_limit=0, gf2_width=64,
+                                strict=False)(xorshift_func)
+        for state in (-5, 2 ** 70):
+            self.assertEqual(xorshift_func(state, xrange(100)),
+                             optimized(state, xrange(100)))
+
+    def test_constants_wider_than_word(self):
+        def func(state, n, key):
+            for i in xrange(n):
+                state = (state >> 1) ^ key
+            return state
+
+        optimized = cpmoptimize(iters_limit=0, gf2_width=8,
+                                strict=False)(func)
+        for key in (0x1FF, -1):
+            self.assertEqual(func(0x5A, 100, key), optimized(0x5A, 100, key))
+
+        optimized = cpmoptimize(iters_limit=0, gf2_width=8,
+                                strict=True)(func)
+        self.assertEqual(func(0x5A, 100, 0xC3), optimized(0x5A, 100, 0xC3))
+        with self.assertRaisesRegexp(TypeError,
+                                     r"^Can't run optimized loop: "):
+            optimized(0x5A, 100, 0x1FF)
+
+
+def max_plus_func(n, gain, cost):
+    best = 0
+    other = 5
+    for i in xrange(n):
+        best = max(best, other + gain)
+        other = other - cost
+    return best, other
+
+
+class TestSemirings(unittest.TestCase):
+    def check_func(self, func, semiring, *args):
+        optimized = cpmoptimize(iters_limit=0, semiring=semiring)(func)
+        self.assertEqual(func(*args), optimized(*args))
+
+    def test_max_plus(self):
+        self.check_func(max_plus_func, 'max_plus', LOOP_ITERATIONS, 7, 3)
+        self.check_func(max_plus_func, 'max_plus', LOOP_ITERATIONS, 7, -3)
+
+    def test_min_plus(self):
+        def func(n, weight):
+            a = 0
+            b = 100
+            for i in xrange(n):
+                a, b = b, min(a + weight, b + 3, GLOBAL_CONST)
+            return a, b
+
+        self.check_func(func, 'min_plus', LOOP_ITERATIONS, 2)
+        self.check_func(func, 'min_plus', LOOP_ITERATIONS + 1, 5)
+
+    def test_boolean(self):
+        def func(n, flag):
+            reach = False
+            prev = True
+            last = False
+            for i in xrange(n):
+                reach = reach or prev
+                prev, last = last and flag, prev or last and not flag
+            return reach, prev, last
+
+        for flag in (False, True):
+            self.check_func(func, 'boolean', LOOP_ITERATIONS, flag)
+
+    def test_invalid_values(self):
+        def func(n, reach):
+            for i in xrange(n):
+                reach = reach or False
+            return reach
+
+        optimized = cpmoptimize(iters_limit=0, semiring='boolean')(func)
+        with self.assertRaisesRegexp(TypeError, 'must contain a boolean'):
+            optimized(LOOP_ITERATIONS, 1)
+
+    def test_invalid_constants(self):
+        def func(n, flag):
+            reach = False
+            for i in xrange(n):
+                reach = reach or flag
+            return reach
+
+        optimized = cpmoptimize(iters_limit=0, semiring='boolean',
+                                strict=False)(func)
+        for flag in (1, 0, True):
+            self.assertEqual(func(LOOP_ITERATIONS, flag),
+                             optimized(LOOP_ITERATIONS, flag))
+
+        optimized = cpmoptimize(iters_limit=0, semiring='boolean',
+                                strict=True)(func)
+        with self.assertRaisesRegexp(TypeError,
+                                     r"^Can't run optimized loop: "):
+            optimized(LOOP_ITERATIONS, 1)
+
+    def test_shadowed_max(self):
+        source = (
+            'def func(n, gain, cost):\n'
+            '    best = 0\n'
+            '    other = 5\n'
+            '    for i in xrange(n):\n'
+            '        best = max(best, other + gain)\n'
+            '        other = other - cost\n'
+            '    return best, other\n'
+        )
+        namespace = {'max': lambda first, second: first}
+        exec source in namespace
+        with self.assertRaisesRegexp(RecompilationError,
+                                     'Unsupported instruction'):
+            cpmoptimize(semiring='max_plus')(namespace['func'])
+
+        # If "max" is defined after the decoration, it's checked in the
+        # run-time
+        namespace = {}
+        exec source in namespace
+        optimized = cpmoptimize(iters_limit=0, semiring='max_plus')(
+            namespace['func'])
+        namespace['max'] = lambda first, second: first
+        with self.assertRaisesRegexp(TypeError, 'not the builtin "max"'):
+            optimized(LOOP_ITERATIONS, 7, 3)
+        optimized = cpmoptimize(iters_limit=0, semiring='max_plus',
+                                strict=False)(namespace['func'])
+        self.assertEqual(namespace['func'](LOOP_ITERATIONS, 7, 3),
+                         optimized(LOOP_ITERATIONS, 7, 3))
+
+    def test_recompilation_errors(self):
+        def sum_of_vars(n):
+            a = 1
+            b = 2
+            for i in xrange(n):
+                a, b = a + b, b
+            return a
+
+        def conjunction_of_vars(n):
+            a = True
+            b = False
+            for i in xrange(n):
+                a, b = a and b, a
+            return a
+
+        with self.assertRaisesRegexp(RecompilationError, 'not linear'):
+            cpmoptimize(semiring='max_plus')(sum_of_vars)
+        with self.assertRaisesRegexp(RecompilationError, 'not linear'):
+            cpmoptimize(semiring='boolean')(conjunction_of_vars)
+        with self.assertRaises(ValueError):
+            cpmoptimize(semiring='tropical')
+        with self.assertRaises(ValueError):
+            cpmoptimize(semiring='boolean', gf2_width=8)
+
+
+def two_loops_func(n, offset):
+    a = 0
+    b = 1
+    for i in xrange(n):
+        a, b = b, a + b + offset
+    c = a
+    for i in xrange(n):
+        c = c * 3 - b
+    return a, b, c, i
+
+
+class TestCache(unittest.TestCase):
+    def test_cache_hits(self):
+        func = cpmoptimize(iters_limit=0, cache_size=10 ** 6)(two_loops_func)
+        for n, offset in ((1000, 1), (1000, 1), (1000, 2), (1000, 1)):
+            self.assertEqual(two_loops_func(n, offset), func(n, offset))
+        info = func.cache_info()
+        self.assertEqual([2, 2], [elem['hits'] for elem in info])
+        self.assertEqual([2, 2], [elem['misses'] for elem in info])
+        self.assertEqual([2, 2], [elem['entries'] for elem in info])
+        self.assertTrue(all(0 < elem['size'] <= 10 ** 6 for elem in info))
+
+        func.cache_clear()
+        self.assertEqual(two_loops_func(1000, 1), func(1000, 1))
+        self.assertEqual([2, 2], [elem['hits'] for elem in func.cache_info()])
+
+    def test_cache_size_limit(self):
+        entry_size = int_size(1) * 2
+        result_cache = ResultCache(entry_size * 2, None)
+        result_cache.put((1,), (1,))
+        result_cache.put((2,), (1,))
+        self.assertEqual((1,), result_cache.get((1,)))
+        result_cache.put((3,), (1,))  # Evicts the least recently used entry
+        result_cache.put((10 ** 1000,), (1,))  # Too big to be stored
+        self.assertEqual(None, result_cache.get((2,)))
+        self.assertEqual((1,), result_cache.get((1,)))
+        self.assertEqual((1,), result_cache.get((3,)))
+        self.assertEqual(None, result_cache.get((10 ** 1000,)))
+
+        info = result_cache.info()
+        self.assertEqual((3, 2, 2, entry_size * 2),
+                         (info['hits'], info['misses'], info['entries'], info['size']))
+
+    def test_equal_values_of_different_types(self):
+        def func(n, step):
+            res = 0
+            for i in xrange(n):
+                res += step
+            return res
+
+        optimized = cpmoptimize(iters_limit=0, cache_size=10 ** 6)(func)
+        for step in (1, 1.0, True, 1L, 1):
+            expected = func(LOOP_ITERATIONS, step)
+            actual = optimized(LOOP_ITERATIONS, step)
+            self.assertEqual((type(expected), expected),
+                             (type(actual), actual))
+        info, = optimized.cache_info()
+        self.assertEqual((1, 4), (info['hits'], info['entries']))
+
+    def test_size_of_tuples(self):
+        self.assertEqual(int_size(1) + int_size(10 ** 100),
+                         int_size((1, (int, 10 ** 100))))
+
+    def test_disabled_cache(self):
+        func = cpmoptimize(iters_limit=0)(two_loops_func)
+        self.assertEqual(two_loops_func(1000, 1), func(1000, 1))
+        self.assertEqual([], func.cache_info())
+
+
+class RecordingExecutor(object):
+    # Executor that runs submitted functions immediately and remembers them
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func, *args, **kwargs):
+        self.submitted.append(func)
+        future = futures.Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+@unittest.skipIf(futures is None, '"futures" package is not installed')
+class TestExecutor(unittest.TestCase):
+    def test_executor_threshold(self):
+        expected = generalized_fib_func(0, xrange(LOOP_ITERATIONS))
+        for threshold, submitted_count in ((1, 1), (10 ** 100, 0)):
+            executor = RecordingExecutor()
+            func = cpmoptimize(iters_limit=0, executor=executor,
+                               executor_threshold=threshold)(generalized_fib_func)
+            self.assertEqual(expected, func(0, xrange(LOOP_ITERATIONS)))
+            self.assertEqual(submitted_count, len(executor.submitted))
+
+    def test_process_pool_executor(self):
+        expected = generalized_fib_func(0, xrange(LOOP_ITERATIONS))
+        executor = futures.ProcessPoolExecutor(1)
+        try:
+            func = cpmoptimize(iters_limit=0, executor=executor,
+                               executor_threshold=0)(generalized_fib_func)
+            self.assertEqual(expected, func(0, xrange(LOOP_ITERATIONS)))
+        finally:
+            executor.shutdown()
+
+    def test_async_call(self):
+        func = cpmoptimize(iters_limit=0)(generalized_fib_func)
+        future = func.async_call(0, xrange(LOOP_ITERATIONS))
+        self.assertEqual(generalized_fib_func(0, xrange(LOOP_ITERATIONS)),
+                         future.result())
+
+        future = func.async_call(0.5, xrange(LOOP_ITERATIONS))
+        with self.assertRaisesRegexp(TypeError, r"^Can't run optimized loop: "):
+            future.result()
+
+    def test_async_calls_with_executor(self):
+        expected = generalized_fib_func(0, xrange(LOOP_ITERATIONS))
+        executor = futures.ThreadPoolExecutor(2)
+        try:
+            func = cpmoptimize(iters_limit=0, executor=executor,
+                               executor_threshold=0)(generalized_fib_func)
+            threads_count = threading.active_count()
+            calls = [func.async_call(0, xrange(LOOP_ITERATIONS))
+                     for i in xrange(MAX_ASYNC_CALLS * 2)]
+            # Calls are run in a shared pool with a limited number of
+            # threads
+            self.assertLessEqual(threading.active_count(),
+                                 threads_count + MAX_ASYNC_CALLS + 2)
+            for future in calls:
+                self.assertEqual(expected, future.result())
+        finally:
+            executor.shutdown()
+
+    def test_invalid_executor(self):
+        with self.assertRaisesRegexp(TypeError, r'^`executor` argument must '):
+            cpmoptimize(executor=object())
+
+
+def report_func(n, flag):
+    a, b = 0, 1
+    for i in xrange(n):
+        a, b = b, a + b
+    res = 1
+    for i in xrange(2, n + 1):
+        if flag:
+            res ^= i
+    return a, res
+
+
+class TestReport(unittest.TestCase):
+    def tearDown(self):
+        clear_report()
+
+    def test_function_report(self):
+        func = cpmoptimize(strict=False)(report_func)
+        self.assertEqual(report_func(100, True), func(100, True))
+
+        optimized, failed = func.report()
+        self.assertEqual(('report_func', 'optimized', None), (
+            optimized['function'], optimized['outcome'], optimized['reason']))
+        self.assertEqual((3, 0, 'unused'), (optimized['matrix_size'],
+                                            optimized['folded_consts'],
+                                            optimized['counter_status']))
+        self.assertEqual(('failed', 'unpredictable_operands', 'INPLACE_XOR',
+                          'read', None), (
+            failed['outcome'], failed['category'], failed['instruction'],
+            failed['counter_status'], failed['matrix_size']))
+        self.assertEqual(optimized['lineno'] + 3, failed['lineno'])
+
+    def test_deduplicated_folded_consts(self):
+        def func(x, n):
+            a, b = 1, 2
+            for i in xrange(n):
+                a, b = b * (x * GLOBAL_CONST), a * (x * GLOBAL_CONST) + b
+            return a, b
+
+        optimized = cpmoptimize(iters_limit=0)(func)
+        self.assertEqual(func(3, 100), optimized(3, 100))
+        self.assertEqual([1], [entry['folded_consts']
+                               for entry in optimized.report()])
+
+    def test_aggregated_report(self):
+        clear_report()
+        funcs = [cpmoptimize(strict=False)(report_func),
+                 cpmoptimize(strict=False)(generalized_fib_func)]
+        self.assertEqual(3, len(get_report()))
+        self.assertEqual(['report_func'], [
+            entry['function'] for entry in get_report('failed')])
+        self.assertEqual(get_report(), json.loads(dump_report()))
+
+        # Reports of garbage collected functions are removed
+        del funcs[0]
+        gc.collect()
+        self.assertEqual(['generalized_fib_func'], [
+            entry['function'] for entry in get_report()])
+
+        clear_report()
+        self.assertEqual([], get_report())
+
+
+IMPORTED_MODULE_SOURCE = '''
+a, b = 0, 1
+for i in xrange(%(n)s):
+    a, b = b, a + b
+
+
+def fib(n):
+    a, b = 0, 1
+    for i in xrange(n):
+        a, b = b, a + b
+    return a
+
+
+class Accumulator(object):
+    def add_squares(self, n):
+        res = 0
+        for i in xrange(n):
+            res += i * i
+        return res
+
+
+def factorial(n):
+    res = 1
+    for i in xrange(2, n + 1):
+        res *= i
+    return res
+''' % {'n': LOOP_ITERATIONS}
+
+
+class TestImportHook(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        package_path = os.path.join(self.path, 'cpm_test_package')
+        os.mkdir(package_path)
+        with open(os.path.join(package_path, '__init__.py'), 'w') as init_file:
+            init_file.write('VERSION = 1\n')
+        with open(os.path.join(package_path, 'loops.py'), 'w') as module_file:
+            module_file.write(IMPORTED_MODULE_SOURCE)
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        for name in ('cpm_test_package', 'cpm_test_package.loops'):
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.path)
+
+    def test_module_optimization(self):
+        importer = install_import_hook('cpm_test_package', iters_limit=0)
+        try:
+            from cpm_test_package import loops
+        finally:
+            importer.uninstall()
+
+        expected = generalized_fib_func(0, xrange(LOOP_ITERATIONS))
+        self.assertEqual((expected, LOOP_ITERATIONS - 1), (loops.a, loops.i))
+        self.assertEqual(expected, loops.fib(LOOP_ITERATIONS))
+        self.assertEqual(sum(i * i for i in xrange(LOOP_ITERATIONS)),
+                         loops.Accumulator().add_squares(LOOP_ITERATIONS))
+        self.assertEqual(120, loops.factorial(5))
+
+        self.assertEqual([], importer.changes['cpm_test_package'])
+        functions = [entry['function']
+                     for entry in importer.changes['cpm_test_package.loops']]
+        self.assertEqual(['fib', 'add_squares', '<module>'], functions)
+        self.assertNotIn(importer, sys.meta_path)
+
+    def test_unmatched_prefix(self):
+        importer = install_import_hook(['cpm_test'])
+        try:
+            import cpm_test_package
+        finally:
+            importer.uninstall()
+        self.assertEqual(1, cpm_test_package.VERSION)
+        self.assertEqual({}, importer.changes)
+
+
 if __name__ == '__main__':
     unittest.main()
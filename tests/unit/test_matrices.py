@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import sys
+
+PYTHON_VERSION = sys.version_info
+
+if PYTHON_VERSION < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from cpmoptimize.matrices import BitMatrix, Matrix, choose_window, MAX_WINDOW, \
+    BOOLEAN, MAX_PLUS, MIN_PLUS
+
+
+def naive_power(mat, n):
+    res = Matrix.identity(mat.rows)
+    for i in xrange(n):
+        res *= mat
+    return res
+
+
+def binary_power(mat, n):
+    res = Matrix.identity(mat.rows)
+    while n:
+        if n & 1:
+            res *= mat
+        mat *= mat
+        n >>= 1
+    return res
+
+
+class TestMatrix(unittest.TestCase):
+    def test_content(self):
+        content = [[1, 2, 3], [4, 5, 6]]
+        mat = Matrix(content)
+        self.assertEqual(content, mat.content)
+        self.assertEqual((2, 3), (mat.rows, mat.cols))
+        self.assertEqual(6, mat[-1, -1])
+        self.assertEqual([2, 5], mat.col(1))
+        self.assertEqual([[1, 4], [2, 5], [3, 6]], mat.transposed().content)
+
+    def test_multiplication(self):
+        first = Matrix([[1, 2], [3, 4], [5, 6]])
+        second = Matrix([[7, 8, 9], [10, 11, 12]])
+        self.assertEqual([[27, 30, 33], [61, 68, 75], [95, 106, 117]],
+                         (first * second).content)
+        with self.assertRaises(ValueError):
+            first * first
+
+    def test_power(self):
+        mat = Matrix([[2, -1, 0], [1, 3, 7], [0, 5, -4]])
+        for n in xrange(40):
+            self.assertEqual(naive_power(mat, n).content, (mat ** n).content)
+        # The operand mustn't be changed
+        self.assertEqual([[2, -1, 0], [1, 3, 7], [0, 5, -4]], mat.content)
+
+    def test_power_with_windows(self):
+        mat = Matrix([[0, 1, 0], [1, 1, 3], [-2, 0, 1]])
+        for n in (255, 256, 1000, 2 ** 14 - 1, 0x5ad3, 3 ** 9):
+            self.assertEqual(binary_power(mat, n).content, (mat ** n).content)
+
+    def test_window_size(self):
+        self.assertEqual(1, choose_window(8, 3))
+        self.assertEqual(MAX_WINDOW, choose_window(10 ** 6, 3))
+        # Powers of big matrices occupy too much memory
+        self.assertTrue(choose_window(10 ** 6, 200) < choose_window(10 ** 6, 20))
+        windows = [choose_window(2 ** power, 10) for power in xrange(20)]
+        self.assertEqual(sorted(windows), windows)
+
+    def test_power_of_empty_matrix(self):
+        self.assertEqual([], (Matrix([]) ** 5).content)
+
+
+def bit_matrix_to_matrix(mat):
+    return Matrix([[mat.row(y) >> x & 1 for x in xrange(mat.side)]
+                   for y in xrange(mat.side)])
+
+
+class TestBitMatrix(unittest.TestCase):
+    def test_multiplication(self):
+        first = BitMatrix([0b011, 0b110, 0b101])
+        second = BitMatrix([0b111, 0b010, 0b001])
+        product = bit_matrix_to_matrix(first) * bit_matrix_to_matrix(second)
+        self.assertEqual([[elem % 2 for elem in row] for row in product.content],
+                         bit_matrix_to_matrix(first * second).content)
+
+    def test_power(self):
+        mat = BitMatrix([0b0110, 0b1001, 0b0011, 0b1100])
+        res = BitMatrix.identity(4)
+        for n in xrange(40):
+            self.assertEqual(res, mat ** n)
+            res = mat * res
+
+    def test_apply(self):
+        mat = BitMatrix([0b011, 0b110, 0b001])
+        # Column vector (1, 0, 1)
+        self.assertEqual(0b111, mat.apply(0b101))
+        self.assertEqual(0b101, mat.apply(0b001))
+
+
+class TestSemiringMatrix(unittest.TestCase):
+    def test_max_plus_power(self):
+        mat = Matrix([[0, 3, MAX_PLUS.zero], [-1, 2, 5], [4, MAX_PLUS.zero, 1]],
+                     MAX_PLUS)
+        res = Matrix.identity(3, MAX_PLUS)
+        for n in xrange(40):
+            self.assertEqual(res.content, (mat ** n).content)
+            res *= mat
+
+    def test_min_plus_shortest_paths(self):
+        inf = MIN_PLUS.zero
+        mat = Matrix([[0, 4, 1], [inf, 0, inf], [inf, 2, 0]], MIN_PLUS)
+        self.assertEqual([[0, 3, 1], [inf, 0, inf], [inf, 2, 0]],
+                         (mat ** 10).content)
+
+    def test_boolean_reachability(self):
+        mat = Matrix([[False, True, False], [False, False, True],
+                      [False, False, False]], BOOLEAN)
+        self.assertEqual([False, False, True], (mat ** 2).row(0))
+        self.assertEqual([False, False, False], (mat ** 3).row(0))
+
+    def test_mixed_semirings(self):
+        with self.assertRaises(ValueError):
+            Matrix.identity(2) * Matrix.identity(2, MAX_PLUS)
+
+
+if __name__ == '__main__':
+    unittest.main()
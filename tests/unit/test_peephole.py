@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import sys
+
+PYTHON_VERSION = sys.version_info
+
+if PYTHON_VERSION < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from cpmoptimize import cpmoptimize
+from cpmoptimize.matcode import *
+from cpmoptimize.peephole import matcode_size, optimize_matcode
+
+
+def var(index):
+    return VAR, index
+
+
+class TestPeephole(unittest.TestCase):
+    def test_step_terms(self):
+        matcode = [
+            [LOOP, (PARAM, 'iters_count')],
+            [STEP,
+             var(0), var(1), (VALUE, 2), var(0), var(1), (VALUE, 3),
+             var(0), (UNIT, None), (CONST, 0), var(0), var(1), (CONST, 1),
+             var(1), var(1), (VALUE, 1),
+             var(2), var(0), (VALUE, 1), var(2), var(0), (VALUE, -1)],
+            [END],
+        ]
+        self.assertEqual([
+            [LOOP, (PARAM, 'iters_count')],
+            [STEP,
+             var(0), var(1), (VALUE, 5),
+             var(0), (UNIT, None), (CONST, 0), var(0), var(1), (CONST, 1),
+             var(2), var(0), (VALUE, 0)],
+            [END],
+        ], optimize_matcode(matcode))
+        self.assertEqual(9, matcode_size(matcode))
+
+    def test_size_of_other_steps(self):
+        matcode = [
+            [LOOP, (PARAM, 'iters_count')],
+            [XOR_STEP, var(0), (VALUE, (1, 2)), (VALUE, 0),
+             var(1), (VALUE, (4,)), (VALUE, 3)],
+            [SEMIRING_STEP, var(0), var(1), (VALUE, 2),
+             var(0), (UNIT, None), (VALUE, 0), var(1), var(1), (VALUE, 0)],
+            [END],
+        ]
+        self.assertEqual(7, matcode_size(matcode))
+
+    def test_unchanged_values(self):
+        matcode = [
+            [LOOP, (PARAM, 'iters_count')],
+            [STEP, var(0), var(0), (VALUE, 1), var(1), var(0), (VALUE, 0),
+             var(1), var(1), (VALUE, 1)],
+            [END],
+        ]
+        self.assertEqual([[LOOP, (PARAM, 'iters_count')], [END]],
+                         optimize_matcode(matcode))
+
+    def test_blocks(self):
+        step = [STEP, var(0), var(1), (VALUE, 1)]
+        other_step = [STEP, var(1), var(0), (CONST, 2)]
+        matcode = [
+            [LOOP, (PARAM, 'iters_count')],
+            [PHASES, (VALUE, 2)],
+            [IF, (CONST, 0)], step, [ELSE], step, [ENDIF],
+            [NEXT_PHASE],
+            [IF, (CONST, 1)], step, [ELSE], other_step, [ENDIF],
+            [END_PHASES],
+            [IF, (CONST, 1)], [STEP, var(0), var(0), (VALUE, 1)], [ENDIF],
+            [END],
+        ]
+        self.assertEqual([
+            [LOOP, (PARAM, 'iters_count')],
+            [PHASES, (VALUE, 2)],
+            step,
+            [NEXT_PHASE],
+            [IF, (CONST, 1)], step, [ELSE], other_step, [ENDIF],
+            [END_PHASES],
+            [END],
+        ], optimize_matcode(matcode))
+
+    def test_identical_phases(self):
+        def func(n):
+            a = 1
+            b = 0
+            for i in xrange(n):
+                if i % 2 == 0:
+                    a += b
+                else:
+                    a += b
+                b += 3
+            return a, b
+
+        optimized = cpmoptimize(iters_limit=0)(func)
+        for n in (0, 1, 2, 1001):
+            self.assertEqual(func(n), optimized(n))
+        entry, = optimized.report()
+        self.assertLess(entry['matcode_size'], entry['unoptimized_matcode_size'])
+
+
+if __name__ == '__main__':
+    unittest.main()